@@ -0,0 +1,146 @@
+'''
+Hyperparameter sweeps for the bandit study in 2519631_RL_Assignment1_MABs.ipynb.
+A sweep is a list of jobs, each one algorithm (e_greedy or UCB) with one set of hyperparameters and
+one seed, run as `runs` batched runs (K_Arm_Bandit.e_greedy_batch/UCB_batch) of `steps` steps. Jobs
+run in a process pool, every job on its own copy of the bandit and with its own random generator
+seeded from the job, so a result doesn't depend on which worker ran it or in what order. Results are
+cached on disk under a key of the bandit's arms, the source of the batched methods and the job, and
+re-running a sweep only computes the jobs that aren't cached yet. Editing e_greedy_batch, UCB_batch or
+_run_batch starts new keys; bump CACHE_VERSION for changes they don't show, e.g. to _run_job.
+
+    sweep = Sweep(MAB)
+    curves = sweep.run(sweep.jobs('e_greedy', 'epsilon', epsilons, seeds=range(8), opt_init=0))
+
+The bandit class reaches the workers by fork, as classes defined in a notebook can't be imported by a
+fresh interpreter. Where fork isn't available the jobs run one by one in the notebook's process.
+'''
+import copy
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+CACHE_DIR = 'bandit_sweep_cache'
+STEPS = 1000
+RUNS = 100          # batched runs per job
+CACHE_VERSION = 1
+# methods of the bandit a job's result depends on
+CODE = ('_run_batch', 'e_greedy_batch', 'UCB_batch')
+
+
+def _code_hash(bandit):
+    '''Hash of the source of the bandit's CODE methods, of their bytecode where the source isn't available'''
+    h = hashlib.sha1()
+    for name in CODE:
+        method = getattr(bandit, name)
+        try:
+            h.update(inspect.getsource(method).encode())
+        except (OSError, TypeError):
+            h.update(method.__code__.co_code)
+    return h.hexdigest()
+
+
+def _run_job(bandit, job):
+    '''(average reward per time step over the job's runs, seconds it took)'''
+    start = time.perf_counter()
+    method = getattr(bandit, job['algorithm'] + '_batch')
+    curve = method(job['runs'], steps=job['steps'], average=True, seed=job['seed'], **job['params'])
+    return curve, time.perf_counter() - start
+
+
+class Sweep:
+    def __init__(self, bandit, cache_dir=CACHE_DIR, workers=None):
+        self.bandit = bandit
+        self.cache_dir = cache_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.report = {}
+        # what the results depend on, the arms are fixed when the bandit is made
+        self.problem = {'K': bandit.K, 'var': float(bandit.var), 'arm_means': [float(np.ravel(m)[0]) for m in bandit.arm_means]}
+        # and the code that computes them
+        self.code = {'version': CACHE_VERSION, 'methods': _code_hash(bandit)}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def jobs(self, algorithm, name, values, seeds=(0,), steps=STEPS, runs=RUNS, **fixed):
+        '''One job per value of hyperparameter `name` and seed, with the `fixed` hyperparameters'''
+        out = []
+        for value in values:
+            for seed in seeds:
+                params = dict(fixed)
+                params[name] = float(value)
+                out.append({'algorithm': algorithm, 'params': params, 'seed': int(seed), 'steps': steps, 'runs': runs})
+        return out
+
+    def key(self, job):
+        text = json.dumps({'problem': self.problem, 'code': self.code, 'job': job}, sort_keys=True)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _path(self, job):
+        return os.path.join(self.cache_dir, self.key(job) + '.npy')
+
+    def _load(self, job):
+        if not self.cache_dir:
+            return None
+        try:
+            return np.load(self._path(job))
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, job, curve):
+        if not self.cache_dir:
+            return
+        path = self._path(job)
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'wb') as f:
+            np.save(f, curve)
+        os.replace(temp, path)
+
+    def _pool(self, workers):
+        if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+        return None
+
+    def compute(self, jobs, workers=None):
+        '''[(curve, seconds)] of every job, computed without the cache'''
+        workers = min(workers or self.workers, max(1, len(jobs)))
+        pool = self._pool(workers)
+        if pool is None:
+            return [_run_job(copy.deepcopy(self.bandit), job) for job in jobs]
+        with pool:
+            # every job is pickled with its own copy of the bandit
+            futures = [pool.submit(_run_job, self.bandit, job) for job in jobs]
+            return [f.result() for f in futures]
+
+    def run(self, jobs):
+        '''Average reward per time step of every job, in order, from the cache where it can'''
+        start = time.perf_counter()
+        curves = [self._load(job) for job in jobs]
+        todo = [i for i in range(len(jobs)) if curves[i] is None]
+        busy = 0.0
+        for i, (curve, seconds) in zip(todo, self.compute([jobs[i] for i in todo])):
+            self._store(jobs[i], curve)
+            curves[i] = curve
+            busy += seconds
+        wall = time.perf_counter() - start
+        self.report = {'jobs': len(jobs), 'cached': len(jobs) - len(todo), 'computed': len(todo),
+                       'workers': self.workers, 'wall': wall, 'job_time': busy}
+        print('{} jobs: {} cached, {} computed on {} workers in {:.1f} s ({:.1f} s of job time)'.format(
+            len(jobs), len(jobs) - len(todo), len(todo), self.workers, wall, busy))
+        return curves
+
+    def scaling(self, jobs, workers=None):
+        '''[(workers, wall time s, speedup over one worker)] computing the jobs without the cache'''
+        if workers is None:
+            workers = sorted(set([1, 2, 4, 8, 16, self.workers]) & set(range(1, self.workers + 1)))
+        out = []
+        for n in workers:
+            start = time.perf_counter()
+            self.compute(jobs, n)
+            wall = time.perf_counter() - start
+            out.append((n, wall, out[0][1] / wall if out else 1.0))
+        return out
@@ -0,0 +1,129 @@
+from array import array
+
+# Filter modes available per channel
+BOXCAR = 0
+MEDIAN = 1
+
+
+class Channel:
+    '''
+    Oversampling ring buffer for a single ADC input.
+    Raw codes are written into a preallocated array('H') and every `oversample` samples the
+    buffer is decimated into a single filtered code using a boxcar (mean) or median filter.
+    `low` and `high` track the extremes of the filtered codes since the last clear_extremes(), so
+    readers polling `value` less often than it is decimated still see short excursions.
+    '''
+    def __init__(self, adc, oversample=16, mode=BOXCAR):
+        if oversample < 1:
+            raise Exception('Oversample factor must be at least 1')
+        if mode != BOXCAR and mode != MEDIAN:
+            raise Exception('Filter mode must be BOXCAR or MEDIAN')
+        self.adc = adc
+        self.oversample = oversample
+        self.mode = mode
+        self.ring = array('H', [0] * oversample)
+        # scratch buffer used by the median filter so that sorting never allocates
+        self.scratch = array('H', [0] * oversample)
+        self.index = 0
+        self.raw = 0
+        self.value = 0
+        self.low = 0
+        self.high = 0
+        self.windows = 0
+
+    def sample(self):
+        '''Store one raw reading and decimate when the ring buffer wraps'''
+        self.raw = self.adc.read()
+        self.ring[self.index] = self.raw
+        self.index += 1
+        if self.index == self.oversample:
+            self.index = 0
+            if self.mode == MEDIAN:
+                self.value = self._median()
+            else:
+                self.value = self._boxcar()
+            if self.value < self.low:
+                self.low = self.value
+            if self.value > self.high:
+                self.high = self.value
+            self.windows += 1
+
+    def clear_extremes(self):
+        self.low = self.value
+        self.high = self.value
+
+    def _boxcar(self):
+        ring = self.ring
+        total = 0
+        for i in range(self.oversample):
+            total += ring[i]
+        return total // self.oversample
+
+    def _median(self):
+        ring = self.ring
+        scratch = self.scratch
+        n = self.oversample
+        # insertion sort into the scratch buffer, n is small so this beats anything fancier
+        for i in range(n):
+            v = ring[i]
+            j = i - 1
+            while j >= 0 and scratch[j] > v:
+                scratch[j + 1] = scratch[j]
+                j -= 1
+            scratch[j + 1] = v
+        return scratch[n // 2]
+
+    def read(self):
+        '''Latest filtered ADC code. Drop-in replacement for ADC.read()'''
+        return self.value
+
+    def __getattr__(self, name):
+        # anything else (atten, width, ...) goes to the underlying ADC
+        return getattr(self.adc, name)
+
+
+class Acquisition:
+    '''
+    Samples every registered channel round-robin from a hardware timer.
+    Readers use the Channel objects returned by add(), which never block and never allocate.
+    '''
+    def __init__(self, timer, period=1):
+        self.timer = timer
+        self.period = period  # ms between sampling rounds
+        self.channels = []
+        self.running = False
+        self.hook = None  # called with no arguments after every sampling round, e.g. Protection.check
+
+    def add(self, adc, oversample=16, mode=BOXCAR):
+        '''Registers an ADC input and returns its filtered Channel'''
+        channel = Channel(adc, oversample, mode)
+        self.channels.append(channel)
+        return channel
+
+    def sample_all(self, timer=None):
+        '''Timer callback: take one reading from every channel'''
+        for channel in self.channels:
+            channel.sample()
+        if self.hook is not None:
+            self.hook()
+
+    def prime(self):
+        '''Fill every ring buffer once so that the first reads are valid filtered values'''
+        longest = 0
+        for channel in self.channels:
+            if channel.oversample > longest:
+                longest = channel.oversample
+        for i in range(longest):
+            self.sample_all()
+
+    def start(self):
+        if not self.running:
+            self.prime()
+            for channel in self.channels:
+                channel.clear_extremes()
+            self.timer.init(period=self.period, callback=self.sample_all)
+            self.running = True
+
+    def stop(self):
+        self.timer.deinit()
+        self.running = False
@@ -0,0 +1,59 @@
+'''
+HMAC-SHA256 signatures for control messages, on the device and in the host-side control tool.
+The signature covers the exact bytes sent, so neither side has to agree on how JSON is formatted:
+the sender builds the message with "SIG": "" in it, signs those bytes and writes the hex signature
+into the placeholder; the receiver takes it back out before checking. Every device holds its own key,
+derived from the fleet key with device_key(), so one device's key can't sign for another.
+'''
+from binascii import hexlify
+import hashlib
+
+BLOCK = 64  # SHA-256 block size
+SIG = b'"SIG": "'
+PLACEHOLDER = b'"SIG": ""'
+HEX_SIZE = 64
+
+
+def hmac_sha256(key, msg):
+    '''HMAC (RFC 2104) with SHA-256, MicroPython has no hmac module'''
+    if len(key) > BLOCK:
+        key = hashlib.sha256(key).digest()
+    key = key + bytes(BLOCK - len(key))
+    inner = hashlib.sha256(bytes(b ^ 0x36 for b in key))
+    inner.update(msg)
+    outer = hashlib.sha256(bytes(b ^ 0x5C for b in key))
+    outer.update(inner.digest())
+    return outer.digest()
+
+
+def device_key(fleet_key, device_id):
+    '''A device's key (hex string, the CONTROL_KEY of its config) from the fleet key'''
+    if isinstance(fleet_key, str):
+        fleet_key = fleet_key.encode()
+    return hexlify(hmac_sha256(fleet_key, device_id.encode())).decode()
+
+
+def sign(msg, key):
+    '''Fills the "SIG": "" placeholder of msg (bytes) with the signature of msg'''
+    at = msg.find(PLACEHOLDER)
+    if at < 0:
+        raise ValueError('Message has no "SIG": "" placeholder')
+    signature = hexlify(hmac_sha256(key.encode(), msg))
+    return msg[:at + len(SIG)] + signature + msg[at + len(SIG):]
+
+
+def verify(msg, key):
+    '''True when msg (bytes) carries a valid signature for key'''
+    at = msg.find(SIG)
+    if at < 0:
+        return False
+    start = at + len(SIG)
+    signature = msg[start:start + HEX_SIZE]
+    if len(signature) != HEX_SIZE or msg[start + HEX_SIZE:start + HEX_SIZE + 1] != b'"':
+        return False
+    expected = hexlify(hmac_sha256(key.encode(), msg[:start] + msg[start + HEX_SIZE:]))
+    # compare every byte, the time taken says nothing about where they differ
+    diff = 0
+    for i in range(HEX_SIZE):
+        diff |= expected[i] ^ signature[i]
+    return diff == 0
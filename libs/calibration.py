@@ -0,0 +1,98 @@
+'''
+Calibration profiles: per board corrections from a channel's filtered ADC code straight to a reading,
+fitted on the host by tools/calibrate.py from codes recorded next to a reference meter.
+A profile maps reading names (as in libs/telemetry.py FIELDS) to one of
+    {'poly': [c0, c1, c2, ...]}             value = c0 + c1 * code + c2 * code ** 2 ...
+    {'points': [[code, value], ...]}        piecewise linear through the points, extended past the ends
+solar_voltage is the panel's rise over the battery, which fetch_data() adds to the battery voltage. The
+panel is measured against the 3.3V rail, so its conversion falls as the code rises; all others rise.
+Profiles live in the config file under CALIBRATION and are selected by charger profile:
+    "CALIBRATION": {"gamistar": {"battery_voltage": {"poly": [0.012, 0.0365]}, ...}}
+They are only evaluated while the conversion tables (libs/lut.py) are built at boot; sampling still
+converts every reading with one integer table lookup.
+'''
+READINGS = ('scc_load_voltage', 'scc_load_current', 'battery_voltage', 'battery_current',
+            'solar_voltage', 'solar_current')
+FALLING = ('solar_voltage',)
+CODES = 1 << 13
+CHECK_STEP = 64     # codes between the samples checked for a monotonic conversion
+
+
+def polynomial(coefficients):
+    c = [float(x) for x in coefficients]
+    if not c:
+        raise ValueError('Polynomial has no coefficients')
+
+    def convert(code):
+        v = 0.0
+        for i in range(len(c) - 1, -1, -1):
+            v = v * code + c[i]
+        return v
+    return convert
+
+
+def piecewise(points):
+    points = sorted([float(p[0]), float(p[1])] for p in points)
+    codes = [p[0] for p in points]
+    values = [p[1] for p in points]
+    if len(codes) < 2:
+        raise ValueError('Piecewise correction needs at least two points')
+    for i in range(1, len(codes)):
+        if codes[i] <= codes[i - 1]:
+            raise ValueError('Piecewise correction has two points at code {}'.format(codes[i]))
+    last = len(codes) - 1
+
+    def convert(code):
+        i = 1
+        while i < last and code > codes[i]:
+            i += 1
+        return values[i - 1] + (values[i] - values[i - 1]) * (code - codes[i - 1]) / (codes[i] - codes[i - 1])
+    return convert
+
+
+def correction(spec, falling=False):
+    '''
+    code -> value function of a profile entry. Raises ValueError when the entry is malformed or
+    the conversion doesn't rise with the code (fall with `falling`), which the protection thresholds rely on.
+    '''
+    if 'poly' in spec:
+        convert = polynomial(spec['poly'])
+    elif 'points' in spec:
+        convert = piecewise(spec['points'])
+    else:
+        raise ValueError('Calibration needs poly or points')
+    sign = -1 if falling else 1
+    last = sign * convert(0)
+    for code in range(CHECK_STEP, CODES, CHECK_STEP):
+        v = sign * convert(code)
+        if v < last:
+            raise ValueError('Calibration turns back at code {}'.format(code))
+        last = v
+    return convert
+
+
+def profile(config, charger):
+    '''{reading: entry} of a charger profile, empty when it has none'''
+    return config.get('CALIBRATION', {}).get(charger, {})
+
+
+def calibrated(channel, name, spec):
+    '''convert() reading the channel's filtered code through a reading's profile entry, for ConversionTable.build and threshold_code'''
+    convert = correction(spec, name in FALLING)
+    return lambda: convert(channel.value)
+
+
+def check(calibration):
+    '''Raises ValueError unless every entry of every profile in a CALIBRATION value is usable'''
+    if not isinstance(calibration, dict):
+        raise ValueError('CALIBRATION must map charger profiles to profiles')
+    for charger in calibration:
+        if not isinstance(calibration[charger], dict):
+            raise ValueError('Profile {} must map readings to corrections'.format(charger))
+        for name in calibration[charger]:
+            if name not in READINGS:
+                raise ValueError('Unknown reading {}'.format(name))
+            try:
+                correction(calibration[charger][name], name in FALLING)
+            except (TypeError, KeyError, IndexError):
+                raise ValueError('Malformed {} calibration'.format(name))
@@ -0,0 +1,178 @@
+from libs.ticks import ticks_ms, ticks_diff
+
+# Message keys that address or authenticate the command rather than being one
+ENVELOPE = ('ID', 'REQUEST_ID', 'EXPIRES', 'SIG')
+
+
+class CommandStats:
+    '''Count, duplicate count and last and worst-case latency (ms, receipt to reply) of one command'''
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.duplicates = 0
+        self.last_latency = 0
+        self.worst_latency = 0
+        self.total_latency = 0
+
+    def record(self, latency):
+        self.count += 1
+        self.last_latency = latency
+        self.total_latency += latency
+        if latency > self.worst_latency:
+            self.worst_latency = latency
+
+    def __repr__(self):
+        return '{}: count={} duplicates={} last={}ms worst={}ms'.format(
+            self.name, self.count, self.duplicates, self.last_latency, self.worst_latency)
+
+
+class Dispatcher:
+    '''
+    Registry of control command handlers with a bounded inbound queue.
+    submit() is cheap and runs in the MQTT callback; the handlers run later from process(), one message
+    per call, so a burst of control messages can't stall the caller.
+    Every key of a message other than the envelope (ID, REQUEST_ID, EXPIRES, SIG) is one command:
+    {'COMMAND': name} runs the handler registered with command(), {key: value} the one registered with update().
+    A message with a REQUEST_ID seen again within `dedup_window` ms is dropped. Messages without one, from
+    dashboards that predate it, run every time: an operator repeating a command expects it to be answered.
+    Replies carry the REQUEST_ID of the message so commands can be pipelined.
+    A handler that raises is counted in `failed` and answered with a HANDLER_FAILED error; the other
+    commands of the message still run and the caller's task carries on.
+    A retry of a request that was already handled gets the same replies again instead of running twice,
+    so a sender that lost a reply can retry with the same REQUEST_ID.
+    '''
+    def __init__(self, reply, queue=8, dedup=16, dedup_window=30000, clock=ticks_ms):
+        self.reply = reply                  # called with a reply dictionary
+        self.commands = {}                  # COMMAND value -> (handler, reply key)
+        self.updates = {}                   # message key -> (handler, reply key)
+        self.queue = []                     # (ticks received, message)
+        self.queue_size = queue
+        self.recent = []                    # [REQUEST_ID, ticks, replies] of the last `dedup` messages
+        self.dedup = dedup
+        self.dedup_window = dedup_window
+        self.clock = clock
+        self.stats = {}                     # command name -> CommandStats
+        self.rejected = 0                   # messages dropped because the queue was full
+        self.unknown = 0
+        self.replayed = 0                   # retries answered from the replies of the first run
+        self.failed = 0                     # handler calls that raised
+
+    def command(self, name, handler, reply_key=None):
+        '''
+        handler() runs for {'COMMAND': name}. When reply_key is given its return value is
+        published as {reply_key: value}.
+        '''
+        self.commands[name] = (handler, reply_key)
+
+    def update(self, key, handler, reply_key=None):
+        '''As command(), for {key: value} messages. handler(value) gets the value.'''
+        self.updates[key] = (handler, reply_key)
+
+    def command_stats(self, name):
+        if name not in self.stats:
+            self.stats[name] = CommandStats(name)
+        return self.stats[name]
+
+    def _names(self, message):
+        names = []
+        for key, value in message.items():
+            if key in ENVELOPE:
+                continue
+            names.append(value if key == 'COMMAND' else key)
+        return names
+
+    def _duplicate(self, request_id, now):
+        '''The recent entry of request_id when it was seen within the window, otherwise records it and returns None'''
+        for entry in self.recent:
+            if entry[0] == request_id and ticks_diff(now, entry[1]) < self.dedup_window:
+                entry[1] = now
+                return entry
+        self.recent.append([request_id, now, None])
+        if len(self.recent) > self.dedup:
+            self.recent.pop(0)
+        return None
+
+    def _forget(self, request_id):
+        for entry in self.recent:
+            if entry[0] == request_id:
+                self.recent.remove(entry)
+                return
+
+    def _remember(self, request_id, replies):
+        for entry in self.recent:
+            if entry[0] == request_id:
+                entry[2] = replies
+                return
+
+    def submit(self, message):
+        '''Queues an authenticated message. Returns False when it is a duplicate or the queue is full.'''
+        now = self.clock()
+        request_id = message.get('REQUEST_ID')
+        duplicate = self._duplicate(request_id, now) if request_id is not None else None
+        if duplicate is not None:
+            for name in self._names(message):
+                self.command_stats(name).duplicates += 1
+            # still queued when there are no replies yet, they will go out once it has run
+            if duplicate[2]:
+                self.replayed += 1
+                for response in duplicate[2]:
+                    self.reply(response)
+            return False
+        if len(self.queue) >= self.queue_size:
+            self.rejected += 1
+            if request_id is not None:
+                # not handled, a retry has to be let through
+                self._forget(request_id)
+                self.reply({'ERROR': 'BUSY', 'REQUEST_ID': request_id})
+            return False
+        self.queue.append((now, message))
+        return True
+
+    def pending(self):
+        return len(self.queue)
+
+    def process(self):
+        '''Runs the handlers of the oldest queued message. Returns False when the queue was empty.'''
+        if not self.queue:
+            return False
+        received, message = self.queue.pop(0)
+        request_id = message.get('REQUEST_ID')
+        replies = []
+        for key, value in message.items():
+            if key in ENVELOPE:
+                continue
+            if key == 'COMMAND':
+                name = value
+                entry = self.commands.get(value)
+            else:
+                name = key
+                entry = self.updates.get(key)
+            if entry is None:
+                self.unknown += 1
+                print("Invalid Command" if key == 'COMMAND' else "Invalid key used for update")
+                if request_id is not None:
+                    replies.append({'ERROR': 'UNKNOWN_COMMAND', 'COMMAND': name, 'REQUEST_ID': request_id})
+                    self.reply(replies[-1])
+                continue
+            handler, reply_key = entry
+            try:
+                result = handler() if key == 'COMMAND' else handler(value)
+            except Exception as e:
+                self.failed += 1
+                print("Command {} failed: {!r}".format(name, e))
+                response = {'ERROR': 'HANDLER_FAILED', 'COMMAND': name}
+                if request_id is not None:
+                    response['REQUEST_ID'] = request_id
+                    replies.append(response)
+                self.reply(response)
+                continue
+            if reply_key is not None:
+                response = {reply_key: result}
+                if request_id is not None:
+                    response['REQUEST_ID'] = request_id
+                    replies.append(response)
+                self.reply(response)
+            self.command_stats(name).record(ticks_diff(self.clock(), received))
+        if request_id is not None:
+            self._remember(request_id, replies)
+        return True
@@ -0,0 +1,49 @@
+from libs.ticks import ticks_ms, ticks_diff
+
+# Fields that are never a reason to publish on their own
+IGNORED = ('time', 'stats')
+
+
+class ReportByException:
+    '''
+    Decides which DATA fields are worth publishing.
+    Numeric fields with a deadband are reported once they move more than the deadband away from
+    the last reported value, any other field is reported when it changes. A full snapshot is
+    returned every `heartbeat` ms and after force().
+    '''
+    def __init__(self, deadbands, heartbeat, clock=ticks_ms):
+        self.deadbands = deadbands
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.last = {}          # field -> last reported value
+        self.last_full = None   # ticks of the last full snapshot
+
+    def force(self):
+        '''Makes the next call to changes() return a full snapshot'''
+        self.last_full = None
+
+    def changes(self, data):
+        '''
+        Returns `data` itself when a full snapshot is due, a dictionary of the changed fields,
+        or None when nothing moved beyond its deadband.
+        '''
+        now = self.clock()
+        if self.last_full is None or ticks_diff(now, self.last_full) >= self.heartbeat:
+            self.last_full = now
+            self.last.update(data)
+            return data
+        changed = {}
+        for key, value in data.items():
+            if key in IGNORED:
+                continue
+            last = self.last.get(key)
+            band = self.deadbands.get(key)
+            if band is None or value is None or last is None:
+                if value != last:
+                    changed[key] = value
+            elif abs(value - last) > band:
+                changed[key] = value
+        if not changed:
+            return None
+        self.last.update(changed)
+        return changed
@@ -0,0 +1,59 @@
+'''
+Console dumps of main.py's DATA, ERROR_STATES and CONFIG for DEBUG_STATE runs.
+Imported only when they are printed, so a normal boot doesn't load them.
+'''
+
+
+def printDATA(DATA):
+    '''Used to verify DATA dictionary, which gets sent to the MQTT server'''
+    print("\033[4m" + "DATA DICTIONARY" + "\033[0m")
+    print('scc_load_voltage : {:>36.7} V'.format(DATA['scc_load_voltage']))
+    print('scc_load_current : {:>40.7} A'.format(DATA['scc_load_current']))
+    
+    print('battery_connected : {!r:>36}'.format(DATA['battery_connected']))
+    print('battery_voltage : {:>27.7} V'.format(DATA['battery_voltage']))
+    print('battery_current : {:>31.7} A'.format(DATA['battery_current']))
+    
+    print('panel_connected : {!r:>39}'.format(DATA['panel_connected']))
+    print('solar_voltage : {:>30.7} V'.format(DATA['solar_voltage']))
+    print('solar_current : {:>34.7} A'.format(DATA['solar_current']))
+    
+    print('temperature : {:>49.7} {}C'.format(DATA['temperature'], u"\u00b0"))
+    print('connected_to_wifi : {!r:>36}'.format(DATA['connected_to_wifi']))
+    
+    
+    print('error_message_1 : {!r:>38}'.format(DATA['error_message_1']))
+    print('error_message_2 : {!r:>38}'.format(DATA['error_message_2']))
+    print('error_message_3 : {!r:>38}'.format(DATA['error_message_3']))
+    print('error_message_4 : {!r:>38}'.format(DATA['error_message_4']))
+    print('time : {!r:>64}'.format(DATA['time']))
+
+
+def printERROR_STATES(ERROR_STATES):
+    print("\n\033[4m" + "ERROR STATES DICTIONARY" + "\033[0m")
+    print('scc_over_voltage : {!r:>39}'.format(ERROR_STATES['scc_over_voltage']))
+    print('scc_under_voltage : {!r:>36}'.format(ERROR_STATES['scc_under_voltage']))
+    print('scc_over_current : {!r:>39}'.format(ERROR_STATES['scc_over_current']))
+    print('batt_charging_voltage_too_high : {!r:>8}'.format(ERROR_STATES['batt_charging_voltage_too_high']))
+
+
+def printCONFIG(CONFIG):
+    print("\n\033[4m" + "CONFIG DICTIONARY" + "\033[0m")
+    print('ID : {!r:>70}'.format(CONFIG['ID']))
+    # profile names and SSIDs only, passwords stay off the console
+    for profile in CONFIG['WIFI_CREDENTIALS']:
+        print('WIFI_CREDENTIALS : {!r:>30} {!r:>20}'.format(profile, CONFIG['WIFI_CREDENTIALS'][profile][0]))
+    print('MQTT_SERVER : {!r:>41}'.format(CONFIG['MQTT_SERVER']))
+    print('MQTT_GATEWAY : {!r:>40}'.format(CONFIG['MQTT_GATEWAY']))
+    print('MQTT_DATA_TOPIC : {!r:>49}'.format(CONFIG['MQTT_DATA_TOPIC']))
+    print('MQTT_CONTROL_TOPIC : {!r:>49}'.format(CONFIG['MQTT_CONTROL_TOPIC']))
+    print('MQTT_REQUEST_TOPIC : {!r:>49}'.format(CONFIG['MQTT_REQUEST_TOPIC']))
+    print('MQTT_REPLY_TOPIC : {!r:>51}'.format(CONFIG['MQTT_REPLY_TOPIC']))
+    print('CHARGER_PROFILE : {!r:>32}'.format(CONFIG['CHARGER_PROFILE']))
+    print('LOG_INTERVAL : {!r:>42}'.format(CONFIG['LOG_INTERVAL']))
+    print('TIMEZONE : {!r:>52}'.format(CONFIG['TIMEZONE']))
+    print('LOAD_RESET_INTERVAL : {!r:>25}'.format(CONFIG['LOAD_RESET_INTERVAL']))
+    print('12V_LOAD_ON : {!r:>43}'.format(CONFIG['12V_LOAD_ON']))
+    print('POE_LOAD_ON : {!r:>42}'.format(CONFIG['POE_LOAD_ON']))
+    print('MQTT_DIAGNOSTICS_TOPIC : {!r:>40}'.format(CONFIG['MQTT_DIAGNOSTICS_TOPIC']))
+    print('DIAGNOSTICS_INTERVAL : {!r:>34}\n'.format(CONFIG['DIAGNOSTICS_INTERVAL']))
@@ -0,0 +1,144 @@
+'''
+Runtime diagnostics for main.py: run time histograms of the firmware's callbacks, free heap, garbage
+collections, watchdog margin and publish latency, reported as one compact dictionary.
+Works on MicroPython and CPython. Recording allocates nothing, so it can run on the hot path.
+'''
+from array import array
+
+from libs.ticks import ticks_ms, ticks_us, ticks_diff
+
+BUCKETS = 16  # log2 buckets of microseconds: <2us, <4us, ... <32ms, and everything longer
+
+
+class Histogram:
+    '''Fixed size log2 histogram of run times (us), with count, total and worst case'''
+    def __init__(self, name, buckets=BUCKETS):
+        self.name = name
+        self.counts = array('I', [0] * buckets)
+        self.count = 0
+        self.total = 0
+        self.worst = 0
+
+    def record(self, us):
+        self.count += 1
+        self.total += us
+        if us > self.worst:
+            self.worst = us
+        # log2 by halving the range rather than one shift at a time, this runs on every timed call
+        last = len(self.counts) - 1
+        if us >= 1 << last:
+            self.counts[last] += 1
+            return
+        i = 0
+        if us >= 65536:
+            us >>= 16
+            i = 16
+        if us >= 256:
+            us >>= 8
+            i += 8
+        if us >= 16:
+            us >>= 4
+            i += 4
+        if us >= 4:
+            us >>= 2
+            i += 2
+        if us >= 2:
+            i += 1
+        self.counts[i] += 1
+
+    def summary(self):
+        '''[count, mean us, worst us, bucket counts...], trailing empty buckets left out'''
+        n = len(self.counts)
+        while n and not self.counts[n - 1]:
+            n -= 1
+        return [self.count, self.total // self.count if self.count else 0, self.worst] + list(self.counts[:n])
+
+    def __repr__(self):
+        return '{}: count={} mean={}us worst={}us'.format(
+            self.name, self.count, self.total // self.count if self.count else 0, self.worst)
+
+
+class Diagnostics:
+    '''
+    Registry of the histograms plus the heap, GC and watchdog figures.
+    timed() wraps a function so every call is recorded in the histogram of its name, attach() feeds a
+    histogram from the run times a libs.tasks.TaskStats already measures. Disabled, timed() returns the
+    function itself, attach() does nothing and the firmware runs exactly as without diagnostics.
+    MicroPython doesn't count its collections, so check_heap() counts the drops of the allocated heap
+    between two of its calls: collections closer together than that are counted once.
+    '''
+    def __init__(self, enabled=True, mem_free=None, mem_alloc=None, clock=ticks_ms):
+        self.enabled = enabled
+        self.histograms = {}                # name -> Histogram
+        self.mem_free = mem_free
+        self.mem_alloc = mem_alloc
+        self.clock = clock
+        self.started = clock()
+        self.free = 0                       # bytes, at the last check_heap()
+        self.min_free = None
+        self.allocated = 0
+        self.collections = 0
+        self.wdt_margin = None              # ms left before the watchdog would have fired, at the last feed
+        self.min_wdt_margin = None
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name)
+        return self.histograms[name]
+
+    def timed(self, name, fn):
+        if not self.enabled:
+            return fn
+        histogram = self.histogram(name)
+
+        def wrapper(*args):
+            start = ticks_us()
+            result = fn(*args)
+            histogram.record(ticks_diff(ticks_us(), start))
+            return result
+        return wrapper
+
+    def attach(self, name, stats):
+        '''Records the runs of a task in the histogram `name`, for tasks whose job is just the function timed'''
+        if self.enabled:
+            stats.histogram = self.histogram(name)
+
+    def check_heap(self):
+        if self.mem_free is None:
+            return
+        self.free = self.mem_free()
+        if self.min_free is None or self.free < self.min_free:
+            self.min_free = self.free
+        allocated = self.mem_alloc()
+        if allocated < self.allocated:
+            self.collections += 1
+        self.allocated = allocated
+
+    def fed(self, margin):
+        '''Records the watchdog margin (ms) seen at a feed'''
+        self.wdt_margin = margin
+        if self.min_wdt_margin is None or margin < self.min_wdt_margin:
+            self.min_wdt_margin = margin
+
+    def report(self, tasks=None, publisher=None):
+        '''
+        Everything since boot as a dictionary of short lists, see DIAGNOSTICS in main.py for the keys.
+        tasks is libs.tasks.TASK_STATS, publisher a libs.publisher.Publisher.
+        '''
+        out = {
+            'uptime': ticks_diff(self.clock(), self.started),
+            'timing': {},
+            'heap': [self.free, self.min_free, self.allocated, self.collections],
+            'wdt': [self.wdt_margin, self.min_wdt_margin],
+            }
+        for name in self.histograms:
+            out['timing'][name] = self.histograms[name].summary()
+        if tasks is not None:
+            out['tasks'] = {}
+            for name in tasks:
+                s = tasks[name]
+                out['tasks'][name] = [s.runs, s.worst_late, s.total_run // s.runs if s.runs else 0, s.worst_run]
+        if publisher is not None:
+            out['publish'] = [publisher.acked, publisher.last_latency, publisher.worst_latency,
+                              publisher.total_latency // publisher.acked if publisher.acked else 0, publisher.retransmits]
+        return out
@@ -0,0 +1,333 @@
+from json import dumps, loads
+from libs.ticks import ticks_ms, ticks_diff
+from libs.telemetry import FIELDS, MISSING
+
+MS_PER_HOUR = 3600000
+FOLD_MS = 1000      # ms of integer sums EnergyMeter.update_record() gathers before turning them into Ah, Wh and SoC
+
+
+class Counter:
+    '''
+    Ah and Wh of one channel, integrated with the trapezoidal rule over the sample timestamps.
+    Flow in each direction is kept separately (e.g. battery charge and discharge).
+    Intervals longer than `max_gap` ms (the sampler stalled or the board slept) are not integrated
+    rather than being bridged with a straight line; they are counted in `gaps`.
+    Samples come either as floats through add() or as integers through add_scaled(), not both.
+    '''
+    def __init__(self, max_gap=10000):
+        self.max_gap = max_gap
+        self.ah_in = 0.0
+        self.ah_out = 0.0
+        self.wh_in = 0.0
+        self.wh_out = 0.0
+        self.gaps = 0
+        self.last = None
+        self.last_current = 0.0
+        self.last_power = 0.0
+        # integer trapezoid sums (twice the charge and energy) of add_scaled(), see fold()
+        self.q_in = 0
+        self.q_out = 0
+        self.e_in = 0
+        self.e_out = 0
+        self.peak = 0               # largest current magnitude since the last fold()
+
+    def add(self, t, current, voltage):
+        '''Adds the sample at ticks t and returns the Ah since the previous one'''
+        power = current * voltage
+        ah = 0.0
+        if self.last is not None:
+            dt = ticks_diff(t, self.last)
+            if dt > self.max_gap or dt < 0:
+                self.gaps += 1
+            else:
+                h = dt / MS_PER_HOUR
+                ah = (current + self.last_current) * h / 2
+                wh = (power + self.last_power) * h / 2
+                if ah >= 0:
+                    self.ah_in += ah
+                else:
+                    self.ah_out -= ah
+                if wh >= 0:
+                    self.wh_in += wh
+                else:
+                    self.wh_out -= wh
+        self.last = t
+        self.last_current = current
+        self.last_power = power
+        return ah
+
+    def add_scaled(self, t, current, power):
+        '''
+        add() for integer current and power, e.g. in the units of a libs/record.py Record. Allocates
+        nothing on MicroPython while the sums stay small integers; fold() turns them into Ah and Wh.
+        '''
+        if self.last is not None:
+            dt = ticks_diff(t, self.last)
+            if dt > self.max_gap or dt < 0:
+                self.gaps += 1
+            else:
+                q = (current + self.last_current) * dt
+                e = (power + self.last_power) * dt
+                if q >= 0:
+                    self.q_in += q
+                else:
+                    self.q_out -= q
+                if e >= 0:
+                    self.e_in += e
+                else:
+                    self.e_out -= e
+        self.last = t
+        self.last_current = current
+        self.last_power = power
+        if current > self.peak:
+            self.peak = current
+        elif -current > self.peak:
+            self.peak = -current
+
+    def fold(self, ah_unit, wh_unit):
+        '''Adds the sums of add_scaled() to the counters, ah_unit and wh_unit Ah and Wh per unit of them. Returns the net Ah.'''
+        ah_in = self.q_in * ah_unit
+        ah_out = self.q_out * ah_unit
+        self.ah_in += ah_in
+        self.ah_out += ah_out
+        self.wh_in += self.e_in * wh_unit
+        self.wh_out += self.e_out * wh_unit
+        self.q_in = self.q_out = self.e_in = self.e_out = self.peak = 0
+        return ah_in - ah_out
+
+    def state(self):
+        return [self.ah_in, self.ah_out, self.wh_in, self.wh_out]
+
+    def restore(self, state):
+        self.ah_in, self.ah_out, self.wh_in, self.wh_out = state
+
+
+class StateOfCharge:
+    '''
+    Coulomb counting state of charge (%), re-anchored on the open circuit voltage.
+    `ocv` is a list of [voltage, soc] pairs in increasing voltage. Once the battery current has stayed
+    below `rest_current` A for `rest_time` ms the voltage is close enough to OCV to reset the estimate,
+    which removes the drift of the current integration. Charge is counted with `charge_efficiency`.
+    '''
+    def __init__(self, capacity_ah, ocv, rest_current=0.5, rest_time=1800000, charge_efficiency=1.0):
+        self.capacity_ah = capacity_ah
+        self.ocv = ocv
+        self.rest_current = rest_current
+        self.rest_time = rest_time
+        self.charge_efficiency = charge_efficiency
+        self.soc = None
+        self.rest_since = None
+        self.anchored = False       # already re-anchored during the current rest
+        self.anchors = 0
+
+    def from_voltage(self, voltage):
+        '''SoC by linear interpolation of the OCV table'''
+        ocv = self.ocv
+        if voltage <= ocv[0][0]:
+            return ocv[0][1]
+        for i in range(1, len(ocv)):
+            if voltage <= ocv[i][0]:
+                v0, s0 = ocv[i - 1]
+                v1, s1 = ocv[i]
+                return s0 + (s1 - s0) * (voltage - v0) / (v1 - v0)
+        return ocv[-1][1]
+
+    def update(self, t, ah, current, voltage):
+        '''ah is the charge (positive into the battery) since the previous update'''
+        if self.soc is None:
+            self.soc = self.from_voltage(voltage)
+        if ah > 0:
+            ah *= self.charge_efficiency
+        self.soc += ah * 100 / self.capacity_ah
+        if self.soc > 100:
+            self.soc = 100.0
+        elif self.soc < 0:
+            self.soc = 0.0
+        if abs(current) < self.rest_current:
+            if self.rest_since is None:
+                self.rest_since = t
+            elif not self.anchored and ticks_diff(t, self.rest_since) >= self.rest_time:
+                self.soc = self.from_voltage(voltage)
+                self.anchored = True
+                self.anchors += 1
+        else:
+            self.rest_since = None
+            self.anchored = False
+        return self.soc
+
+
+class EnergyMeter:
+    '''
+    Energy counters for the solar, load and battery channels plus the battery state of charge, fed
+    after every conversion. Battery current is positive while charging.
+    update() takes DATA or anything else indexed by its field names, in floats. update_record() takes the
+    integer values of a libs/record.py Record of `fields` and allocates nothing: it keeps integer sums
+    (power in 10 mW) and turns them into Ah, Wh and SoC every FOLD_MS, and before fields() and state().
+    The state of charge then rests only if the battery current stayed below rest_current all along.
+    '''
+    # channel -> (current field, voltage field) of DATA
+    CHANNELS = {
+        'solar'   : ('solar_current', 'solar_voltage'),
+        'load'    : ('scc_load_current', 'scc_load_voltage'),
+        'battery' : ('battery_current', 'battery_voltage'),
+        }
+
+    def __init__(self, soc, max_gap=10000, clock=ticks_ms, fields=FIELDS, fold_ms=FOLD_MS):
+        self.clock = clock
+        self.soc = soc
+        self.fold_ms = fold_ms
+        self.counters = {}
+        for name in self.CHANNELS:
+            self.counters[name] = Counter(max_gap)
+        # (counter, current index, voltage index, power divisor, Ah and Wh per unit of its sums) for update_record()
+        names = [f[0] for f in fields]
+        self.scaled = []
+        for name, (current, voltage) in self.CHANNELS.items():
+            i, v = names.index(current), names.index(voltage)
+            scale = fields[i][1] * fields[v][1]
+            divisor = scale // 100 if scale >= 100 else 1
+            self.scaled.append((self.counters[name], i, v, divisor,
+                                1 / (2 * fields[i][1] * MS_PER_HOUR), divisor / (2 * scale * MS_PER_HOUR)))
+        v = names.index('battery_voltage')
+        self.battery = (v, fields[names.index('battery_current')][1], fields[v][1])   # voltage index, scales
+        self.battery_voltage = MISSING  # at the last update_record()
+        self.folded = None              # ticks of the last fold()
+        self.pending = False            # update_record() ran since the last fold()
+
+    def update(self, data, t=None):
+        if t is None:
+            t = self.clock()
+        battery_ah = 0.0
+        for name, fields in self.CHANNELS.items():
+            current = data[fields[0]]
+            voltage = data[fields[1]]
+            if current is None or voltage is None:
+                continue
+            ah = self.counters[name].add(t, current, voltage)
+            if name == 'battery':
+                battery_ah = ah
+        if data['battery_current'] is not None and data['battery_voltage'] is not None:
+            self.soc.update(t, battery_ah, data['battery_current'], data['battery_voltage'])
+
+    def update_record(self, values, t=None):
+        if t is None:
+            t = self.clock()
+        for counter, i, v, divisor, ah_unit, wh_unit in self.scaled:
+            current = values[i]
+            voltage = values[v]
+            if current == MISSING or voltage == MISSING:
+                continue
+            counter.add_scaled(t, current, current * voltage // divisor)
+        self.battery_voltage = values[self.battery[0]]
+        self.pending = True
+        if self.folded is None:
+            self.folded = t
+        elif ticks_diff(t, self.folded) >= self.fold_ms:
+            self.folded = t
+            self.fold()
+
+    def fold(self):
+        '''Turns the integer sums of update_record() into Ah and Wh and moves the state of charge on'''
+        if not self.pending:
+            return
+        battery = self.counters['battery']
+        peak = battery.peak
+        battery_ah = 0.0
+        for counter, i, v, divisor, ah_unit, wh_unit in self.scaled:
+            ah = counter.fold(ah_unit, wh_unit)
+            if counter is battery:
+                battery_ah = ah
+        if battery.last is not None and self.battery_voltage != MISSING:
+            index, current_scale, voltage_scale = self.battery
+            self.soc.update(battery.last, battery_ah, peak / current_scale, self.battery_voltage / voltage_scale)
+        self.pending = False
+
+    def fields(self, data):
+        '''Writes the compact published fields (whole Wh, Ah to 0.1, SoC in whole %) into data'''
+        self.fold()
+        counters = self.counters
+        data['solar_wh'] = int(counters['solar'].wh_in)
+        data['load_wh'] = int(counters['load'].wh_in)
+        data['battery_ah'] = round(counters['battery'].ah_in - counters['battery'].ah_out, 1)
+        data['soc'] = None if self.soc.soc is None else int(self.soc.soc + 0.5)
+
+    def state(self):
+        self.fold()
+        state = {'soc': self.soc.soc}
+        for name, counter in self.counters.items():
+            state[name] = counter.state()
+        return state
+
+    def restore(self, state):
+        self.soc.soc = state['soc']
+        for name, counter in self.counters.items():
+            if name in state:
+                counter.restore(state[name])
+
+
+class Checkpoint:
+    '''
+    Throttled flash checkpoints of a JSON serialisable state.
+    A write happens at most every `interval` ms and only when `changed(old, new)` says the state moved
+    enough to matter, so flash sees a handful of writes a day. Writes alternate between two slots with
+    a sequence number, which spreads the wear and means a write torn by a reset leaves the previous
+    checkpoint intact; load() returns the newest slot that parses.
+    '''
+    def __init__(self, path, interval=600000, changed=None, clock=ticks_ms):
+        self.path = path
+        self.interval = interval
+        self.changed = changed
+        self.clock = clock
+        self.seq = 0
+        self.saved = None           # last state written
+        self.last_write = None
+        self.writes = 0
+
+    def _slot(self, seq):
+        return '{}.{}'.format(self.path, seq & 1)
+
+    def load(self):
+        best = None
+        for slot in (0, 1):
+            try:
+                with open(self._slot(slot), 'r') as f:
+                    record = loads(f.read())
+            except (OSError, ValueError):
+                continue
+            if best is None or record['seq'] > best['seq']:
+                best = record
+        if best is None:
+            return None
+        self.seq = best['seq']
+        self.saved = best['state']
+        return best['state']
+
+    def save(self, state, force=False):
+        '''Writes state if due. Returns True when it was written.'''
+        now = self.clock()
+        if not force:
+            if self.last_write is not None and ticks_diff(now, self.last_write) < self.interval:
+                return False
+            if self.saved is not None and self.changed is not None and not self.changed(self.saved, state):
+                return False
+        self.seq += 1
+        with open(self._slot(self.seq), 'w') as f:
+            f.write(dumps({'seq': self.seq, 'state': state}))
+        self.saved = state
+        self.last_write = now
+        self.writes += 1
+        return True
+
+
+def energy_changed(old, new, wh=1.0, soc=0.5):
+    '''Checkpoint rule for EnergyMeter.state(): any counter moved by `wh` Wh or the SoC by `soc` %'''
+    if (old['soc'] is None) != (new['soc'] is None):
+        return True
+    if new['soc'] is not None and abs(new['soc'] - old['soc']) >= soc:
+        return True
+    for name in new:
+        if name == 'soc' or name not in old:
+            continue
+        if abs(new[name][2] - old[name][2]) >= wh or abs(new[name][3] - old[name][3]) >= wh:
+            return True
+    return False
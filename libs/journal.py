@@ -0,0 +1,125 @@
+from binascii import crc32
+from struct import pack_into, unpack_from, calcsize
+import os
+
+MAGIC = 0x4A53
+# magic, payload length, sequence number, CRC32 of the first 8 header bytes and the payload
+HEADER = '<HHII'
+HEADER_SIZE = calcsize(HEADER)
+
+
+class Journal:
+    '''
+    Append-only journal of small records in fixed size slots, rotating over `files` files of `slots`
+    slots each. Every record carries a sequence number and a CRC32, so a slot torn by a reset is
+    detected and skipped. Files are only ever appended to; when the current one is full the next one
+    is started over, which spreads the writes over all files. The journal holds between
+    (files - 1) * slots and files * slots of the newest records.
+    Call recover() before the first append(), it finds where the journal left off.
+    '''
+    def __init__(self, path, slot_size=64, slots=64, files=4):
+        if slot_size <= HEADER_SIZE:
+            raise Exception('Slots must be larger than the {} byte header'.format(HEADER_SIZE))
+        self.path = path
+        self.slot_size = slot_size
+        self.slots = slots
+        self.files = files
+        self.seq = 0            # sequence number of the last record written
+        self.file = 0           # file being appended to
+        self.used = 0           # slots used in it
+        self.writes = 0
+        self.bytes_written = 0
+        self.buf = bytearray(slot_size)
+
+    def _file_path(self, i):
+        return '{}.{}'.format(self.path, i)
+
+    def _read_slot(self, f):
+        '''(seq, payload) of the next slot in f, None when it is missing, torn or corrupt'''
+        slot = f.read(self.slot_size)
+        if len(slot) < self.slot_size:
+            return None
+        magic, length, seq, crc = unpack_from(HEADER, slot)
+        if magic != MAGIC or length > self.slot_size - HEADER_SIZE:
+            return None
+        view = memoryview(slot)
+        if crc32(view[HEADER_SIZE:HEADER_SIZE + length], crc32(view[:8])) != crc:
+            return None
+        return seq, bytes(view[HEADER_SIZE:HEADER_SIZE + length])
+
+    def _scan(self, i, first_seq):
+        '''Valid records at the start of file i, in sequence from first_seq'''
+        records = []
+        try:
+            with open(self._file_path(i), 'rb') as f:
+                while len(records) < self.slots:
+                    record = self._read_slot(f)
+                    if record is None or record[0] != first_seq + len(records):
+                        break
+                    records.append(record)
+        except OSError:
+            pass
+        return records
+
+    def _firsts(self):
+        '''(seq, file) of the first record of every file that starts with a valid one, newest first'''
+        firsts = []
+        for i in range(self.files):
+            try:
+                with open(self._file_path(i), 'rb') as f:
+                    record = self._read_slot(f)
+            except OSError:
+                record = None
+            if record is not None:
+                firsts.append((record[0], i))
+        firsts.sort(reverse=True)
+        return firsts
+
+    def recover(self):
+        '''
+        Finds the newest valid record and carries on after it. Reads one slot per file and then only
+        the newest file. Returns (seq, payload), or None when the journal is empty.
+        '''
+        for first_seq, i in self._firsts():
+            records = self._scan(i, first_seq)
+            self.file = i
+            self.seq = records[-1][0]
+            try:
+                size = os.stat(self._file_path(i))[6]
+            except OSError:
+                size = 0
+            # never append behind a torn slot, the next record starts the following file instead
+            self.used = len(records) if size == len(records) * self.slot_size else self.slots
+            return records[-1]
+        return None
+
+    def records(self):
+        '''Every valid record, oldest first'''
+        records = []
+        for first_seq, i in self._firsts():
+            records = self._scan(i, first_seq) + records
+        return records
+
+    def append(self, payload):
+        '''Writes one record into the next slot'''
+        length = len(payload)
+        if length > self.slot_size - HEADER_SIZE:
+            raise Exception('Record must be at most {} bytes'.format(self.slot_size - HEADER_SIZE))
+        if self.used >= self.slots:
+            self.file = (self.file + 1) % self.files
+            self.used = 0
+        self.seq += 1
+        buf = self.buf
+        pack_into('<HHI', buf, 0, MAGIC, length, self.seq)
+        buf[HEADER_SIZE:HEADER_SIZE + length] = payload
+        for i in range(HEADER_SIZE + length, self.slot_size):
+            buf[i] = 0
+        view = memoryview(buf)
+        pack_into('<I', buf, 8, crc32(view[HEADER_SIZE:HEADER_SIZE + length], crc32(view[:8])))
+        # a full file is started over rather than rewritten slot by slot
+        with open(self._file_path(self.file), 'wb' if self.used == 0 else 'ab') as f:
+            f.write(buf)
+        self.used += 1
+        self.writes += 1
+        self.bytes_written += self.slot_size
+        return self.seq
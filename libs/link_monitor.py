@@ -0,0 +1,79 @@
+from libs.ticks import ticks_ms, ticks_diff, ticks_add
+
+
+class LinkMonitor:
+    '''
+    Cached internet link health.
+    The link is probed on its own schedule rather than on every loop iteration. Cheap signals are
+    used first: a disconnected WLAN is an immediate failure, and recent traffic on the MQTT socket
+    counts as success. Only when neither is conclusive is a single ICMP ping sent.
+    Failed probes are retried with exponential backoff.
+    '''
+    def __init__(self, wlan, ping, host='google.com', interval=30000, ttl=90000,
+                 min_backoff=2000, max_backoff=120000, ping_timeout=1000, clock=ticks_ms):
+        self.wlan = wlan
+        self.ping = ping
+        self.host = host
+        self.interval = interval          # ms between probes while the link is up
+        self.ttl = ttl                    # ms before a cached result is no longer trusted
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.ping_timeout = ping_timeout
+        self.clock = clock
+        self.mqtt = None                  # MQTT client whose traffic counts as a live link
+        self.connected = False
+        self.checked = None               # ticks of the last conclusive result
+        self.activity = None              # ticks of the last successful MQTT round trip
+        self.backoff = min_backoff
+        self.next_probe = clock()
+        self.probes = 0
+        self.pings = 0
+
+    def note_activity(self):
+        '''Record a successful MQTT round trip (publish acknowledged, message received)'''
+        self.activity = self.clock()
+
+    def is_connected(self):
+        '''Cached link state, False once the last result is older than the TTL'''
+        if self.checked is None or ticks_diff(self.clock(), self.checked) > self.ttl:
+            return False
+        return self.connected
+
+    def poll(self):
+        '''Cheap enough to call every loop iteration. Only probes when a probe is due.'''
+        now = self.clock()
+        # dropping off the access point is visible for free, don't wait for the schedule
+        if self.connected and not self.wlan.isconnected():
+            self._result(False, now)
+        elif ticks_diff(now, self.next_probe) >= 0:
+            self._result(self.probe(), self.clock())
+        return self.is_connected()
+
+    def check(self):
+        '''Probe immediately, ignoring the schedule'''
+        self._result(self.probe(), self.clock())
+        return self.connected
+
+    def probe(self):
+        self.probes += 1
+        if not self.wlan.isconnected():
+            return False
+        if self.activity is not None and self.mqtt is not None and self.mqtt.sock is not None:
+            if ticks_diff(self.clock(), self.activity) < self.interval:
+                return True
+        self.pings += 1
+        try:
+            sent, received = self.ping(self.host, count=1, timeout=self.ping_timeout, quiet=True, size=64)
+        except Exception:
+            return False
+        return received > 0
+
+    def _result(self, connected, now):
+        self.connected = connected
+        self.checked = now
+        if connected:
+            self.backoff = self.min_backoff
+            self.next_probe = ticks_add(now, self.interval)
+        else:
+            self.next_probe = ticks_add(now, self.backoff)
+            self.backoff = min(self.backoff * 2, self.max_backoff)
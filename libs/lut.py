@@ -0,0 +1,90 @@
+from array import array
+from struct import pack, unpack
+
+# 13 bit ADC codes
+CODES = 1 << 13
+LIMIT = 32767
+
+
+class ConversionTable:
+    '''
+    Lookup table replacing an expensive code -> value conversion (e.g. NTC_Temperature.get_temperature).
+    Holds convert() sampled every `step` codes, scaled by `scale` and rounded into an array('h'), and
+    interpolates linearly in between with integer arithmetic. step=1 is a full table (no interpolation).
+    step must be a power of two so the index is a shift.
+    Values that can't be computed (e.g. log of 0 at the rails) are saturated.
+    '''
+    def __init__(self, table, step, scale):
+        shift = 0
+        while (1 << shift) < step:
+            shift += 1
+        if (1 << shift) != step:
+            raise Exception('Table step must be a power of two')
+        if len(table) != CODES // step + 1:
+            raise Exception('Table must have {} entries'.format(CODES // step + 1))
+        self.table = table
+        self.step = step
+        self.shift = shift
+        self.mask = step - 1
+        self.scale = scale
+
+    @classmethod
+    def build(cls, channel, convert, step=16, scale=100):
+        '''
+        Samples convert() by driving the channel's filtered value over the code range, the same way
+        threshold_code() does. Only call this while the acquisition timer is stopped.
+        '''
+        saved = channel.value
+        table = array('h', [0] * (CODES // step + 1))
+        last = 0
+        for i in range(len(table)):
+            # the entry past the end stands for the top code so the last interval can be interpolated
+            channel.value = min(i * step, CODES - 1)
+            try:
+                v = int(round(convert() * scale))
+            except (ValueError, ZeroDivisionError, OverflowError):
+                v = last
+            if v > LIMIT:
+                v = LIMIT
+            elif v < -LIMIT:
+                v = -LIMIT
+            table[i] = v
+            last = v
+        channel.value = saved
+        return cls(table, step, scale)
+
+    def convert_scaled(self, code):
+        '''Integer value (times scale) for an ADC code'''
+        i = code >> self.shift
+        low = self.table[i]
+        frac = code & self.mask
+        if frac == 0:
+            return low
+        return low + (self.table[i + 1] - low) * frac // self.step
+
+    def convert(self, code):
+        return self.convert_scaled(code) / self.scale
+
+    def save(self, path, key):
+        '''Stores the table in flash. `key` identifies the conversion (e.g. its coefficients).'''
+        key = key.encode()
+        with open(path, 'wb') as f:
+            f.write(pack('<HHH', self.step, self.scale, len(key)))
+            f.write(key)
+            f.write(self.table)
+
+    @classmethod
+    def load(cls, path, key):
+        '''Table saved with the same key, or None when there is none (or it was built for other coefficients)'''
+        key = key.encode()
+        try:
+            with open(path, 'rb') as f:
+                step, scale, key_len = unpack('<HHH', f.read(6))
+                if f.read(key_len) != key:
+                    return None
+                table = array('h', f.read())
+            return cls(table, step, scale)
+        except Exception:
+            # missing, truncated or corrupt, the caller rebuilds it
+            return None
+
@@ -0,0 +1,95 @@
+from libs.ticks import ticks_us, ticks_diff
+
+# Fault bits, shared with anything that reports the protection state
+SCC_OVER_VOLTAGE = 1
+SCC_UNDER_VOLTAGE = 2
+SCC_OVER_CURRENT = 4
+BATT_OVER_VOLTAGE = 8
+
+
+def threshold_code(channel, convert, limit):
+    '''
+    Finds the lowest ADC code for which convert() reaches `limit`, by driving the channel's
+    filtered value through a binary search. convert() must increase with the code.
+    Only call this while the acquisition timer is stopped.
+    '''
+    saved = channel.value
+    lo = 0
+    hi = (1 << 13) - 1
+    while lo < hi:
+        channel.value = (lo + hi) // 2
+        if convert() >= limit:
+            hi = channel.value
+        else:
+            lo = channel.value + 1
+    channel.value = saved
+    return lo
+
+
+class Protection:
+    '''
+    High rate load protection, run from the acquisition timer after every sampling round.
+    Compares the latest raw codes of the load and battery channels against integer thresholds
+    worked out once at boot, so the check is a handful of integer compares with no allocation.
+    A fault has to be present for `trip_count` consecutive rounds before it trips; on the trip edge
+    `on_trip()` is called, which is expected to switch the loads off straight away.
+    '''
+    def __init__(self, load_current, load_voltage, battery_voltage, on_trip, trip_count=3):
+        self.load_current = load_current
+        self.load_voltage = load_voltage
+        self.battery_voltage = battery_voltage
+        self.on_trip = on_trip
+        self.trip_count = trip_count
+        # thresholds in ADC codes, set by set_limits()
+        self.load_v_max = 8191
+        self.load_v_min = 0
+        self.load_i_max = 8191
+        self.batt_v_max = 8191
+        self.count = 0
+        self.faults = 0         # faults seen in the latest round
+        self.tripped = 0        # faults latched at the last trip, cleared by rearm()
+        self.trips = 0
+        self.first_seen = 0     # ticks_us of the first faulty round before a trip
+        self.last_latency = 0   # us from first faulty round to on_trip() returning
+        self.worst_latency = 0
+
+    def set_limits(self, load_v_max, load_v_min, load_i_max, batt_v_max):
+        self.load_v_max = load_v_max
+        self.load_v_min = load_v_min
+        self.load_i_max = load_i_max
+        self.batt_v_max = batt_v_max
+
+    def check(self):
+        faults = 0
+        load_v = self.load_voltage.raw
+        if load_v > self.load_v_max:
+            faults |= SCC_OVER_VOLTAGE
+        elif load_v < self.load_v_min:
+            faults |= SCC_UNDER_VOLTAGE
+        if self.load_current.raw > self.load_i_max:
+            faults |= SCC_OVER_CURRENT
+        if self.battery_voltage.raw > self.batt_v_max:
+            faults |= BATT_OVER_VOLTAGE
+        self.faults = faults
+        if not faults:
+            self.count = 0
+            return
+        if self.count == 0:
+            self.first_seen = ticks_us()
+        self.count += 1
+        if self.count >= self.trip_count and not self.tripped:
+            self.on_trip()
+            self.tripped = faults
+            self.trips += 1
+            self.last_latency = ticks_diff(ticks_us(), self.first_seen)
+            if self.last_latency > self.worst_latency:
+                self.worst_latency = self.last_latency
+
+    def rearm(self):
+        '''Allows a fault that is still present to trip again, call when the loads are switched back on'''
+        self.tripped = 0
+        self.count = 0
+
+    def latency_bound(self, period_us):
+        '''Worst case trip latency (us) for a sampling round every period_us'''
+        return self.trip_count * period_us + self.worst_latency
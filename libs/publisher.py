@@ -0,0 +1,248 @@
+from struct import pack
+from libs.ticks import ticks_ms, ticks_diff
+
+
+class Publisher:
+    '''
+    Non-blocking QoS 1 publishing on one long lived libs.simple.MQTTClient session.
+    umqtt.simple's publish(qos=1) waits for the PUBACK of every message. Here PUBLISH packets are written
+    straight to the client's socket and up to `window` of them may be unacknowledged at once; further
+    messages wait in a bounded queue. PUBACKs, inbound PUBLISHes and PINGRESPs are read by poll(), which also
+    retransmits (DUP) anything unacknowledged after `retry_timeout` ms and sends PINGREQ when the session
+    has been idle for half the keepalive. The session is persistent: after a reconnect every
+    unacknowledged message is sent again.
+    All inbound packets must go through poll(); the client's own publish(qos=1), wait_msg() and check_msg()
+    would consume acknowledgements meant for the window.
+    '''
+    def __init__(self, client=None, window=8, queue=16, retry_timeout=5000, keepalive=60, clock=ticks_ms):
+        self.client = client
+        self.window = window                # max unacknowledged QoS 1 messages
+        self.queue_size = queue             # max messages waiting for a window slot
+        self.retry_timeout = retry_timeout  # ms before an unacknowledged message is sent again
+        self.keepalive = keepalive          # s, sent to the broker on connect
+        self.clock = clock
+        self.connected = False
+        self.inflight = {}                  # pid -> [packet, ticks last sent, ticks first sent, ticket]
+        self.queue = []                     # (topic, msg, ticket) waiting for a window slot
+        self.last_tx = None
+        self.ping_sent = None
+        self.ticket = 0                     # sequence number of the last accepted message
+        self.published = 0
+        self.acked = 0
+        self.retransmits = 0
+        self.refused = 0
+        self.pings = 0
+        self.last_latency = 0               # ms from first send to PUBACK
+        self.worst_latency = 0
+        self.total_latency = 0
+
+    def connect(self, clean_session=False):
+        '''(Re)connects the session and resends everything still unacknowledged'''
+        self.client.keepalive = self.keepalive
+        present = self.client.connect(clean_session)
+        self.connected = True
+        self.last_tx = self.clock()
+        self.ping_sent = None
+        for pid in self.inflight:
+            self._send(pid, True)
+        self._fill()
+        return present
+
+    def drop(self):
+        '''Marks the session as lost, the caller reconnects. Unacknowledged messages are kept.'''
+        if self.connected:
+            self.connected = False
+            try:
+                self.client.sock.close()
+            except (OSError, AttributeError):
+                pass
+
+    def publish(self, topic, msg, qos=1):
+        '''
+        Queues msg for sending without waiting for the broker. Returns a ticket for delivered(),
+        or 0 when the window and queue are full and the message was not accepted.
+        QoS 0 messages are written immediately.
+        '''
+        if qos == 0:
+            if self.connected:
+                try:
+                    self.client.publish(topic, msg)
+                    self.last_tx = self.clock()
+                except OSError:
+                    self.drop()
+            return 0
+        if len(self.queue) >= self.queue_size:
+            self.refused += 1
+            return 0
+        self.ticket += 1
+        # copy, callers reuse their buffers
+        self.queue.append((topic, bytes(msg), self.ticket))
+        self._fill()
+        return self.ticket
+
+    def subscribe(self, topic, qos=0):
+        '''
+        Sends SUBSCRIBE without waiting for the SUBACK, which poll() discards. client.subscribe() can't be
+        used once messages are in flight as it reads packets until its SUBACK arrives.
+        '''
+        if isinstance(topic, str):
+            topic = topic.encode()
+        pid = self._next_pid()
+        packet = bytearray(b'\x82')
+        packet.append(2 + 2 + len(topic) + 1)
+        packet += pack('!HH', pid, len(topic)) + topic + bytes((qos,))
+        self.client.sock.write(packet)
+        self.last_tx = self.clock()
+
+    def delivered(self, ticket):
+        '''True once the message with this ticket has been acknowledged'''
+        for entry in self.inflight.values():
+            if entry[3] == ticket:
+                return False
+        for entry in self.queue:
+            if entry[2] == ticket:
+                return False
+        return ticket <= self.ticket
+
+    def pending(self):
+        '''Messages accepted but not yet acknowledged'''
+        return len(self.inflight) + len(self.queue)
+
+    def available(self):
+        '''Messages that can be accepted right now without waiting in the queue'''
+        return self.window - self.pending()
+
+    def _next_pid(self):
+        client = self.client
+        while True:
+            client.pid = client.pid + 1 if client.pid < 0xFFFF else 1
+            if client.pid not in self.inflight:
+                return client.pid
+
+    def _fill(self):
+        if not self.connected:
+            return
+        while self.queue and len(self.inflight) < self.window:
+            topic, msg, ticket = self.queue.pop(0)
+            if isinstance(topic, str):
+                topic = topic.encode()
+            pid = self._next_pid()
+            size = 2 + len(topic) + 2 + len(msg)
+            header = bytearray(b'\x32')
+            while size > 0x7F:
+                header.append((size & 0x7F) | 0x80)
+                size >>= 7
+            header.append(size)
+            packet = header + pack('!H', len(topic)) + topic + pack('!H', pid) + msg
+            now = self.clock()
+            self.inflight[pid] = [packet, now, now, ticket]
+            self.published += 1
+            self._send(pid, False)
+            if not self.connected:
+                return
+
+    def _send(self, pid, dup):
+        entry = self.inflight[pid]
+        packet = entry[0]
+        if dup:
+            packet[0] |= 0x08
+            self.retransmits += 1
+        entry[1] = self.clock()
+        try:
+            self.client.sock.write(packet)
+            self.last_tx = entry[1]
+        except OSError:
+            self.drop()
+
+    def _receive(self, blocking=False):
+        '''Reads and handles one packet. Returns False when no data is waiting.'''
+        sock = self.client.sock
+        if not blocking:
+            sock.setblocking(False)
+        res = sock.read(1)
+        sock.setblocking(True)
+        if res is None:
+            return False
+        if res == b'':
+            raise OSError(-1)
+        self.ping_sent = None
+        op = res[0]
+        if op == 0x40:  # PUBACK
+            data = sock.read(3)
+            pid = data[1] << 8 | data[2]
+            entry = self.inflight.pop(pid, None)
+            if entry is not None:
+                self.acked += 1
+                self.last_latency = ticks_diff(self.clock(), entry[2])
+                self.total_latency += self.last_latency
+                if self.last_latency > self.worst_latency:
+                    self.worst_latency = self.last_latency
+            return True
+        size = self.client._recv_len()
+        if op & 0xF0 != 0x30:
+            # PINGRESP, SUBACK, ... carry nothing the session needs
+            if size:
+                sock.read(size)
+            return True
+        topic_len = sock.read(2)
+        topic_len = topic_len[0] << 8 | topic_len[1]
+        topic = sock.read(topic_len)
+        size -= topic_len + 2
+        pid = None
+        if op & 6:
+            pid = sock.read(2)
+            size -= 2
+        msg = sock.read(size) if size else b''
+        self.client.cb(topic, msg)
+        if op & 6 == 2:
+            sock.write(b'\x40\x02' + pid)
+        return True
+
+    def poll(self, max_packets=8):
+        '''
+        Handles up to max_packets inbound packets, then retransmits and pings as needed. Never waits
+        on the network. Returns the number of packets received; the session is dropped on a socket error.
+        '''
+        if not self.connected:
+            return 0
+        received = 0
+        try:
+            while received < max_packets and self._receive():
+                received += 1
+        except OSError:
+            self.drop()
+            return received
+        now = self.clock()
+        for pid in self.inflight:
+            if ticks_diff(now, self.inflight[pid][1]) >= self.retry_timeout:
+                self._send(pid, True)
+        self._fill()
+        if self.keepalive and self.connected:
+            half = self.keepalive * 500
+            if self.ping_sent is not None:
+                # no answer to the last PINGREQ, the broker will consider the session gone as well
+                if ticks_diff(now, self.ping_sent) > half:
+                    self.drop()
+            elif ticks_diff(now, self.last_tx) >= half:
+                try:
+                    self.client.ping()
+                    self.pings += 1
+                    self.ping_sent = self.last_tx = now
+                except OSError:
+                    self.drop()
+        return received
+
+    def flush(self, timeout=5000):
+        '''Waits up to timeout ms for every accepted message to be acknowledged, e.g. before a reset'''
+        start = self.clock()
+        while self.connected and self.pending():
+            left = timeout - ticks_diff(self.clock(), start)
+            if left <= 0:
+                break
+            try:
+                self.client.sock.settimeout(left / 1000)
+                self._receive(True)
+            except OSError:
+                break
+            self.poll(0)
+        return not self.pending()
@@ -0,0 +1,32 @@
+'''
+Preallocated record of the latest readings, for the sampling hot path.
+Readings are held as integers in the telemetry scaling (libs/telemetry.py FIELDS) in an array('h'),
+so converting, checking and packing them allocates nothing: small integers are not heap objects on
+MicroPython, floats are. Floats are only made when a reading is looked up by name or exported.
+'''
+from array import array
+
+from libs.telemetry import FIELDS, MISSING
+
+
+class Record:
+    def __init__(self, fields=FIELDS):
+        self.fields = fields
+        self.index = {}
+        for i in range(len(fields)):
+            self.index[fields[i][0]] = i
+        self.values = array('h', [MISSING] * len(fields))
+
+    def __getitem__(self, name):
+        '''Reading in engineering units, None while it is missing'''
+        i = self.index[name]
+        v = self.values[i]
+        if v == MISSING:
+            return None
+        return v / self.fields[i][1]
+
+    def export(self, data):
+        '''Copies every reading into data (e.g. DATA) in engineering units'''
+        for i in range(len(self.fields)):
+            v = self.values[i]
+            data[self.fields[i][0]] = None if v == MISSING else v / self.fields[i][1]
@@ -0,0 +1,130 @@
+import os
+
+
+class Spool:
+    '''
+    Bounded, append-only store-and-forward log of fixed size records.
+    Records are appended to numbered segment files in `path`. When the spool holds `max_segments`
+    segments the oldest one is deleted (oldest-first eviction), so a write never rewrites existing data.
+    A small cursor file remembers how far the oldest segment has been drained.
+    Eviction works on whole segments, so the capacity is between max_segments - 1 and max_segments
+    segments of undrained records.
+    '''
+    def __init__(self, path, record_size, segment_records=256, max_segments=8):
+        self.path = path
+        self.record_size = record_size
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        self.dropped = 0
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass
+        self.segments = self._scan()
+        self.read_offset = self._load_cursor()
+
+    def _segment_path(self, seq):
+        return '{}/{:08d}.bin'.format(self.path, seq)
+
+    def _scan(self):
+        segments = []
+        for name in os.listdir(self.path):
+            if name.endswith('.bin'):
+                segments.append(int(name[:-4]))
+        segments.sort()
+        return segments
+
+    def _records_in(self, seq):
+        try:
+            return os.stat(self._segment_path(seq))[6] // self.record_size
+        except OSError:
+            return 0
+
+    def _load_cursor(self):
+        try:
+            with open(self.path + '/cursor', 'r') as f:
+                seq, offset = f.read().split()
+            seq = int(seq)
+            offset = int(offset)
+        except (OSError, ValueError):
+            return 0
+        # the segment the cursor points into may have been evicted since
+        if self.segments and seq == self.segments[0]:
+            return offset
+        return 0
+
+    def _save_cursor(self):
+        with open(self.path + '/cursor', 'w') as f:
+            f.write('{} {}'.format(self.segments[0] if self.segments else 0, self.read_offset))
+
+    def append(self, record):
+        '''Appends one record, evicting the oldest segment when the spool is full'''
+        if len(record) != self.record_size:
+            raise Exception('Record must be {} bytes'.format(self.record_size))
+        if not self.segments or self._records_in(self.segments[-1]) >= self.segment_records:
+            next_seq = self.segments[-1] + 1 if self.segments else 0
+            if len(self.segments) >= self.max_segments:
+                self.dropped += self._records_in(self.segments[0]) - self.read_offset
+                os.remove(self._segment_path(self.segments.pop(0)))
+                self.read_offset = 0
+                self._save_cursor()
+            self.segments.append(next_seq)
+        with open(self._segment_path(self.segments[-1]), 'ab') as f:
+            f.write(record)
+
+    def pending(self):
+        '''Number of records not yet drained'''
+        total = 0
+        for seq in self.segments:
+            total += self._records_in(seq)
+        return total - self.read_offset
+
+    def read_batch(self, n):
+        '''Returns up to n of the oldest undrained records without consuming them'''
+        records = []
+        offset = self.read_offset
+        for seq in self.segments:
+            if len(records) >= n:
+                break
+            available = self._records_in(seq) - offset
+            if available > 0:
+                count = min(available, n - len(records))
+                with open(self._segment_path(seq), 'rb') as f:
+                    f.seek(offset * self.record_size)
+                    data = f.read(count * self.record_size)
+                for i in range(count):
+                    records.append(data[i * self.record_size:(i + 1) * self.record_size])
+            offset = 0
+        return records
+
+    def head(self):
+        '''(segment, offset) of the oldest undrained record, for commit()'''
+        return (self.segments[0] if self.segments else 0, self.read_offset)
+
+    def commit(self, n, head=None):
+        '''
+        Marks the n oldest records as drained, deleting segments that are fully drained.
+        head is head() from when the batch was read: records of the batch in segments that were evicted
+        since are gone already and aren't counted again against the records that replaced them.
+        '''
+        if head is not None and self.segments:
+            seq, offset = head
+            # evicted segments were full, all but the newest segment are
+            while seq < self.segments[0] and n > 0:
+                n -= min(n, self.segment_records - offset)
+                seq += 1
+                offset = 0
+            if seq != self.segments[0] or offset != self.read_offset:
+                # what the batch was read from isn't the head anymore, nothing of it is left to commit
+                n = 0
+        self.read_offset += n
+        while self.segments:
+            size = self._records_in(self.segments[0])
+            # keep the segment that is still being appended to
+            if self.read_offset < size or len(self.segments) == 1 and size < self.segment_records:
+                break
+            self.read_offset -= size
+            os.remove(self._segment_path(self.segments.pop(0)))
+        if not self.segments:
+            self.read_offset = 0
+        self._save_cursor()
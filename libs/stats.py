@@ -0,0 +1,97 @@
+from array import array
+from math import sqrt
+
+
+class WindowStats:
+    '''
+    Streaming statistics of a set of channels over a window: min, max, mean, RMS and sample count.
+    add() is O(1) per channel. Min and max are kept as integers, the mean and the sum of squared
+    deviations with Welford's update in preallocated float arrays. The update runs on the offset from
+    each window's first sample and both sums are Kahan compensated, so they keep their digits in the
+    device's single precision floats over long windows (a running sum of squares would not).
+    reset() starts a new window. Samples equal to `missing` are skipped.
+    '''
+    def __init__(self, channels, missing=None):
+        self.channels = channels
+        self.missing = missing
+        self.count = array('i', [0] * channels)
+        self.low = array('i', [0] * channels)
+        self.high = array('i', [0] * channels)
+        self.first = array('i', [0] * channels)
+        self.offset = array('f', [0] * channels)  # mean - first
+        self.m2 = array('f', [0] * channels)
+        # Kahan compensations of offset and m2
+        self.offset_c = array('f', [0] * channels)
+        self.m2_c = array('f', [0] * channels)
+
+    def reset(self):
+        for i in range(self.channels):
+            self.count[i] = 0
+
+    def add(self, values):
+        '''Adds one sample of every channel, values[i] being an integer (e.g. a libs/record.py Record's values)'''
+        for i in range(self.channels):
+            x = values[i]
+            if x == self.missing:
+                continue
+            n = self.count[i] + 1
+            self.count[i] = n
+            if n == 1:
+                self.low[i] = x
+                self.high[i] = x
+                self.first[i] = x
+                self.offset[i] = 0
+                self.m2[i] = 0
+                self.offset_c[i] = 0
+                self.m2_c[i] = 0
+                continue
+            if x < self.low[i]:
+                self.low[i] = x
+            elif x > self.high[i]:
+                self.high[i] = x
+            x -= self.first[i]
+            offset = self.offset[i]
+            delta = x - offset
+            # offset += delta / n, then m2 += delta * (x - new offset). The sums are read back from
+            # the arrays so the compensation sees the value as stored.
+            y = delta / n - self.offset_c[i]
+            self.offset[i] = offset + y
+            self.offset_c[i] = (self.offset[i] - offset) - y
+            offset = self.offset[i] - self.offset_c[i]
+            m2 = self.m2[i]
+            y = delta * (x - offset) - self.m2_c[i]
+            self.m2[i] = m2 + y
+            self.m2_c[i] = (self.m2[i] - m2) - y
+
+    def extend(self, i, low, high):
+        '''Widens channel i's min and max with extremes seen between samples'''
+        if self.count[i]:
+            if low < self.low[i]:
+                self.low[i] = low
+            if high > self.high[i]:
+                self.high[i] = high
+
+    def mean(self, i):
+        if not self.count[i]:
+            return None
+        return self.first[i] + self.offset[i] - self.offset_c[i]
+
+    def rms(self, i):
+        n = self.count[i]
+        if not n:
+            return None
+        # mean square = mean^2 + population variance
+        mean = self.mean(i)
+        return sqrt(mean * mean + (self.m2[i] - self.m2_c[i]) / n)
+
+    def summary(self, i, scale=1, digits=None):
+        '''[min, max, mean, rms, count] of channel i divided by scale, None when the window is empty'''
+        n = self.count[i]
+        if not n:
+            return None
+        mean = self.mean(i) / scale
+        rms = self.rms(i) / scale
+        if digits is not None:
+            mean = round(mean, digits)
+            rms = round(rms, digits)
+        return [self.low[i] / scale, self.high[i] / scale, mean, rms, n]
@@ -0,0 +1,105 @@
+'''
+Helpers for the cooperative (uasyncio) runtime in main.py.
+Works with uasyncio on the device and with asyncio under CPython.
+'''
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from libs.ticks import ticks_ms, ticks_us, ticks_diff, ticks_add
+
+if hasattr(asyncio, 'sleep_ms'):
+    sleep_ms = asyncio.sleep_ms
+else:
+    def sleep_ms(ms):
+        return asyncio.sleep(ms / 1000)
+
+
+class TaskStats:
+    '''Run count, last and worst-case start lateness (ms) and run time (us) of a task'''
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.last_late = 0
+        self.worst_late = 0
+        self.last_run = 0
+        self.worst_run = 0
+        self.total_run = 0
+        self.histogram = None   # libs.diagnostics.Histogram fed with every run time, see Diagnostics.attach()
+
+    def record(self, late):
+        self.runs += 1
+        self.last_late = late
+        if late > self.worst_late:
+            self.worst_late = late
+
+    def record_run(self, us):
+        '''Time from the start of a run to its end, including any awaits inside the job'''
+        self.last_run = us
+        self.total_run += us
+        if us > self.worst_run:
+            self.worst_run = us
+        if self.histogram is not None:
+            self.histogram.record(us)
+
+    def __repr__(self):
+        return '{}: runs={} last_late={}ms worst_late={}ms mean_run={}us worst_run={}us'.format(
+            self.name, self.runs, self.last_late, self.worst_late,
+            self.total_run // self.runs if self.runs else 0, self.worst_run)
+
+
+# Task name -> TaskStats, filled in as tasks are created
+TASK_STATS = {}
+
+
+def task_stats(name):
+    if name not in TASK_STATS:
+        TASK_STATS[name] = TaskStats(name)
+    return TASK_STATS[name]
+
+
+async def periodic(name, period, job, first=None):
+    '''
+    Runs job() every `period` ms on a fixed cadence and records how late each run started.
+    The first run is `first` ms after the start, one period by default.
+    job may be a plain function or a coroutine function. Missed periods are skipped rather than run back to back.
+    '''
+    stats = task_stats(name)
+    deadline = ticks_add(ticks_ms(), period if first is None else first)
+    while 1:
+        wait = ticks_diff(deadline, ticks_ms())
+        await sleep_ms(wait if wait > 0 else 0)
+        now = ticks_ms()
+        stats.record(ticks_diff(now, deadline))
+        start = ticks_us()
+        result = job()
+        if result is not None and hasattr(result, 'send'):
+            await result
+        stats.record_run(ticks_diff(ticks_us(), start))
+        deadline = ticks_add(deadline, period)
+        if ticks_diff(ticks_ms(), deadline) > 0:
+            deadline = ticks_add(ticks_ms(), period)
+
+
+async def on_event(name, event, job):
+    '''Runs job() each time the StampedEvent `event` is set and records the delay from set() to the run (ms)'''
+    stats = task_stats(name)
+    while 1:
+        await event.wait()
+        event.clear()
+        stats.record(ticks_diff(ticks_ms(), event.stamp))
+        start = ticks_us()
+        job()
+        stats.record_run(ticks_diff(ticks_us(), start))
+
+
+class StampedEvent(asyncio.Event):
+    '''Event that remembers when it was last set so consumers can measure their delay'''
+    def __init__(self):
+        super().__init__()
+        self.stamp = ticks_ms()
+
+    def set(self):
+        self.stamp = ticks_ms()
+        super().set()
@@ -0,0 +1,162 @@
+'''
+Compact binary telemetry record, an alternative to publishing dumps(DATA).
+Version 1 layout (little endian, 21 bytes):
+    B  version
+    I  unix time (s)
+    7h readings scaled to integers, see FIELDS
+    B  flag bits, see FLAGS
+    B  error codes as bits, see ERRORS
+The device id is carried in the topic instead of the payload and error messages are sent as codes only.
+A site gateway (tools/gateway.py) forwards the records of several devices in one site batch:
+    B  device id length, then the id (utf-8)
+    H  number of records, then the records
+repeated for every device.
+Used on the device and by the host-side decoder.
+'''
+from struct import pack, pack_into, unpack_from, calcsize
+from time import localtime
+
+VERSION = 1
+FORMAT = '<BI7hBB'
+SIZE = calcsize(FORMAT)
+
+# DATA field, scale applied before rounding to a 16 bit integer
+FIELDS = (
+    ('scc_load_voltage', 100),
+    ('scc_load_current', 1000),
+    ('battery_voltage', 100),
+    ('battery_current', 1000),
+    ('solar_voltage', 100),
+    ('solar_current', 1000),
+    ('temperature', 100),
+    )
+FLAGS = ('connected_to_wifi', 'battery_connected', 'panel_connected')
+# ERROR_STATES keys, in the same order as error_message_1 to error_message_4
+ERRORS = ('scc_over_voltage', 'scc_under_voltage', 'scc_over_current', 'batt_charging_voltage_too_high')
+
+# stands for a missing (None) reading
+MISSING = -32768
+
+# MicroPython ports count from 2000, unix from 1970
+EPOCH_OFFSET = 946684800 if localtime(0)[0] == 2000 else 0
+
+
+def _scaled(value, scale):
+    if value is None:
+        return MISSING
+    v = int(round(value * scale))
+    if v > 32767:
+        return 32767
+    if v < -32767:
+        return -32767
+    return v
+
+
+def flag_bits(data):
+    flags = 0
+    for i in range(len(FLAGS)):
+        if data[FLAGS[i]]:
+            flags |= 1 << i
+    return flags
+
+
+def error_bits(error_states):
+    errors = 0
+    for i in range(len(ERRORS)):
+        if error_states[ERRORS[i]]:
+            errors |= 1 << i
+    return errors
+
+
+def encode(data, error_states, t, buf=None, offset=0):
+    '''
+    Packs DATA and ERROR_STATES with unix time t. Writes into `buf` when given (no allocation
+    for the record itself) and returns it, otherwise returns a new bytearray.
+    '''
+    if buf is None:
+        buf = bytearray(SIZE)
+    pack_into(FORMAT, buf, offset, VERSION, t,
+              _scaled(data['scc_load_voltage'], 100),
+              _scaled(data['scc_load_current'], 1000),
+              _scaled(data['battery_voltage'], 100),
+              _scaled(data['battery_current'], 1000),
+              _scaled(data['solar_voltage'], 100),
+              _scaled(data['solar_current'], 1000),
+              _scaled(data['temperature'], 100),
+              flag_bits(data), error_bits(error_states))
+    return buf
+
+
+def encode_values(values, flags, errors, t, buf=None, offset=0):
+    '''Same as encode() for readings that are already scaled, in FIELDS order (e.g. a libs/record.py Record)'''
+    if buf is None:
+        buf = bytearray(SIZE)
+    pack_into(FORMAT, buf, offset, VERSION, t,
+              values[0], values[1], values[2], values[3], values[4], values[5], values[6],
+              flags, errors)
+    return buf
+
+
+def record_time(record, offset=0):
+    return unpack_from('<I', record, offset + 1)[0]
+
+
+def set_record_time(record, t, offset=0):
+    '''Rewrites the time of a record in a bytearray'''
+    pack_into('<I', record, offset + 1, t)
+
+
+def decode(payload, offset=0):
+    '''Unpacks one record into a dictionary with DATA's field names, 'time' (unix) and 'errors' (bits)'''
+    values = unpack_from(FORMAT, payload, offset)
+    if values[0] != VERSION:
+        raise ValueError('Unsupported telemetry version {}'.format(values[0]))
+    record = {'time': values[1]}
+    for i in range(len(FIELDS)):
+        name, scale = FIELDS[i]
+        record[name] = None if values[i + 2] == MISSING else values[i + 2] / scale
+    for i in range(len(FLAGS)):
+        record[FLAGS[i]] = bool(values[9] & (1 << i))
+    record['errors'] = values[10]
+    return record
+
+
+def decode_batch(payload):
+    '''Unpacks a payload made of back to back records'''
+    if len(payload) % SIZE:
+        raise ValueError('Payload is not a whole number of {} byte records'.format(SIZE))
+    return [decode(payload, offset) for offset in range(0, len(payload), SIZE)]
+
+
+def encode_site_batch(devices):
+    '''Packs {device id: payload of back to back records} into one site batch'''
+    out = []
+    for device_id, records in devices.items():
+        name = device_id.encode() if isinstance(device_id, str) else device_id
+        if len(records) % SIZE:
+            raise ValueError('Records of {} are not a whole number of {} byte records'.format(device_id, SIZE))
+        out.append(pack('<B', len(name)) + name + pack('<H', len(records) // SIZE))
+        out.append(bytes(records))
+    return b''.join(out)
+
+
+def decode_site_batch(payload):
+    '''Splits a site batch into a list of (device id, payload of back to back records)'''
+    devices = []
+    at = 0
+    while at < len(payload):
+        n = payload[at]
+        device_id = bytes(payload[at + 1:at + 1 + n]).decode()
+        at += 1 + n
+        count = unpack_from('<H', payload, at)[0]
+        at += 2
+        end = at + count * SIZE
+        if end > len(payload):
+            raise ValueError('Site batch is truncated')
+        devices.append((device_id, payload[at:end]))
+        at = end
+    return devices
+
+
+def error_names(errors):
+    return [ERRORS[i] for i in range(len(ERRORS)) if errors & (1 << i)]
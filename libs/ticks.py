@@ -0,0 +1,21 @@
+'''
+Millisecond tick helpers.
+Uses the MicroPython time.ticks_* functions when available and falls back to time.monotonic()
+under CPython so that the libs can be exercised on a host machine.
+'''
+try:
+    from time import ticks_ms, ticks_us, ticks_diff, ticks_add
+except ImportError:
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_us():
+        return int(monotonic() * 1000000)
+
+    def ticks_diff(new, old):
+        return new - old
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
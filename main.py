@@ -5,17 +5,34 @@ from machine import reset
 from machine import WDT
 from network import WLAN
 from network import STA_IF
-from math import log
-from time import sleep
+from time import sleep, localtime, time
 from json import dumps, loads, dump, load
+from struct import pack_into
+from binascii import hexlify, unhexlify
 
 #import libs
 from libs.power_monitoring import CurrentRead, VoltageRead
 from libs.temperature import NTC_Temperature
 from libs.simple import MQTTClient
 from libs.uping import ping
-import ntptime
-from gc import enable, collect
+from libs.acquisition import Acquisition, BOXCAR, MEDIAN
+from libs.link_monitor import LinkMonitor
+from libs.protection import Protection, threshold_code
+from libs.tasks import asyncio, sleep_ms, periodic, on_event, StampedEvent, TASK_STATS, task_stats
+from libs.spool import Spool
+from libs import telemetry
+from libs.deadband import ReportByException
+from libs.publisher import Publisher
+from libs.commands import Dispatcher
+from libs.lut import ConversionTable, LIMIT
+from libs.calibration import profile, calibrated, check
+from libs.energy import EnergyMeter, StateOfCharge, Checkpoint, energy_changed
+from libs.record import Record
+from libs.journal import Journal
+from libs.stats import WindowStats
+from libs.diagnostics import Diagnostics
+from libs.ticks import ticks_ms, ticks_diff, ticks_add
+from gc import enable, collect, threshold, mem_free, mem_alloc
 from libs.config_proc import *
 
 #gc enable
@@ -23,7 +40,8 @@ enable()
 collect()
 
 # remember to enable timers
-wdt = WDT(timeout=hppc_config['LOG_INTERVAL'] + 30000)  # set timeout to 2 seconds 
+WDT_TIMEOUT = hppc_config['LOG_INTERVAL'] + 30000
+wdt = WDT(timeout=WDT_TIMEOUT)  # set timeout to 2 seconds 
 
 ###### PIN ASSIGNMENTS ######
 # Debug LED
@@ -65,8 +83,25 @@ temperature_pin.atten(ADC.ATTN_11DB)
 temperature_pin.width(ADC.WIDTH_13BIT)
 
 # create hw timers
-timer_one = Timer(0)
-timer_two = Timer(1)
+timer_one = Timer(0) # ADC acquisition
+
+# Oversampled acquisition: all channels are sampled round-robin every ACQUISITION_PERIOD ms
+# and decimated per channel. The measurement classes read the filtered channels.
+ACQUISITION_PERIOD = 1 # ms
+acquisition = Acquisition(timer_one, period = ACQUISITION_PERIOD)
+battery_current_ch = acquisition.add(battery_current_pin, oversample = 32, mode = BOXCAR)
+battery_voltage_ch = acquisition.add(battery_voltage_pin, oversample = 16, mode = BOXCAR)
+panel_current_ch = acquisition.add(panel_current_pin, oversample = 32, mode = BOXCAR)
+panel_voltage_ch = acquisition.add(panel_voltage_pin, oversample = 16, mode = BOXCAR)
+load_current_ch = acquisition.add(load_current_pin, oversample = 32, mode = BOXCAR)
+load_voltage_ch = acquisition.add(load_voltage_pin, oversample = 16, mode = BOXCAR)
+temperature_ch = acquisition.add(temperature_pin, oversample = 16, mode = MEDIAN)
+
+# Link health is probed on its own schedule and cached, see libs/link_monitor.py
+link = LinkMonitor(WLAN(STA_IF), ping, host = 'google.com', interval = 30000, ttl = 90000)
+
+# One long lived MQTT session with pipelined QoS 1 publishing, see libs/publisher.py
+publisher = Publisher(window = 8, queue = 16, retry_timeout = 5000)
 
 # this is the dictionary used to store the state of the HomePoynt Power Controller as well as its peripherals
 DATA = {
@@ -79,6 +114,10 @@ DATA = {
     'solar_voltage'      : 1, # solar_voltage
     'solar_current'      : 1, # solar_current
     'temperature'        : 1,
+    'solar_wh'           : 0,    # energy harvested since the counters were first started
+    'load_wh'            : 0,    # energy used by the SCC load
+    'battery_ah'         : 0,    # net charge into the battery
+    'soc'                : None, # battery state of charge, %
     'connected_to_wifi'  : False,
     'battery_connected'  : False,
     'panel_connected'    : False,
@@ -86,9 +125,38 @@ DATA = {
     'error_message_2'    : None,
     'error_message_3'    : None,
     'error_message_4'    : None,
+    'stats'              : None, # {reading: [min, max, mean, rms, samples]} over the last publish window
     'time'               : None
     }
 
+# HOT PATH READINGS
+# The sampler converts into this preallocated record of integers in the telemetry scaling (centivolts,
+# milliamps, centidegrees) rather than into DATA, so a conversion cycle allocates no floats. DATA is
+# refreshed from it when it is published (see update_data()).
+readings = Record()
+LOAD_V = readings.index['scc_load_voltage']
+LOAD_I = readings.index['scc_load_current']
+BATTERY_V = readings.index['battery_voltage']
+BATTERY_I = readings.index['battery_current']
+SOLAR_V = readings.index['solar_voltage']
+SOLAR_I = readings.index['solar_current']
+TEMPERATURE = readings.index['temperature']
+READING_LUT_STEP = 64 # ADC codes between conversion table entries of the voltage and current channels
+
+# Min, max, mean and RMS of every reading over each publish window (libs/stats.py), fed after every conversion.
+# Min and max also take in the extremes of the filtered codes between conversions (window_extremes, set up by
+# setup()), so short load spikes and inrush currents show up in the published window.
+stats = WindowStats(len(telemetry.FIELDS), missing = telemetry.MISSING)
+window_extremes = ()
+STATS_DIGITS = 4
+
+# Safety limits in the same scaling, compared by safety_check()
+SCC_MAX_V = int(round(hppc_config['SCC_MAX_VOLTAGE'] * 100))
+SCC_MIN_V = int(round(hppc_config['SCC_MIN_VOLTAGE'] * 100))
+SCC_MAX_I = int(round(hppc_config['SCC_MAX_CURRENT'] * 1000))
+BATT_MAX_V = int(round(hppc_config['BATT_MAX_VOLTAGE'] * 100))
+BATTERY_PRESENT_V = 2000 # a 24V battery reads above 20V
+
 # This should be sent to cloud dashboard for remote control
 CONFIG = {
     'ID'                    : hppc_config['ID'], 
@@ -96,31 +164,99 @@ CONFIG = {
     'MQTT_UN'               : hppc_config['MQTT']['CREDENTIALS'][0],
     'MQTT_PW'               : hppc_config['MQTT']['CREDENTIALS'][1],
     'MQTT_SERVER'           : hppc_config['MQTT']['MQTT_SERVER'][0],
+    # site gateway on the LAN (tools/gateway.py): the session, link probe and NTP go there instead, None for direct
+    'MQTT_GATEWAY'          : hppc_config['MQTT'].get('MQTT_GATEWAY', [None])[0],
     'MQTT_DATA_TOPIC'       : hppc_config['MQTT']['MQTT_DATA_TOPIC'][0],
     'MQTT_CONTROL_TOPIC'    : hppc_config['MQTT']['MQTT_CONTROL_TOPIC'][0],
+    # commands addressed to this device only, and where its replies go (see CONTROL COMMANDS)
+    'MQTT_REQUEST_TOPIC'    : hppc_config['MQTT'].get('MQTT_REQUEST_TOPIC', ['{}/{}/request'.format(hppc_config['MQTT']['MQTT_CONTROL_TOPIC'][0], hppc_config['ID'])])[0],
+    'MQTT_REPLY_TOPIC'      : hppc_config['MQTT'].get('MQTT_REPLY_TOPIC', ['{}/{}/reply'.format(hppc_config['MQTT']['MQTT_CONTROL_TOPIC'][0], hppc_config['ID'])])[0],
+    # periodic diagnostics reports (see DIAGNOSTICS)
+    'MQTT_DIAGNOSTICS_TOPIC': hppc_config['MQTT'].get('MQTT_DIAGNOSTICS_TOPIC', ['{}/{}/diagnostics'.format(hppc_config['MQTT']['MQTT_CONTROL_TOPIC'][0], hppc_config['ID'])])[0],
+    'CONTROL_KEY'           : hppc_config.get('CONTROL_KEY'), # libs/auth.py device key, None accepts unsigned commands
     'CHARGER_PROFILE'       : hppc_config['CHARGER_PROFILE'],
     'LOG_INTERVAL'          : hppc_config['LOG_INTERVAL'],
     'LOAD_RESET_INTERVAL'   : hppc_config['LOAD_RESET_INTERVAL'],
     '12V_LOAD_ON'           : hppc_config['12V_LOAD_ON'], 
     'POE_LOAD_ON'           : hppc_config['POE_LOAD_ON'], 
     'TIMEZONE'              : hppc_config['TIMEZONE'], # not used at yet
-    'CONFIG_FILE'           : hppc_config['CONFIG_FILE']
+    'CONFIG_FILE'           : hppc_config['CONFIG_FILE'],
+    'PAYLOAD_FORMAT'        : hppc_config.get('PAYLOAD_FORMAT', 'json'), # 'json' or 'binary' (libs/telemetry.py)
+    'REPORT_MODE'           : hppc_config.get('REPORT_MODE', 'interval'), # 'interval' or 'exception' (libs/deadband.py)
+    'DEADBANDS'             : hppc_config.get('DEADBANDS', {
+                                  'scc_load_voltage' : 0.1, 'scc_load_current' : 0.05,
+                                  'battery_voltage'  : 0.1, 'battery_current'  : 0.05,
+                                  'solar_voltage'    : 0.5, 'solar_current'    : 0.05,
+                                  'temperature'      : 0.5,
+                                  'solar_wh'         : 10,  'load_wh'          : 10,
+                                  'battery_ah'       : 0.5, 'soc'              : 1}),
+    'HEARTBEAT_INTERVAL'    : hppc_config.get('HEARTBEAT_INTERVAL', 900000), # ms between full snapshots in exception mode
+    'TEMPERATURE_LUT_STEP'  : hppc_config.get('TEMPERATURE_LUT_STEP', 16), # ADC codes between lookup table entries, 0 for the analytic conversion
+    'BATTERY_CAPACITY_AH'   : hppc_config.get('BATTERY_CAPACITY_AH', 100),
+    # [voltage, soc %] at rest, default is a 24V lead acid bank
+    'OCV_TABLE'             : hppc_config.get('OCV_TABLE', [[22.6, 0], [23.0, 10], [23.3, 20], [23.6, 30], [23.9, 40], [24.2, 50],
+                                                            [24.5, 60], [24.7, 70], [25.0, 80], [25.2, 90], [25.5, 100]]),
+    'ENERGY_CHECKPOINT_INTERVAL' : hppc_config.get('ENERGY_CHECKPOINT_INTERVAL', 600000), # min ms between energy counter writes to flash
+    'FAST_BOOT'             : hppc_config.get('FAST_BOOT', True), # join the last good access point directly, no start up blink (see BOOT)
+    'DIAGNOSTICS'           : hppc_config.get('DIAGNOSTICS', True), # run time histograms of the callbacks (see DIAGNOSTICS)
+    'DIAGNOSTICS_INTERVAL'  : hppc_config.get('DIAGNOSTICS_INTERVAL', 300000) # ms between diagnostics reports, 0 for none (STATS still answers)
     }
 
+# behind a site gateway the uplink is the gateway's business, the link probe only has to reach it
+if CONFIG['MQTT_GATEWAY']:
+    link.host = CONFIG['MQTT_GATEWAY']
+
+# ENERGY ACCOUNTING
+# Wh/Ah counters and coulomb counting state of charge, integrated after every conversion from the integer readings
+# record, without allocating, and brought up to date once a second (see libs/energy.py). Checkpointed to flash so
+# they survive a reset. Battery current is positive while charging.
+energy = EnergyMeter(StateOfCharge(CONFIG['BATTERY_CAPACITY_AH'], CONFIG['OCV_TABLE'], rest_current = 0.5, rest_time = 1800000))
+energy_store = Checkpoint('energy', interval = CONFIG['ENERGY_CHECKPOINT_INTERVAL'], changed = energy_changed)
+ENERGY_CHECKPOINT_PERIOD = 60000 # ms between checkpoint checks, the store decides whether to write
+
+# Texts for error_message_1 to error_message_4
+ERROR_MESSAGES = (
+    "WARNING: SCC LOAD VOLTAGE IS ABOVE MAX VOLTAGE RATING. POWER CONTROLLER LOADS TURNED OFF",
+    "WARNING: SCC LOAD VOLTAGE IS BELOW MIN VOLTAGE RATING. POWER CONTROLLER LOADS TURNED OFF",
+    "WARNING: SCC LOAD IS OVER CURRENT RATING. POWER CONTROLLER LOADS TURNED OFF",
+    "WARNING: BATTERY CHARGING VOLTAGE IS TOO HIGH. POWER CONTROLLER LOADS TURNED OFF",
+    )
+# The safety checks only deal in error codes (ERROR_STATES, telemetry.ERRORS), the texts are filled in on publishing
+ERROR_KEYS = ('error_message_1', 'error_message_2', 'error_message_3', 'error_message_4')
+
 #print(CONFIG)
 #sleep(100)
 
+# STATE LOG
+# The state is journalled to flash (libs/journal.py) as a telemetry record plus the watchdog feed count, only when
+# a flag or error changed, a reading moved beyond its JOURNAL_DEADBANDS or JOURNAL_HEARTBEAT ms have passed.
+# The configuration is snapshotted separately and only when it changed.
+JOURNAL_DEADBANDS = {
+    'scc_load_voltage' : 1.0, 'scc_load_current' : 0.5,
+    'battery_voltage'  : 0.5, 'battery_current'  : 1.0,
+    'solar_voltage'    : 5.0, 'solar_current'    : 1.0,
+    'temperature'      : 2.0,
+    'solar_wh'         : 100, 'load_wh'          : 100,
+    'battery_ah'       : 5,   'soc'              : 5}
+JOURNAL_HEARTBEAT = 3600000 # ms
+journal = Journal('journal', slot_size = 48, slots = 256, files = 4)
+journal_filter = ReportByException(JOURNAL_DEADBANDS, JOURNAL_HEARTBEAT)
+journal_buf = bytearray(telemetry.SIZE + 4)
+last_journal = None # (seq, payload) of the newest record found at boot
+config_store = Checkpoint('config', interval = 0, changed = lambda old, new: old != new)
+
 def log_state():
-    global DATA, CONFIG, hppc_config
-    with open('/log.txt', 'w') as f:
-        f.write(dumps(DATA))
-        f.write('\n')
-        f.write(dumps(CONFIG))
-        f.write('\n')
-        f.write(dumps(hppc_config))
-        f.write('\n')
-        f.write(str(test_count))
-    f.close()
+    '''Journals the state when it changed'''
+    if journal_filter.changes(DATA) is None:
+        return False
+    encode_readings(journal_buf)
+    pack_into('<I', journal_buf, telemetry.SIZE, test_count)
+    journal.append(journal_buf)
+    return True
+
+def save_config():
+    '''Snapshots CONFIG and hppc_config when they differ from the last snapshot'''
+    return config_store.save(dumps({'CONFIG' : CONFIG, 'hppc_config' : hppc_config}))
 
 def enable_24v_poe(state):
     ''' This function used to toggle the 24V HomePoynt load'''
@@ -149,6 +285,18 @@ def enable_12v(state):
         EN_12V = False
     return EN_12V
 
+def trip_loads():
+    ''' Called from the acquisition timer when the protection trips. Switches both loads off immediately'''
+    global EN_12V, EN_24V_POE
+    _12v.value(0)
+    _24v_poe.value(0)
+    EN_12V = False
+    EN_24V_POE = False
+
+# Fast load protection on raw ADC codes, checked after every acquisition round (see libs/protection.py)
+protection = Protection(load_current_ch, load_voltage_ch, battery_voltage_ch, trip_loads, trip_count = 3)
+acquisition.hook = protection.check
+
 def blink_debug_led(times):
     for i in range(times):
         debug_led.value(1)
@@ -166,201 +314,315 @@ def toggle_debug_led():
         debug_led.value(0)
         debug_led_state = True
     
+# Thermistor conversion parameters. The lookup table in flash is rebuilt whenever these change.
+NTC_PARAMETERS = {
+    'set_point'   : 0.595,
+    'Bval'        : 470000,
+    'A1'          : 3.354016E-03,
+    'B1'          : 2.264097E-04,
+    'C1'          : 3.278184E-06,
+    'D1'          : 1.097628E-07,
+    'temp_offset' : 1.35,
+    }
+TEMPERATURE_TABLE_FILE = 'ntc_table.bin'
+temperature_table = None
+
+def load_temperature_table(step):
+    '''Temperature lookup table (libs/lut.py) from flash, built from the analytic conversion when missing or stale'''
+    key = '{} {}'.format(step, sorted(NTC_PARAMETERS.items()))
+    table = ConversionTable.load(TEMPERATURE_TABLE_FILE, key)
+    if table is None:
+        table = ConversionTable.build(temperature_ch, thermistor.get_temperature, step = step, scale = 100)
+        try:
+            table.save(TEMPERATURE_TABLE_FILE, key)
+        except OSError:
+            print("Could not save temperature table")
+    return table
+
+def reading_convert(calibration, name, channel, nominal):
+    '''convert() of a reading through its calibration profile entry, the nominal conversion without one'''
+    spec = calibration.get(name)
+    if spec is None:
+        return nominal
+    try:
+        return calibrated(channel, name, spec)
+    except (ValueError, TypeError, KeyError, IndexError):
+        print("Invalid {} calibration, using the nominal conversion".format(name))
+        return nominal
+
 def setup():
-    '''This function sets up the power monitor states, initial load states and verifies internet connection '''
-    global hppc_config, DATA, EN_24V_POE, EN_12V, battery_voltage, battery_current, panel_voltage, panel_current, load_voltage, load_current, thermistor
+    '''This function sets up the power monitor states and initial load states. The network is brought up by the link task.'''
+    global hppc_config, DATA, EN_24V_POE, EN_12V, battery_voltage, battery_current, panel_voltage, panel_current, load_voltage, load_current, thermistor, temperature_table
+    global battery_current_table, panel_current_table, load_current_table, battery_voltage_table, panel_rise_table, load_voltage_table
+    global last_journal, window_extremes
     
-    # Setup curremt, voltage temperature measurement classes
+    # Setup curremt, voltage temperature measurement classes (fed by the filtered acquisition channels)
     # Current Classes
-    battery_current = CurrentRead(battery_current_pin, 1.660, -0.001, 3.332, "BATTERY_CURRENT", 88700, 20000) # 2.66735
-    panel_current = CurrentRead(panel_current_pin, 1.671, -0.007,  3.332, "PANEL_CURRENT", 88700, 20000)
-    load_current = CurrentRead(load_current_pin, 1.688, -0.008, 3.332, "LOAD_CURRENT", 88700, 20000) #2.66735
+    battery_current = CurrentRead(battery_current_ch, 1.660, -0.001, 3.332, "BATTERY_CURRENT", 88700, 20000) # 2.66735
+    panel_current = CurrentRead(panel_current_ch, 1.671, -0.007,  3.332, "PANEL_CURRENT", 88700, 20000)
+    load_current = CurrentRead(load_current_ch, 1.688, -0.008, 3.332, "LOAD_CURRENT", 88700, 20000) #2.66735
 
     # Voltage Classes
-    battery_voltage = VoltageRead(battery_voltage_pin, 0.001, 0, "BATTERY_VOLTAGE", 88700, 1000000)
-    panel_voltage = VoltageRead(panel_voltage_pin, 0, 0, "PANEL_VOLTAGE", 178000, 1000000)
-    load_voltage = VoltageRead(load_voltage_pin, 0, 0.1, "LOAD_VOLTAGE", 88700, 1000000)
+    battery_voltage = VoltageRead(battery_voltage_ch, 0.001, 0, "BATTERY_VOLTAGE", 88700, 1000000)
+    panel_voltage = VoltageRead(panel_voltage_ch, 0, 0, "PANEL_VOLTAGE", 178000, 1000000)
+    load_voltage = VoltageRead(load_voltage_ch, 0, 0.1, "LOAD_VOLTAGE", 88700, 1000000)
 
     # Temperature
-    thermistor = NTC_Temperature(temperature_pin,
-                                 set_point = 0.595, Bval = 470000,
-                                 A1 = 3.354016E-03,
-                                 B1 = 2.264097E-04,
-                                 C1 = 3.278184E-06,
-                                 D1 = 1.097628E-07,
-                                 temp_offset = 1.35)
+    thermistor = NTC_Temperature(temperature_ch, **NTC_PARAMETERS)
+    if CONFIG['TEMPERATURE_LUT_STEP']:
+        temperature_table = load_temperature_table(CONFIG['TEMPERATURE_LUT_STEP'])
+    
+    # The board's calibration for the charger profile (libs/calibration.py) replaces the nominal conversions above
+    calibration = profile(hppc_config, CONFIG['CHARGER_PROFILE'])
+    battery_current_convert = reading_convert(calibration, 'battery_current', battery_current_ch, battery_current.get_current)
+    panel_current_convert = reading_convert(calibration, 'solar_current', panel_current_ch, panel_current.get_current)
+    load_current_convert = reading_convert(calibration, 'scc_load_current', load_current_ch, load_current.get_current)
+    battery_voltage_convert = reading_convert(calibration, 'battery_voltage', battery_voltage_ch, battery_voltage.get_voltage)
+    panel_rise_convert = reading_convert(calibration, 'solar_voltage', panel_voltage_ch, lambda: get_panel_rise(panel_voltage))
+    load_voltage_convert = reading_convert(calibration, 'scc_load_voltage', load_voltage_ch, load_voltage.get_voltage)
+    
+    # Integer conversion tables for fetch_data(), sampled from the conversions above
+    battery_current_table = ConversionTable.build(battery_current_ch, battery_current_convert, step = READING_LUT_STEP, scale = 1000)
+    panel_current_table = ConversionTable.build(panel_current_ch, panel_current_convert, step = READING_LUT_STEP, scale = 1000)
+    load_current_table = ConversionTable.build(load_current_ch, load_current_convert, step = READING_LUT_STEP, scale = 1000)
+    battery_voltage_table = ConversionTable.build(battery_voltage_ch, battery_voltage_convert, step = READING_LUT_STEP, scale = 100)
+    panel_rise_table = ConversionTable.build(panel_voltage_ch, panel_rise_convert, step = READING_LUT_STEP, scale = 100)
+    load_voltage_table = ConversionTable.build(load_voltage_ch, load_voltage_convert, step = READING_LUT_STEP, scale = 100)
+    # (reading, channel, table) for the readings converted from a single channel
+    window_extremes = ((LOAD_V, load_voltage_ch, load_voltage_table),
+                       (LOAD_I, load_current_ch, load_current_table),
+                       (BATTERY_V, battery_voltage_ch, battery_voltage_table),
+                       (BATTERY_I, battery_current_ch, battery_current_table),
+                       (SOLAR_I, panel_current_ch, panel_current_table))
+    if temperature_table is not None:
+        window_extremes += ((TEMPERATURE, temperature_ch, temperature_table),)
+    
+    # Energy counters carry on from the last checkpoint
+    state = energy_store.load()
+    if state is not None:
+        energy.restore(state)
+    
+    # Newest state journalled before the reset, and a configuration snapshot if it changed since
+    last_journal = journal.recover()
+    if last_journal is not None:
+        print("Last journalled state: record {}".format(last_journal[0]))
+    config_store.load()
+    save_config()
+    wifi_store.load()
+    
+    # Protection thresholds are converted to ADC codes once, so the fast path only compares integers
+    protection.set_limits(threshold_code(load_voltage_ch, load_voltage_convert, hppc_config['SCC_MAX_VOLTAGE']),
+                          threshold_code(load_voltage_ch, load_voltage_convert, hppc_config['SCC_MIN_VOLTAGE']),
+                          threshold_code(load_current_ch, load_current_convert, hppc_config['SCC_MAX_CURRENT']),
+                          threshold_code(battery_voltage_ch, battery_voltage_convert, hppc_config['BATT_MAX_VOLTAGE']))
     
     # Set PoE and 12V state
     enable_24v_poe(CONFIG['POE_LOAD_ON'])
     enable_12v(CONFIG['12V_LOAD_ON'])
     
-    # Verify internet by pinging google
-    while 1:
-        if do_connect():
-            if ping_google():
-                DATA['connected_to_wifi'] = True
-                print('Internet connection established...')
-                break
-            else:
-                DATA['connected_to_wifi'] = False
-                print('Internet connection could not be established. Retrying...')
-    # Setup MQTT client
-    mqtt_setup(CONFIG['ID'], CONFIG['MQTT_SERVER'], CONFIG['MQTT_UN'], CONFIG['MQTT_PW'] ,CONFIG['LOG_INTERVAL']/1000 + 60)
-    subscribe_to_control(client, topic = CONFIG['MQTT_CONTROL_TOPIC'])
+    # Start sampling (and protection) once the loads are in their initial state
+    acquisition.start()
+    
+    # Drop the start up garbage, then leave collections to the heap: one runs once a quarter of the
+    # free heap has been allocated, instead of on a schedule
+    collect()
+    threshold(mem_free() // 4 + mem_alloc())
     
     return True
 
-def do_connect():
-    '''Establishs wifi connection'''
+# BOOT
+# Sampling and protection start as soon as setup() has run, the network comes up behind them in the link task.
+# With FAST_BOOT the access point of the last good WiFi profile is joined directly by BSSID and channel
+# (remembered in flash by wifi_store). Otherwise, or when that fails, one scan picks the strongest access
+# point of a known profile rather than trying every profile in turn. Time is set in the background (see CLOCK).
+FAST_JOIN_TIMEOUT = 3000 # ms to wait for the remembered access point before scanning
+JOIN_TIMEOUT = 5000      # ms to give a profile to associate
+SCAN_MAX_WAIT = 30000    # ms between scans at most, while no known network is in range
+wifi_store = Checkpoint('wifi', interval = 0, changed = lambda old, new: old != new)
+
+def set_channel(wlan, channel):
+    try:
+        wlan.config(channel = channel)
+    except (OSError, ValueError): # ports that don't take a channel in station mode
+        pass
+
+async def join(wlan, ssid, pwd, timeout, bssid = None):
+    '''Starts joining and waits cooperatively for up to timeout ms. Returns True once associated.'''
+    try:
+        wlan.connect(ssid, pwd, bssid = bssid)
+    except OSError:
+        return False
+    for i in range(timeout // 100):
+        if wlan.isconnected():
+            return True
+        await sleep_ms(100)
+    if wlan.isconnected():
+        return True
+    wlan.disconnect()
+    return False
+
+async def join_scanned(wlan):
+    '''
+    Scans once and joins the strongest access point of a known profile. Profiles that were not seen are only
+    tried when a hidden network is in range. The scan blocks for a couple of seconds, acquisition and protection
+    keep running on the timer meanwhile.
+    '''
+    profiles = {}
+    for site_name, credentials in CONFIG['WIFI_CREDENTIALS'].items():
+        profiles[credentials[0].encode()] = site_name
+    try:
+        found = wlan.scan()
+    except OSError:
+        found = []
+    found.sort(key = lambda network: -network[3])
+    hidden = False
+    for network in found:
+        hidden = hidden or network[5]
+        site_name = profiles.pop(network[0], None)
+        if site_name is None:
+            continue
+        print('Attempting to connect using WiFi Profile: {} '.format(site_name))
+        credentials = CONFIG['WIFI_CREDENTIALS'][site_name]
+        set_channel(wlan, network[2])
+        if await join(wlan, credentials[0], credentials[1], JOIN_TIMEOUT, network[1]):
+            wifi_store.save({'profile' : site_name, 'bssid' : hexlify(network[1]).decode(), 'channel' : network[2]})
+            return True
+        print("Attempt failed...\n")
+    if not hidden:
+        return False
+    for site_name in profiles.values():
+        print('Attempting to connect using WiFi Profile: {} '.format(site_name))
+        credentials = CONFIG['WIFI_CREDENTIALS'][site_name]
+        if await join(wlan, credentials[0], credentials[1], JOIN_TIMEOUT):
+            wifi_store.save({'profile' : site_name, 'bssid' : None, 'channel' : 0})
+            return True
+        print("Attempt failed...\n")
+    return False
+
+async def do_connect():
+    '''Establishs wifi connection. Waits cooperatively so sampling and safety checks keep running.'''
     global hppc_config, CONFIG, DATA
     wlan = WLAN(STA_IF)
     wlan.active(True)
     
     if wlan.isconnected():
         print("WiFi already connected...")
-
+    
+    last = wifi_store.saved if CONFIG['FAST_BOOT'] else None
+    if last is not None and last['profile'] in CONFIG['WIFI_CREDENTIALS'] and not wlan.isconnected():
+        print('Joining the last access point of WiFi Profile: {} '.format(last['profile']))
+        credentials = CONFIG['WIFI_CREDENTIALS'][last['profile']]
+        if last['channel']:
+            set_channel(wlan, last['channel'])
+        bssid = unhexlify(last['bssid']) if last['bssid'] else None
+        if not await join(wlan, credentials[0], credentials[1], FAST_JOIN_TIMEOUT, bssid):
+            print("Attempt failed...\n")
+    
+    wait = 1000
     while not wlan.isconnected():
-        for site_name, credentials in CONFIG['WIFI_CREDENTIALS'].items():
-            print('Attempting to connect using WiFi Profile: {} '.format(site_name))
-            ssid = credentials[0]
-            pwd = credentials[1]
-            
-            try:
-                wlan.connect(ssid, pwd)
-                sleep(5)
-                if wlan.isconnected():
-                    print("WiFi connected...")
-                    break
-                else:
-                    print("Attempt failed...\n")
-                    sleep(1)
-            except:
-                wlan.disconnect()
-                print("Attempt failed...\n")
-                sleep(1)
-                pass  
+        if not await join_scanned(wlan):
+            # scans block, so they are spaced out while nothing known is in range
+            await sleep_ms(wait)
+            wait = min(wait * 2, SCAN_MAX_WAIT)
     
     print('network config:', wlan.ifconfig())        
         
     DATA['connected_to_wifi'] = True
-     
-    # Update time with ntp server
-    while 1:
-        try:
-            ntptime.settime()
-        except:
-            print('syncing time...')
-        else:
-            print("time synced...")
-            break
-    
     return True
     
-def ping_google():
-    '''use uPing library to ping google'''
-    x = ping('google.com', count=4, timeout=5000, interval=10, quiet=True, size=64)
-    if x == (4, 4):
-        return True
-    else:
-        return False
- 
 def verify_internet_connection():
-    '''function to set wifi connection flags'''
+    '''function to set wifi connection flags. Only probes the link when the monitor's schedule says so'''
     global DATA, DEBUG_STATE
-    if ping_google():
-        DATA['connected_to_wifi'] = True
-        return True
-    else:
-        DATA['connected_to_wifi'] = False
-        return False
+    DATA['connected_to_wifi'] = link.poll()
+    return DATA['connected_to_wifi']
+
+def get_panel_rise(panel_voltage):
+    """Panel voltage above the battery voltage, see get_panel_voltage()"""
+    panel_v_adc = panel_voltage.get_adc_voltage()
+    panel_v_adc = 3.3 - panel_v_adc  # correct panel adc voltage to account for 3.3V ref instead of gnd
+    return ((panel_v_adc/180000)*1180000) - 3.33
 
 def get_panel_voltage(panel_voltage, battery_voltage, offset = 0.4): # instantiate VoltageRead class for panel
     """
     Panel voltage is calulated differently due to hw mods.
     Use this function speciifcally for measuring the Panel Voltage
     """
-    battery_v = battery_voltage.get_voltage()
-    
-    panel_v_adc = panel_voltage.get_adc_voltage()
-    panel_v_adc = 3.3 - panel_v_adc  # correct panel adc voltage to account for 3.3V ref instead of gnd
-    Vpanel = ((panel_v_adc/180000)*1180000) - 3.33
-    return battery_v + Vpanel + offset
+    return battery_voltage.get_voltage() + get_panel_rise(panel_voltage) + offset
 
-def fetch_data(charger = CONFIG['CHARGER_PROFILE']): 
-    '''Function to update voltage, current, and panel/battery connection states\
-used for two profiles only at the moment'''
-    global DATA, CONFIG, state, test_count
+def fetch_data(): 
+    '''Function to update voltage, current, and panel/battery connection states. Converts into the readings record with
+table lookups, allocating nothing. The charger profile's calibration is in the tables, see setup()'''
+    global DATA, CONFIG
+    values = readings.values
 
-    DATA['scc_load_voltage'] = load_voltage.get_voltage()
-    DATA['scc_load_current'] = load_current.get_current()
-    DATA['battery_voltage'] = battery_voltage.get_voltage()
-    DATA['battery_current'] = battery_current.get_current()
-    DATA['solar_voltage'] = get_panel_voltage(panel_voltage, battery_voltage, offset=0) #panel_voltage.get_voltage()
-    DATA['solar_current'] = panel_current.get_current()
+    values[LOAD_V] = load_voltage_table.convert_scaled(load_voltage_ch.value)
+    values[LOAD_I] = load_current_table.convert_scaled(load_current_ch.value)
+    values[BATTERY_V] = battery_voltage_table.convert_scaled(battery_voltage_ch.value)
+    values[BATTERY_I] = battery_current_table.convert_scaled(battery_current_ch.value)
+    # get_panel_voltage() with offset=0
+    solar_v = values[BATTERY_V] + panel_rise_table.convert_scaled(panel_voltage_ch.value)
+    # both terms are in range on their own, their sum may not be; -32768 is telemetry.MISSING, not a reading
+    values[SOLAR_V] = -LIMIT if solar_v < -LIMIT else (solar_v if solar_v < LIMIT else LIMIT)
+    values[SOLAR_I] = panel_current_table.convert_scaled(panel_current_ch.value)
 
     # check if 24V battery is connected 
-    if DATA['battery_voltage'] < 20:
+    if values[BATTERY_V] < BATTERY_PRESENT_V:
         DATA['battery_connected'] = False
-    if DATA['battery_voltage'] > 20:
+    if values[BATTERY_V] > BATTERY_PRESENT_V:
         DATA['battery_connected'] = True
    
-    if DATA['solar_voltage'] < DATA['battery_voltage']:
+    if values[SOLAR_V] < values[BATTERY_V]:
         DATA['panel_connected'] = False
     else:
         DATA['panel_connected'] = True
    
-    DATA['temperature'] =  thermistor.get_temperature()
-    DATA['connected_to_wifi'] = verify_internet_connection()
-    
-    wdt.feed() # this one
-    test_count += 1
-    print("wdt fed...{}".format(test_count))
+    if temperature_table is not None:
+        values[TEMPERATURE] = temperature_table.convert_scaled(temperature_ch.value)
+    else:
+        values[TEMPERATURE] = int(round(thermistor.get_temperature() * 100))
     
     return True
 
 def safety_check():
     '''checks that voltages and currents are not above the limits of the devices and sets the appropriat condition flags'''
-    global DATA, ERROR_STATES, hppc_config,  EN_12V, EN_24V_POE
+    global DATA, ERROR_STATES, hppc_config,  EN_12V, EN_24V_POE, alarm_bits
+
+    values = readings.values
+    load_v = values[LOAD_V]
 
     # Load protection against input voltage which the 12V reg cannot handle
-    if DATA['scc_load_voltage'] > hppc_config['SCC_MAX_VOLTAGE']:
+    if load_v > SCC_MAX_V:
         ERROR_STATES['scc_over_voltage'] = True
-        DATA['error_message_1'] = "WARNING: SCC LOAD VOLTAGE IS ABOVE MAX VOLTAGE RATING. POWER CONTROLLER LOADS TURNED OFF"
        
     # Load protection against low voltage (This is to ensure that the HomePoynt Load Is powered by a minimum voltage)    
-    if DATA['scc_load_voltage'] < hppc_config['SCC_MIN_VOLTAGE']:
+    if load_v < SCC_MIN_V:
         ERROR_STATES['scc_under_voltage'] = True
-        DATA['error_message_2'] = "WARNING: SCC LOAD VOLTAGE IS BELOW MIN VOLTAGE RATING. POWER CONTROLLER LOADS TURNED OFF"
         
     # If "scc_load_voltage" is within correct range, set/reset relevant flags
-    if  DATA['scc_load_voltage'] < hppc_config['SCC_MAX_VOLTAGE'] and DATA['scc_load_voltage'] > hppc_config['SCC_MIN_VOLTAGE']:
+    if load_v < SCC_MAX_V and load_v > SCC_MIN_V:
         ERROR_STATES['scc_under_voltage'] = False
         ERROR_STATES['scc_over_voltage'] = False
-        DATA['error_message_1'] = None
-        DATA['error_message_2'] = None
     
     # Load Protection against too much current draw which could reach regulator limits
-    if DATA['scc_load_current'] > hppc_config['SCC_MAX_CURRENT']:
+    if values[LOAD_I] > SCC_MAX_I:
         ERROR_STATES['scc_over_current'] = True        
-        DATA['error_message_3'] = "WARNING: SCC LOAD IS OVER CURRENT RATING. POWER CONTROLLER LOADS TURNED OFF"
       
     # If  "scc_load_current" is within the correct range, set/reset relevant flags
-    if DATA['scc_load_current'] < hppc_config['SCC_MAX_CURRENT']:
+    if values[LOAD_I] < SCC_MAX_I:
         ERROR_STATES['scc_over_current'] = False
-        DATA['error_message_3'] = None
     
     # Battery Protection: Battery max voltage cannot exceed the max voltage at which the battery can be charged at (Dependant on battery and charge controller charging stage settings)
-    if DATA['battery_voltage'] > hppc_config['BATT_MAX_VOLTAGE']:
+    if values[BATTERY_V] > BATT_MAX_V:
         ERROR_STATES['batt_charging_voltage_too_high'] = True
-        DATA['error_message_4'] = "WARNING: BATTERY CHARGING VOLTAGE IS TOO HIGH. POWER CONTROLLER LOADS TURNED OFF"
         
-    if DATA['battery_voltage'] < hppc_config['BATT_MAX_VOLTAGE']:
+    if values[BATTERY_V] < BATT_MAX_V:
         ERROR_STATES['batt_charging_voltage_too_high'] = False
-        DATA['error_message_4'] = None
     # Panel Protection: No protection, can only say if the panel is connected or not  
     
     # Checks for any error states which are true
     safty_state = (ERROR_STATES['scc_over_current'] or ERROR_STATES['scc_under_voltage']) or (ERROR_STATES['scc_over_voltage'] or ERROR_STATES['batt_charging_voltage_too_high'])
+    # A trip of the fast protection path keeps the loads off until the next load reset
+    safty_state = safty_state or protection.tripped
     
     # Switched all loads off based on error state estimate
     if safty_state:
@@ -368,6 +630,12 @@ def safety_check():
         EN_24V_POE = False
     
     update_board_states()
+    
+    # Any change of the safety flags is published straight away
+    bits = (protection.tripped << len(telemetry.ERRORS)) | telemetry.error_bits(ERROR_STATES)
+    if bits != alarm_bits:
+        alarm_bits = bits
+        alarm.set()
 
 # add code to request error state dictionary (will help with remote debugging)
 # error state dictionary
@@ -378,55 +646,6 @@ ERROR_STATES = {
     'batt_charging_voltage_too_high' : False,
     }
 
-def printDATA():
-    '''Used to verify DATA dictionary, which gets sent to the MQTT server'''
-    global DATA
-    print("\033[4m" + "DATA DICTIONARY" + "\033[0m")
-    print('scc_load_voltage : {:>36.7} V'.format(DATA['scc_load_voltage']))
-    print('scc_load_current : {:>40.7} A'.format(DATA['scc_load_current']))
-    
-    print('battery_connected : {!r:>36}'.format(DATA['battery_connected']))
-    print('battery_voltage : {:>27.7} V'.format(DATA['battery_voltage']))
-    print('battery_current : {:>31.7} A'.format(DATA['battery_current']))
-    
-    print('panel_connected : {!r:>39}'.format(DATA['panel_connected']))
-    print('solar_voltage : {:>30.7} V'.format(DATA['solar_voltage']))
-    print('solar_current : {:>34.7} A'.format(DATA['solar_current']))
-    
-    print('temperature : {:>49.7} {}C'.format(DATA['temperature'], u"\u00b0"))
-    print('connected_to_wifi : {!r:>36}'.format(DATA['connected_to_wifi']))
-    
-    
-    print('error_message_1 : {!r:>38}'.format(DATA['error_message_1']))
-    print('error_message_2 : {!r:>38}'.format(DATA['error_message_2']))
-    print('error_message_3 : {!r:>38}'.format(DATA['error_message_3']))
-    print('error_message_4 : {!r:>38}'.format(DATA['error_message_4']))
-    print('time : {!r:>64}'.format(DATA['time']))
-
-def printERROR_STATES():
-    global ERROR_STATES
-    print("\n\033[4m" + "ERROR STATES DICTIONARY" + "\033[0m")
-    print('scc_over_voltage : {!r:>39}'.format(ERROR_STATES['scc_over_voltage']))
-    print('scc_under_voltage : {!r:>36}'.format(ERROR_STATES['scc_under_voltage']))
-    print('scc_over_current : {!r:>39}'.format(ERROR_STATES['scc_over_current']))
-    print('batt_charging_voltage_too_high : {!r:>8}'.format(ERROR_STATES['batt_charging_voltage_too_high']))
-
-def printCONFIG():
-    global CONFIG
-    print("\n\033[4m" + "CONFIG DICTIONARY" + "\033[0m")
-    print('ID : {!r:>70}'.format(CONFIG['ID']))
-    print('WIFI_SSID : {!r:>60}'.format(CONFIG['WIFI_SSID']))
-    print('WIFI_PWD : {!r:>54}'.format(CONFIG['WIFI_PWD']))
-    print('MQTT_SERVER : {!r:>41}'.format(CONFIG['MQTT_SERVER']))
-    print('MQTT_DATA_TOPIC : {!r:>49}'.format(CONFIG['MQTT_DATA_TOPIC']))
-    print('MQTT_CONTROL_TOPIC : {!r:>49}'.format(CONFIG['MQTT_CONTROL_TOPIC']))
-    print('CHARGER_PROFILE : {!r:>32}'.format(CONFIG['CHARGER_PROFILE']))
-    print('LOG_INTERVAL : {!r:>42}'.format(CONFIG['LOG_INTERVAL']))
-    print('TIMEZONE : {!r:>52}'.format(CONFIG['TIMEZONE']))
-    print('LOAD_RESET_INTERVAL : {!r:>25}'.format(CONFIG['LOAD_RESET_INTERVAL']))
-    print('12V_LOAD_ON : {!r:>43}'.format(CONFIG['12V_LOAD_ON']))
-    print('POE_LOAD_ON : {!r:>42}\n'.format(CONFIG['POE_LOAD_ON']))    
-
 # VERIFY THE FLAG STATE CHANGE 
 def update_board_states():
     '''Used to update the states on the board'''
@@ -434,9 +653,9 @@ def update_board_states():
     enable_24v_poe(EN_24V_POE)
     enable_12v(EN_12V)
     
-def getTime():
+def getTime(t = None):
     global CONFIG
-    _year, _month, _day, _hour, _min, _sec, _, _ = time.localtime() #time.gmtime() #
+    _year, _month, _day, _hour, _min, _sec = localtime(t)[:6] #time.gmtime() #
     # Checks that timezone is correct.
 #     current_timezone = CONFIG['TIMEZONE']
 #     if current_timezone > -12 and current_timezone < 13:
@@ -445,222 +664,532 @@ def getTime():
 #         time_zone = 0
     return "{}_{:02d}_{:02d}_{:02d}_{:02d}_{:02d}".format(_year, _month, _day, _hour + CONFIG['TIMEZONE'], _min, _sec)
 
-# TIMER CALLBACK FUNCTIONS
-def send_data(timer_one):
-    '''used to publish data to the MQTT server'''
-    global DATA, CONFIG, client
+# CLOCK
+# NTP is synced in the background and never holds up the link, sampling or commands: a failed sync is retried
+# with backoff. Readings taken before the clock is set are spooled with the unset clock's time and restamped
+# by clock_offset when they are replayed. The RTC keeps its time through a watchdog reset, so this only
+# happens after power up.
+CLOCK_SET = 1577836800 # unix time of 2020-01-01, an earlier clock has not been set by NTP yet
+CLOCK_PERIOD = 1000    # ms between checks whether a sync is due
+NTP_RETRY = 2000       # ms before retrying a failed sync, doubled every time up to NTP_MAX_RETRY
+NTP_MAX_RETRY = 300000
+NTP_RESYNC = 86400000  # ms between syncs once the clock is set, the RTC drifts
+ntp_due = None         # ticks of the next sync, None for as soon as the link is up
+ntp_retry = NTP_RETRY
+clock_offset = 0       # s the first sync moved the clock by
+
+def clock_set():
+    return time() + telemetry.EPOCH_OFFSET >= CLOCK_SET
+
+def sync_clock():
+    '''Sets the clock from NTP when a sync is due. Returns True when it was set.'''
+    global ntp_due, ntp_retry, clock_offset
+    if not DATA['connected_to_wifi'] or ntp_due is not None and ticks_diff(ticks_ms(), ntp_due) < 0:
+        return False
+    import ntptime # only needed once the link is up
+    if CONFIG['MQTT_GATEWAY']:
+        ntptime.host = CONFIG['MQTT_GATEWAY']
+    before = time()
+    try:
+        ntptime.settime()
+    except Exception:
+        print('syncing time...')
+        ntp_due = ticks_add(ticks_ms(), ntp_retry)
+        ntp_retry = min(ntp_retry * 2, NTP_MAX_RETRY)
+        return False
+    if before + telemetry.EPOCH_OFFSET < CLOCK_SET:
+        clock_offset = time() - before
+    print("time synced...")
+    ntp_due = ticks_add(ticks_ms(), NTP_RESYNC)
+    ntp_retry = NTP_RETRY
+    return True
+
+def restamp(record):
+    '''A spooled record with its time moved by clock_offset when it was taken before the clock was set'''
+    t = telemetry.record_time(record)
+    if t >= CLOCK_SET:
+        return record
+    record = bytearray(record)
+    telemetry.set_record_time(record, t + clock_offset)
+    return record
+
+# STORE AND FORWARD
+# Flash paths are relative to the working directory, which is the filesystem root on the device.
+# Readings taken while offline are spooled to flash as telemetry records (libs/telemetry.py) and replayed after reconnecting.
+SPOOL_BATCH = 20         # records per replay publish
+SPOOL_DRAIN_PERIOD = 500 # ms between replay publishes, limits the replay rate
+spool = Spool('spool', telemetry.SIZE, segment_records = 256, max_segments = 8)
+
+# reused for every binary payload
+telemetry_buf = bytearray(telemetry.SIZE)
+
+def encode_readings(buf = telemetry_buf):
+    '''The readings record, DATA's flags and ERROR_STATES as a telemetry record in buf'''
+    return telemetry.encode_values(readings.values, telemetry.flag_bits(DATA), telemetry.error_bits(ERROR_STATES),
+                                   int(time()) + telemetry.EPOCH_OFFSET, buf)
+
+def pack_record():
+    '''Packs the current readings and ERROR_STATES into a telemetry record'''
+    return bytes(encode_readings())
+
+def unpack_record(record, offset = 0):
+    '''Rebuilds a DATA style dictionary from a telemetry record'''
+    reading = telemetry.decode(record, offset)
+    errors = reading.pop('errors')
+    reading['id'] = DATA['id']
+    reading['site_id'] = DATA['site_id']
+    for i in range(len(ERROR_MESSAGES)):
+        reading[ERROR_KEYS[i]] = ERROR_MESSAGES[i] if errors & (1 << i) else None
+    reading['time'] = getTime(reading['time'] - telemetry.EPOCH_OFFSET)
+    return reading
+
+def data_topic():
+    '''Binary payloads carry no device id, so they go to a per device sub topic'''
+    if CONFIG['PAYLOAD_FORMAT'] == 'binary':
+        return '{}/{}'.format(CONFIG['MQTT_DATA_TOPIC'], CONFIG['ID']).encode()
+    return CONFIG['MQTT_DATA_TOPIC'].encode()
+
+def data_payload(fields = None):
+    '''
+    The current DATA in the configured payload format. With `fields` (report by exception) JSON payloads
+    only carry those fields plus id, stats and time; binary records always carry every reading but no stats.
+    '''
+    if CONFIG['PAYLOAD_FORMAT'] == 'binary':
+        return encode_readings()
+    if fields is None or fields is DATA:
+        return dumps(DATA).encode()
+    fields['id'] = DATA['id']
+    fields['stats'] = DATA['stats']
+    fields['time'] = DATA['time']
+    return dumps(fields).encode()
+
+# the replayed batch is only removed from the spool once the broker has acknowledged it
+spool_ticket = 0
+spool_batch_size = 0
+spool_head = None # where the batch was read from, segments may be evicted while it is in flight
+
+def drain_spool():
+    '''Replays one batch of spooled readings to the data topic, as a JSON list or back to back binary records'''
+    global spool_ticket, spool_batch_size, spool_head
+    if spool_ticket:
+        if not publisher.delivered(spool_ticket):
+            return
+        spool.commit(spool_batch_size, spool_head)
+        spool_ticket = 0
+    if not (DATA['connected_to_wifi'] and publisher.connected and clock_set()) or not spool.pending():
+        return
+    # live readings go first, only replay into a window that has room
+    if publisher.available() <= 0:
+        return
+    spool_head = spool.head()
+    records = [restamp(r) for r in spool.read_batch(SPOOL_BATCH)]
+    if CONFIG['PAYLOAD_FORMAT'] == 'binary':
+        payload = b''.join(records)
+    else:
+        payload = dumps([unpack_record(r) for r in records]).encode()
+    spool_ticket = publisher.publish(data_topic(), payload)
+    spool_batch_size = len(records)
+
+# REPORT BY EXCEPTION
+# In 'exception' mode only fields that moved beyond their deadband are published, with a full snapshot
+# every HEARTBEAT_INTERVAL. Safety flag changes set `alarm`, which publishes immediately.
+report = ReportByException(CONFIG['DEADBANDS'], CONFIG['HEARTBEAT_INTERVAL'])
+alarm = StampedEvent()
+alarm_bits = 0
+
+def send_alarm():
+    '''Publishes a full snapshot as soon as the safety flags change'''
+    report.force()
+    send_data()
+
+def update_data():
+    '''Brings DATA up to date with the readings record, the window statistics, the error states and the energy counters'''
+    readings.export(DATA)
+    for i, channel, table in window_extremes:
+        low = table.convert_scaled(channel.low)
+        high = table.convert_scaled(channel.high)
+        stats.extend(i, min(low, high), max(low, high))
+    window = {}
+    for i in range(len(telemetry.FIELDS)):
+        name, scale = telemetry.FIELDS[i]
+        window[name] = stats.summary(i, scale, STATS_DIGITS)
+    DATA['stats'] = window
+    for i in range(len(ERROR_KEYS)):
+        DATA[ERROR_KEYS[i]] = ERROR_MESSAGES[i] if ERROR_STATES[telemetry.ERRORS[i]] else None
+    energy.fields(DATA)
+
+def new_window():
+    '''Starts the next statistics window'''
+    stats.reset()
+    for i, channel, table in window_extremes:
+        channel.clear_extremes()
+
+# TASK FUNCTIONS
+def send_data():
+    '''used to publish data to the MQTT server. Reconnecting is left to the link task, readings are spooled meanwhile and until the clock is set.'''
+    global DATA, CONFIG
+    update_data()
+    new_window()
     DATA['time'] = getTime()
+    log_state()
     
-    while 1:
-        if DATA['connected_to_wifi']:
-            log_state()
-            client.publish(b"{}".format(CONFIG['MQTT_DATA_TOPIC']), b"{}".format(dumps(DATA)), qos=1)
-            break
-        else:
-            # gc collect
-            collect()
-            do_connect()
-            mqtt_setup(CONFIG['ID'], CONFIG['MQTT_SERVER'], CONFIG['MQTT_UN'], CONFIG['MQTT_PW'], CONFIG['LOG_INTERVAL']/1000 + 60)
-            subscribe_to_control(client, topic = CONFIG['MQTT_CONTROL_TOPIC'])    
+    if not (DATA['connected_to_wifi'] and publisher.connected and clock_set()):
+        spool.append(pack_record())
+        return False
+    fields = None
+    if CONFIG['REPORT_MODE'] == 'exception':
+        fields = report.changes(DATA)
+        if fields is None:
+            return True
+    if not publisher.publish(data_topic(), data_payload(fields)):
+        # window and queue are full, the broker is not keeping up
+        spool.append(pack_record())
+        return False
+    return True
+
+CONTROL_MAX_TTL = 300 # s a signed request may be valid for, tools/control.py signs them for 30
+control_floor = None  # (lowest the unix time can be, ticks then), from the signed requests accepted
+
+def control_expired(expires, now):
+    """
+    True when a signed request's EXPIRES (unix time) is outside the window it could have been sent in: from now
+    to CONTROL_MAX_TTL ahead once the clock is set. Before that it is only bounded from below: a request accepted
+    earlier was sent at most CONTROL_MAX_TTL before its EXPIRES, so the time is now at least that plus the time
+    since, and a request replayed from before then has expired.
+    """
+    if now >= CLOCK_SET:
+        return expires < now or expires > now + CONTROL_MAX_TTL
+    return control_floor is not None and expires < control_floor[0] + ticks_diff(ticks_ms(), control_floor[1]) // 1000
 
-def authenticate_control_config(CONFIG, control_config):
+def authenticate_control_config(CONFIG, control_config, msg = None, shared = False):
     """
     Validates incoming dictionary from broker to ensure that the correct device is being updated.
-    Form of minimal security, using device ID.
+    Messages must carry this device's ID and, once CONFIG['CONTROL_KEY'] is set, a valid signature
+    (libs/auth.py) and an integer EXPIRES in the window of control_expired(); without one a captured request
+    could be replayed for ever. On the shared control topic messages for other devices are ignored quietly,
+    on the device's own request topic they are answered.
     """
-    if 'ID' in control_config.keys():
-        if control_config['ID'] == CONFIG['ID']:
-            sleep(2) # required for mqtt function to complete, as a blocking library is used 
-            return 1
-        else:
-            print("Invalid ID") # publish this to control
-            client.publish(b"{}".format(CONFIG['MQTT_CONTROL_TOPIC']), b"{}".format(dumps({"Invalid ID" : "Please provide correct ID."})), qos=1)
-            sleep(2) # required for mqtt function to complete, as a blocking library is used 
+    global control_floor
+    if control_config.get('ID') != CONFIG['ID']:
+        if shared:
             return 0
-       
-def control_callback(topic, msg):
+        print("Invalid ID") # publish this to control
+        reply = {"Invalid ID" : "Please provide correct ID."}
+        if 'REQUEST_ID' in control_config:
+            reply['REQUEST_ID'] = control_config['REQUEST_ID']
+        publish_control(reply)
+        return 0
+    error = None
+    now = time() + telemetry.EPOCH_OFFSET
+    expires = control_config.get('EXPIRES')
+    if CONFIG['CONTROL_KEY']:
+        from libs.auth import verify # imported with the first command rather than at boot
+        if not verify(msg, CONFIG['CONTROL_KEY']) or not isinstance(expires, int):
+            error = 'UNAUTHORIZED'
+        elif control_expired(expires, now):
+            error = 'EXPIRED'
+        else:
+            floor = expires - CONTROL_MAX_TTL
+            if control_floor is not None:
+                floor = max(floor, control_floor[0] + ticks_diff(ticks_ms(), control_floor[1]) // 1000)
+            control_floor = (floor, ticks_ms())
+    # unsigned, only checked once the clock has been set by NTP
+    elif expires is not None and now > CLOCK_SET and (not isinstance(expires, int) or now > expires):
+        error = 'EXPIRED'
+    if error is not None:
+        print("Control message refused: {}".format(error))
+        reply = {'ERROR' : error}
+        if 'REQUEST_ID' in control_config:
+            reply['REQUEST_ID'] = control_config['REQUEST_ID']
+        publish_control(reply)
+        return 0
+    return 1
+
+# CONTROL COMMANDS
+# Commands arrive on the device's own request topic (and, from older dashboards, on the shared control topic).
+# They are authenticated and queued by control_callback() and handled by the 'commands' task, one message
+# per run (see libs/commands.py). Replies go to the reply topic and carry the message's REQUEST_ID, so the
+# device never receives its own replies and a fleet tool can correlate them (tools/control.py).
+COMMAND_PERIOD = 100 # ms between command queue runs
+reset_requested = False
+
+def publish_control(reply):
+    publisher.publish(CONFIG['MQTT_REPLY_TOPIC'], dumps(reply).encode())
+
+commands = Dispatcher(publish_control, queue = 8, dedup = 16, dedup_window = 30000)
+
+def command_reset():
+    global reset_requested
+    print("RESET command initiated")
+    # the reset itself happens in process_commands(), once the reply has been queued
+    reset_requested = True
+    return "DEVICE RESET"
+
+def command_show_wifi_credentials():
+    print("SHOW_WIFI_CREDENTIALS command initiated")
+    return CONFIG['WIFI_CREDENTIALS']
+
+def command_show_config_file():
     collect()
-    global CONFIG, client, state
-    # decode mqtt mesaage into utf-8
-    control_config = msg.decode('utf-8') # decodes message from broker as text 
-    control_config = loads(control_config) # converts broker message to a dictionary
-    
-    #print(control_config)
-    #print("\n")
-    
-    if authenticate_control_config(CONFIG, control_config): # Enforce that correct ID is in the command coming from the broker
-        for control_key, control_value in control_config.items(): #cycle through control config
-            if control_key == 'COMMAND':
-                if control_value == 'RESET':
-                    collect()
-                    client.publish(b"{}".format(CONFIG['MQTT_CONTROL_TOPIC']), b"{}".format(dumps({"RESET" : "DEVICE RESET"})), qos=1)
-                    print("RESET command initiated")
-                    timer_one.deinit()
-                    timer_two.deinit()
-                    client.disconnect()
-                    sleep(5)
-                    reset()
-                    
-                elif control_value == 'SHOW_WIFI_CREDENTIALS':
-                    collect()
-                    print("SHOW_WIFI_CREDENTIALS command initiated")
-                    client.publish(b"{}".format(CONFIG['MQTT_CONTROL_TOPIC']), b"{}".format(dumps({"SHOW_WIFI_CREDENTIALS" : CONFIG['WIFI_CREDENTIALS']})), qos=1)
-                    sleep(2) # required for mqtt function to complete, as a blocking library is used
+    print("SHOW_CONFIG_FILE command initiated")
+    config = load_config()
+    # the signing key never leaves the device
+    config.pop('CONTROL_KEY', None)
+    return config
+
+def update_wifi_credentials(value):
+    print("WIFI_CREDENTIALS_UPDATE command initiated")
+    result = update_config_file('WIFI_CREDENTIALS', value)
+    save_config()
+    return result
+
+def update_mqtt(value):
+    print("MQTT_CONFIG update initiated")
+    result = update_config_file('MQTT', value)
+    save_config()
+    return result
+
+def update_site_id(value):
+    print("SITE_ID update initiated")
+    result = update_config_file('SITE_ID', value)
+    save_config()
+    return result
+
+def command_stats():
+    print("STATS command initiated")
+    return diagnostics_report()
+
+def update_calibration(value):
+    print("CALIBRATION update initiated")
+    try:
+        check(value)
+    except ValueError as e:
+        return 'CALIBRATION not updated: {}'.format(e)
+    result = update_config_file('CALIBRATION', value)
+    save_config()
+    # the conversion tables are built from it on the next boot
+    return result
+
+commands.command('RESET', command_reset, 'RESET')
+commands.command('SHOW_WIFI_CREDENTIALS', command_show_wifi_credentials, 'SHOW_WIFI_CREDENTIALS')
+commands.command('SHOW_CONFIG_FILE', command_show_config_file, 'SHOW_CONFIG_FILE')
+commands.command('STATS', command_stats, 'STATS')
+commands.update('WIFI_CREDENTIALS', update_wifi_credentials, 'WIFI_CREDENTIALS_UPDATE')
+commands.update('MQTT', update_mqtt, 'MQTT_CONFIG')
+commands.update('SITE_ID', update_site_id, 'SITE_ID_UPDATE')
+commands.update('CALIBRATION', update_calibration, 'CALIBRATION_UPDATE')
+
+def control_callback(topic, msg):
+    '''Runs inside publisher.poll(): only decodes, authenticates and queues the message'''
+    try:
+        control_config = loads(msg.decode('utf-8')) # converts broker message to a dictionary
+    except ValueError:
+        print("Invalid control message")
+        return 0
+    if not isinstance(control_config, dict):
+        print("Invalid control message")
+        return 0
     
-                elif control_value == 'SHOW_CONFIG_FILE':
-                    collect()
-                    print("SHOW_CONFIG_FILE command initiated")
-                    client.publish(b"{}".format(CONFIG['MQTT_CONTROL_TOPIC']), b"{}".format(dumps({"SHOW_CONFIG_FILE" : load_config()})), qos=1) # change to get_wifi_credentials
-                    collect()
-                    sleep(5) # required for mqtt function to complete, as a blocking library is used
-
-                else:
-                    print("Invalid Command")
-                    collect()
-                    return 1
-
-            elif control_key == 'WIFI_CREDENTIALS': # update_config_file
-                collect()
-                print("WIFI_CREDENTIALS_UPDATE command initiated")
-                wifi_message = update_config_file(control_key, control_value)
-                client.publish(b"{}".format(CONFIG['MQTT_CONTROL_TOPIC']), b"{}".format(dumps({"WIFI_CREDENTIALS_UPDATE" : wifi_message})), qos=1)
-                sleep(2)
-
-            elif control_key == 'MQTT':
-                collect()
-                print("MQTT_CONFIG update initiated")
-                mqtt_message = update_config_file(control_key, control_value)
-                client.publish(b"{}".format(CONFIG['MQTT_CONTROL_TOPIC']), b"{}".format(dumps({"MQTT_CONFIG" : mqtt_message})), qos=1)
-                sleep(2)
-
-            elif control_key == 'SITE_ID':
-                print("SITE_ID update initiated")
-                site_id_update_message = update_config_file(control_key, control_value)
-                client.publish(b"{}".format(CONFIG['MQTT_CONTROL_TOPIC']), b"{}".format(dumps({"SITE_ID_UPDATE" : site_id_update_message})), qos=1)
-                sleep(2)
-                
-            elif control_key == 'ID': # fix this
-                collect()
-                print( CONFIG['ID'])
-            
-            else:
-                state = 'get_voltages_and_currents'
-                print("Invalid key used for update")
-    else: # authentication failed or message published from device being caught
-        commands =  ['RESET', 'SHOW_WIFI_CREDENTIALS', 'SHOW_CONFIG_FILE',  'WIFI_CREDENTIALS_UPDATE', 'MQTT_CONFIG', 'SITE_ID_UPDATE']
-        collect()
-        if list(control_config.keys())[0] in commands:
-            print("{} command successful".format(list(control_config.keys())[0]))
-        else:
-            print("Unknown Publish to Control\n")
-            print(control_config)
-        return 0 
-             
+    shared = topic != CONFIG['MQTT_REQUEST_TOPIC'].encode()
+    if authenticate_control_config(CONFIG, control_config, msg, shared): # Enforce that correct ID is in the command coming from the broker
+        commands.submit(control_config)
+        return 1
+    return 0
+
+def process_commands():
+    '''Handles one queued control message'''
+    commands.process()
+    if reset_requested:
+        acquisition.stop()
+        energy_store.save(energy.state(), force = True)
+        # wait for the outstanding acknowledgements (including the RESET reply) rather than a fixed time
+        publisher.flush(5000)
+        if publisher.connected:
+            client.disconnect()
+        reset()
+
 def mqtt_setup(_id, _server, _un, _pw, _keepalivetime):
+    '''
+    Connects the MQTT session. The client is created once and reconnected with a persistent session,
+    so messages that were not acknowledged before a drop are sent again. _keepalivetime is in ms.
+    '''
     global client
-    _keepalivetime = _keepalivetime/1000
+    _keepalivetime = int(_keepalivetime/1000)
     if _keepalivetime < 60:
         _keepalivetime = 60
-        
-    client = MQTTClient( _id, _server,  user=_un, password=_pw, keepalive=0) # assign double the log_interval time so that mqtt server doesn't close the connection between publishes
-    client.connect()
-    client.publish(b"{}".format(CONFIG['MQTT_CONTROL_TOPIC']), b"{}".format(dumps({"HPPC" : "DEVICE RUNNING"})), qos=1)
+    
+    if client is None:
+        client = MQTTClient( _id, _server,  user=_un, password=_pw, keepalive=_keepalivetime)
+        publisher.client = client
+        link.mqtt = client
+    publisher.keepalive = _keepalivetime # the publisher pings after half of this without traffic
+    publisher.connect(clean_session = False)
+    publisher.publish(CONFIG['MQTT_REPLY_TOPIC'], dumps({"HPPC" : "DEVICE RUNNING"}).encode())
     
 def subscribe_to_control(mqtt_client, topic = CONFIG['MQTT_CONTROL_TOPIC']):
-    """This function subscribes to the control topic and sets the appropriate callback function"""
+    """This function subscribes to the device's request topic and the shared control topic and sets the appropriate callback function"""
     mqtt_client.set_callback(control_callback)
-    mqtt_client.subscribe(topic, qos=1)
+    publisher.subscribe(CONFIG['MQTT_REQUEST_TOPIC'], qos=1)
+    publisher.subscribe(topic, qos=1)
 
-def load_reset_interval(timer_two):
+def load_reset_interval():
     global CONFIG, EN_12V, EN_24V_POE
     # switch 12V Load on (or to config state)
     EN_12V = CONFIG['12V_LOAD_ON']
     # switch PoE Load on (or to config state)
     EN_24V_POE = CONFIG['POE_LOAD_ON']
+    # a fault that is still present trips again
+    protection.rearm()
+
+###### COOPERATIVE RUNTIME ######
+# Each concern runs as its own uasyncio task. Raw ADC sampling is already timer driven (see acquisition),
+# so these periods only set how often the filtered values are converted, checked and published.
+SAMPLE_PERIOD = 100     # ms between fetch_data() runs
+MQTT_POLL_PERIOD = 50   # ms between publisher.poll() runs (inbound messages, acknowledgements, pings)
+LINK_PERIOD = 1000      # ms between link supervisor runs
+WDT_FEED_PERIOD = 1000  # ms between watchdog feeds
 
-# Used to verify that execution has reached the beginning of the state control loop 
-blink_debug_led(3)
 DEBUG_STATE = False 
 test_count = 0
+client = None
 
-#set initial state
-states = ['setup', 'get_voltages_and_currents', 'send_data', 'debug']
-state = states[0]
-
-try:
-    # state control loop
-    while 1:
-        # gc collect
-        collect()
-        #await asyncio.sleep_ms(100)
-        # Set the HomePoynt Power Controller up
-        if state == 'setup':
-            while 1:
-                if setup():
-                    state = 'get_voltages_and_currents'
-                    # Initialise Timers
-                    timer_one.init(period = CONFIG['LOG_INTERVAL'], callback=send_data)
-                    timer_two.init(period = CONFIG['LOAD_RESET_INTERVAL'], callback=load_reset_interval)
-                    break
-                else:
-                    pass
-                print("Setup Failed")
-                
-        # Fetches the states from the Homepoynt Power Controller
-        if state == 'get_voltages_and_currents':
-            client.check_msg()
-            while 1:
-                if fetch_data(): #charger = "epever_Tracer2210AN" # defaults to gamistar
-                    state = 'send_data'
-                    break
-                else:
-                    pass
-                    print("get_voltages_and_currents state failed")
-         
-        # Sends the states to the MQTT server 
-        if state == 'send_data':
-            while 1:
-                safety_check()
-                if DEBUG_STATE:
-                    state = 'debug'
-                    break
-                else:
-                    state = 'get_voltages_and_currents'
-                    break
-        
-        if state == 'debug':
-            printDATA()
-            printERROR_STATES()
-            printCONFIG()
-            state = 'get_voltages_and_currents'    
-            
-        if state not in states:
-            # The code should never get here, if it does you have earned a spoiler
-            DATA['scc_load_voltage'] = None
-            DATA['scc_load_current'] = None
-            DATA['battery_voltage'] = None
-            DATA['battery_current'] =  None
-            DATA['solar_voltage'] = None
-            DATA['solar_current'] = None
-            DATA['temperature'] = None
-            DATA['connected_to_wifi'] = None
-            DATA['battery_connected'] = None
-            DATA['panel_connected'] = None
-            DATA['error_message_1'] = "OZARK"
-            DATA['error_message_2'] = "WENDY KILLS HER BROTHER"
-            DATA['error_message_3'] = "RUTH KILLS NEVARO'S NEPHEW"
-            printDATA()
-            break
-        else:
-            #print("Current state var is: {}".format(state))
-            toggle_debug_led()
-            
-except KeyboardInterrupt:
-    timer_one.deinit()
-    timer_two.deinit()
-    client.disconnect()
-    print("CTRL+C PRESSED...script exited")
-    
+# set after every fetch_data(), the safety task waits on it
+sampled = StampedEvent()
+sample_count = 0
+fed_sample_count = 0
+last_feed = ticks_ms()
+
+def sample():
+    global sample_count
+    fetch_data()
+    stats.add(readings.values)
+    energy.update_record(readings.values)
+    sample_count += 1
+    toggle_debug_led()
+    sampled.set()
+    if sample_count == 1 and CONFIG['FAST_BOOT']:
+        # the first reading goes out as soon as the link and the clock allow, not a LOG_INTERVAL after boot
+        send_data()
+
+def checkpoint_energy():
+    energy_store.save(energy.state())
+
+def feed_watchdog():
+    '''Feeds the watchdog only while the sampler is making progress, so a stalled loop still resets the board'''
+    global fed_sample_count, test_count, last_feed
+    if sample_count != fed_sample_count:
+        fed_sample_count = sample_count
+        now = ticks_ms()
+        wdt.feed()
+        diagnostics.fed(WDT_TIMEOUT - ticks_diff(now, last_feed))
+        last_feed = now
+        test_count += 1
+    # once a second is often enough, mem_free() walks the heap's allocation table
+    diagnostics.check_heap()
+
+def poll_control():
+    '''Handles inbound control messages and publish acknowledgements without blocking'''
+    if publisher.poll():
+        link.note_activity()
+
+def connect_mqtt():
+    '''Opens the MQTT session and subscribes to control. Returns False when the broker can't be reached.'''
+    try:
+        # keepalive of double the log interval, so the broker doesn't close the connection between publishes
+        mqtt_setup(CONFIG['ID'], CONFIG['MQTT_GATEWAY'] or CONFIG['MQTT_SERVER'], CONFIG['MQTT_UN'], CONFIG['MQTT_PW'], 2 * CONFIG['LOG_INTERVAL'])
+        subscribe_to_control(client, topic = CONFIG['MQTT_CONTROL_TOPIC'])
+        # the cloud side may have missed changes while the session was down
+        report.force()
+    except OSError:
+        publisher.drop()
+        print("MQTT connection failed...")
+        return False
+    return True
+
+async def supervise_link():
+    '''The only place WiFi and the MQTT session are (re)established'''
+    if not verify_internet_connection():
+        publisher.drop()
+        if not link.wlan.isconnected():
+            await do_connect()
+            # with FAST_BOOT the broker accepting the session proves the link, no ping is sent
+            if CONFIG['FAST_BOOT'] and connect_mqtt():
+                link.note_activity()
+            DATA['connected_to_wifi'] = link.check()
+            # first sync straight away rather than on the clock task's next run
+            sync_clock()
+    if DATA['connected_to_wifi'] and not publisher.connected:
+        connect_mqtt()
+
+# DIAGNOSTICS
+# Each run of fetch_data, safety_check, send_data, control_callback and connect_mqtt (once per (re)connection attempt)
+# is recorded in a fixed size run time histogram (libs/diagnostics.py). safety_check and send_data are the jobs of the
+# safety and publish tasks, which time their runs already, so their histograms are fed from those (see main()) rather
+# than timing them twice; the calls of send_data from sample() and send_alarm() are left out. With the free and lowest
+# free heap, the collections seen, the watchdog margin at the feeds, the task statistics and the publish latency they
+# are published as one compact JSON report every DIAGNOSTICS_INTERVAL on the diagnostics topic, QoS 0 so it never
+# takes a slot of the readings, and returned by the STATS command. Figures are since boot:
+#   timing: {name: [runs, mean us, worst us, runs < 2us, < 4us, ... < 32ms, longer]}
+#   tasks: {name: [runs, worst late ms, mean run us, worst run us]}
+#   heap: [free, lowest free, allocated, collections]    wdt: [margin ms, lowest margin ms]
+#   publish: [acked, last latency ms, worst, mean, retransmits]
+diagnostics = Diagnostics(enabled = CONFIG['DIAGNOSTICS'], mem_free = mem_free, mem_alloc = mem_alloc)
+fetch_data = diagnostics.timed('fetch_data', fetch_data)
+control_callback = diagnostics.timed('control_callback', control_callback)
+connect_mqtt = diagnostics.timed('connect_mqtt', connect_mqtt)
+
+def diagnostics_report():
+    out = diagnostics.report(TASK_STATS, publisher)
+    out['ID'] = CONFIG['ID']
+    return out
+
+def publish_diagnostics():
+    if publisher.connected:
+        publisher.publish(CONFIG['MQTT_DIAGNOSTICS_TOPIC'], dumps(diagnostics_report()).encode(), qos = 0)
+
+def debug():
+    from libs.debug import printDATA, printERROR_STATES, printCONFIG
+    update_data()
+    printDATA(DATA)
+    printERROR_STATES(ERROR_STATES)
+    printCONFIG(CONFIG)
 
+async def main():
+    setup()
+    diagnostics.attach('safety_check', task_stats('safety'))
+    diagnostics.attach('send_data', task_stats('publish'))
+    tasks = [
+        asyncio.create_task(periodic('sample', SAMPLE_PERIOD, sample)),
+        asyncio.create_task(on_event('safety', sampled, safety_check)),
+        asyncio.create_task(periodic('watchdog', WDT_FEED_PERIOD, feed_watchdog)),
+        # joining starts right after the first conversion and safety check rather than a LINK_PERIOD in
+        asyncio.create_task(periodic('link', LINK_PERIOD, supervise_link, first = 2 * SAMPLE_PERIOD)),
+        asyncio.create_task(periodic('clock', CLOCK_PERIOD, sync_clock)),
+        asyncio.create_task(periodic('publish', CONFIG['LOG_INTERVAL'], send_data)),
+        asyncio.create_task(on_event('alarm', alarm, send_alarm)),
+        asyncio.create_task(periodic('spool_drain', SPOOL_DRAIN_PERIOD, drain_spool)),
+        asyncio.create_task(periodic('mqtt_inbound', MQTT_POLL_PERIOD, poll_control)),
+        asyncio.create_task(periodic('commands', COMMAND_PERIOD, process_commands)),
+        asyncio.create_task(periodic('energy_checkpoint', ENERGY_CHECKPOINT_PERIOD, checkpoint_energy)),
+        asyncio.create_task(periodic('load_reset', CONFIG['LOAD_RESET_INTERVAL'], load_reset_interval)),
+        ]
+    if CONFIG['DIAGNOSTICS'] and CONFIG['DIAGNOSTICS_INTERVAL']:
+        tasks.append(asyncio.create_task(periodic('diagnostics', CONFIG['DIAGNOSTICS_INTERVAL'], publish_diagnostics)))
+    if DEBUG_STATE:
+        tasks.append(asyncio.create_task(periodic('debug', CONFIG['LOG_INTERVAL'], debug)))
+    await asyncio.gather(*tasks)
 
+def run():
+    # Used to verify that execution has reached the runtime. A fast boot goes without, the LED toggles with every sample.
+    if not CONFIG['FAST_BOOT']:
+        blink_debug_led(3)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        acquisition.stop()
+        if publisher.connected:
+            client.disconnect()
+        print("CTRL+C PRESSED...script exited")
 
+if __name__ == '__main__':
+    run()
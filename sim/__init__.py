@@ -0,0 +1,72 @@
+'''
+Host-side simulation of the HomePoynt Power Controller hardware.
+Provides stand-ins for the MicroPython modules used by main.py so that firmware code can be
+exercised and benchmarked under CPython.
+'''
+import os
+import sys
+
+# repository root, where main.py lives
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# MicroPython module name -> sim module providing its stand-in
+STAND_INS = {
+    'gc': 'sim.gc',
+    'machine': 'sim.machine',
+    'network': 'sim.network',
+    'ntptime': 'sim.ntptime',
+    'libs.simple': 'sim.mqtt',
+    'libs.uping': 'sim.uping',
+    'libs.power_monitoring': 'sim.power_monitoring',
+    'libs.temperature': 'sim.temperature',
+    'libs.config_proc': 'sim.config_proc',
+    'libs.ticks': 'sim.ticks',
+    }
+
+
+def install(config=None, clock=None):
+    '''
+    Registers the stand-ins in sys.modules so that `import main` works under CPython.
+    `config` entries override the default hppc_config, which is reset on every call.
+    With a sim Clock, ticks, timers, the watchdog, ping, WiFi joins, NTP and a fresh broker all run on it;
+    without one they use real time.
+    Device libs imported before are dropped so that they are imported again against these stand-ins.
+    '''
+    from importlib import import_module
+    for name in list(sys.modules):
+        if name.startswith('libs.') and name not in STAND_INS:
+            del sys.modules[name]
+    for name, stand_in in STAND_INS.items():
+        sys.modules[name] = import_module(stand_in)
+    sys.modules['network'].WLAN.reset_all()
+    sys.modules['network'].WLAN.clock = clock
+    ntptime = sys.modules['ntptime']
+    ntptime.clock = clock
+    ntptime.rtc = None
+    ntptime.fail = 0
+    ntptime.host = 'pool.ntp.org'
+    sys.modules['libs.config_proc'].reset(config)
+    sys.modules['libs.ticks'].clock = clock
+    machine = sys.modules['machine']
+    machine.Timer.clock = clock
+    machine.WDT.clock = clock
+    machine.ADC.clock = clock
+    sys.modules['libs.uping'].ping.clock = clock
+    mqtt = sys.modules['libs.simple']
+    mqtt.MQTTClient.broker = mqtt.Broker(clock=clock)
+
+
+def load_firmware(config=None, flash=None, clock=None):
+    '''
+    Installs the stand-ins and imports a fresh copy of main.py.
+    The working directory is changed to `flash` (a new temporary directory by default), which stands
+    in for the device filesystem.
+    '''
+    import tempfile
+    install(config, clock)
+    os.chdir(flash if flash is not None else tempfile.mkdtemp(prefix='hppc-flash-'))
+    sys.modules.pop('main', None)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from importlib import import_module
+    return import_module('main')
@@ -0,0 +1,63 @@
+'''
+Benchmarks the oversampled acquisition engine against single ADC reads.
+Run from the repository root:  python -m sim.bench_acquisition
+'''
+import math
+import time
+
+from libs.acquisition import Acquisition, BOXCAR, MEDIAN
+from sim.machine import ADC, Pin, Timer
+
+CHANNELS = 7
+NOISE = 12  # ADC codes (1 sigma)
+ROUNDS = 20000
+
+
+def stdev(values):
+    mean = sum(values) / len(values)
+    return math.sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+
+
+def make_adc(pin, level):
+    adc = ADC(Pin(pin), source=lambda n: level, noise=NOISE)
+    adc.width(ADC.WIDTH_13BIT)
+    return adc
+
+
+def bench_throughput(oversample, mode):
+    acq = Acquisition(Timer(2))
+    for pin in range(CHANNELS):
+        acq.add(make_adc(pin, 2000 + 500 * pin), oversample, mode)
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        acq.sample_all()
+    elapsed = time.perf_counter() - start
+    return ROUNDS * CHANNELS / elapsed
+
+
+def bench_noise(oversample, mode):
+    adc = make_adc(0, 4000)
+    raw = [adc.read() for i in range(ROUNDS // 4)]
+    acq = Acquisition(Timer(2))
+    channel = acq.add(make_adc(0, 4000), oversample, mode)
+    filtered = []
+    for i in range(ROUNDS):
+        acq.sample_all()
+        if channel.index == 0:
+            filtered.append(channel.read())
+    return stdev(raw), stdev(filtered)
+
+
+def main():
+    print('{:>8} {:>10} {:>16} {:>10} {:>10} {:>8}'.format(
+        'filter', 'oversample', 'samples/s', 'raw sd', 'filt sd', 'gain'))
+    for mode, name in ((BOXCAR, 'boxcar'), (MEDIAN, 'median')):
+        for oversample in (1, 4, 16, 64):
+            rate = bench_throughput(oversample, mode)
+            raw_sd, filt_sd = bench_noise(oversample, mode)
+            print('{:>8} {:>10} {:>16.0f} {:>10.2f} {:>10.2f} {:>8.2f}'.format(
+                name, oversample, rate, raw_sd, filt_sd, raw_sd / filt_sd if filt_sd else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
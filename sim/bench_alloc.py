@@ -0,0 +1,75 @@
+'''
+Heap allocations of the firmware's periodic jobs, measured with tracemalloc under the simulator.
+The firmware first runs for a few virtual seconds so the WiFi and MQTT session are up, then every job
+is called RUNS times with the clock moved on by its period in between. For each call the report gives
+the heap high water mark above the level before the call (transient) and what the call left
+allocated (retained), less what measuring an empty job costs.
+This is CPython's heap, not MicroPython's: strings, bytes, dictionaries and lists are counted much
+the same, but floats come from a free list that bypasses tracemalloc (every float is a heap object
+on the device) while integers above 256 are heap objects here and not on the device. Per job figures
+of a few dozen bytes are within that difference, and so is most of the sample job's: the integer sums
+of the energy counters (libs/energy.py update_record()), small integers on the device, see
+sim.bench_energy.
+Run from the repository root:  python -m sim.bench_alloc [runs]
+'''
+import sys
+import tracemalloc
+
+from sim.bench_firmware import waveforms
+from sim.runtime import run_firmware
+
+RUNS = 500
+
+
+def jobs(firmware):
+    # task name, period ms, job; the same jobs main() schedules
+    return (
+        ('sample', firmware.SAMPLE_PERIOD, firmware.sample),
+        ('safety', firmware.SAMPLE_PERIOD, firmware.safety_check),
+        ('mqtt_inbound', firmware.MQTT_POLL_PERIOD, firmware.poll_control),
+        ('commands', firmware.COMMAND_PERIOD, firmware.process_commands),
+        ('watchdog', firmware.WDT_FEED_PERIOD, firmware.feed_watchdog),
+        ('publish', firmware.CONFIG['LOG_INTERVAL'], firmware.send_data),
+        )
+
+
+def measure(clock, period, job, runs, overhead=0):
+    transient = worst = retained = 0
+    for i in range(runs):
+        clock.advance(period)
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        job()
+        current, peak = tracemalloc.get_traced_memory()
+        transient += peak - before - overhead
+        worst = max(worst, peak - before - overhead)
+        retained += current - before
+    return transient / runs, worst, retained / runs
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    run = run_firmware(10000, {'LOG_INTERVAL': 5000}, prepare=lambda fw, clock, broker: waveforms(fw))
+    firmware = run.firmware
+    # run_firmware stops the acquisition timer on the way out, which is left off: the filtered
+    # values keep their last readings and the clock can be moved on without a timer firing every ms
+    tracemalloc.start()
+    print('{:<14} {:>8} {:>16} {:>14} {:>16}'.format('job', 'runs', 'transient B/run', 'worst B/run', 'retained B/run'))
+    total = 0
+    for name, period, job in jobs(firmware):
+        # a few unmeasured calls first, caches and lazily built objects are not per run costs
+        measure(run.clock, period, job, 5)
+        overhead = measure(run.clock, period, lambda: None, 5)[1]
+        mean, worst, retained = measure(run.clock, period, job, runs, overhead)
+        total += mean * 1000 / period
+        print('{:<14} {:>8} {:>16.1f} {:>14} {:>16.1f}'.format(name, runs, mean, worst, retained))
+    tracemalloc.stop()
+    print('transient heap use of the periodic jobs: {:.0f} B/s'.format(total))
+    threshold = sys.modules['gc'].threshold()
+    if threshold > 0:
+        print('setup() set the collection threshold to {} B, about one collection every {:.0f} s'.format(
+            threshold, threshold / total if total else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+'''
+Boot benchmark: runs the unmodified firmware from power on (sim/runtime.py with boot=True, so importing
+main.py and its libs costs virtual time too) and reports
+    TTFM  time to the first measurement (first conversion) and to the first safety check
+    WiFi  time until the link task has joined an access point
+    clock time until NTP has set the clock
+    MQTT  time until the MQTT session is up (commands are accepted)
+    TTFP  time to the first telemetry publish, and how far that reading's timestamp is off
+Joining an access point takes ASSOCIATE ms, plus SEARCH ms when the driver has to look for it on every
+channel, and a scan blocks for SCAN ms (sim/network.py). The RTC starts unset after a power cycle and
+keeps its time through a watchdog reset (sim/ntptime.py). Scenarios run in order on the same flash, so
+later boots find what earlier ones left there, as on a real board.
+Run from the repository root:  python -m sim.bench_boot [cpu_scale]
+'''
+import shutil
+import sys
+import tempfile
+
+import sim
+from libs import telemetry
+from sim.runtime import run_firmware
+from sim.bench_firmware import waveforms
+
+DURATION = 30000    # virtual ms per boot
+CPU_SCALE = 20      # rough ESP32-S3 MicroPython slowdown against a desktop CPython
+ASSOCIATE = 700     # ms
+SEARCH = 2200       # ms
+SCAN = 2200         # ms
+LATENCY = 20        # broker round trip, ms
+
+ONE_SITE = {'SIM_SITE': ['sim-ssid', 'sim-password']}
+# only the last profile is in range
+THREE_SITES = {'WORKSHOP': ['workshop', 'workshop-password'], 'OFFICE': ['office', 'office-password'],
+               'SIM_SITE': ['sim-ssid', 'sim-password']}
+
+SCENARIOS = (
+    # name, WiFi profiles, FAST_BOOT, RTC kept its time, NTP failures, new flash
+    ('first boot', ONE_SITE, True, False, 0, True),
+    ('power cycle', ONE_SITE, True, False, 0, False),
+    ('watchdog reset', ONE_SITE, True, True, 0, False),
+    ('NTP fails 3 times', ONE_SITE, True, False, 3, False),
+    ('3 profiles, first boot', THREE_SITES, True, False, 0, True),
+    ('3 profiles, power cycle', THREE_SITES, True, False, 0, False),
+    ('FAST_BOOT off', THREE_SITES, False, False, 0, True),
+    )
+
+
+class Probe:
+    '''Virtual times of the boot milestones, taken by wrapping firmware functions'''
+    def __init__(self, firmware, clock, broker):
+        self.clock = clock
+        self.first_sample = None
+        self.first_safety = None
+        self.wifi = None
+        self.mqtt = None
+        self.clock_set = None
+        self.first_reading = None   # when the reading that is published first was taken
+        self.publish = None
+        self.stamp_error = None
+        self.rtc = sim.ntptime.rtc
+        if firmware.clock_set():
+            self.clock_set = 0
+        sample, safety, connect, sync = firmware.sample, firmware.safety_check, firmware.do_connect, firmware.sync_clock
+        connect_mqtt, send_data = firmware.connect_mqtt, firmware.send_data
+
+        def first_sample():
+            sample()
+            if self.first_sample is None:
+                self.first_sample = clock.now
+
+        def first_safety():
+            safety()
+            if self.first_safety is None:
+                self.first_safety = clock.now
+
+        async def do_connect():
+            await connect()
+            if self.wifi is None:
+                self.wifi = clock.now
+
+        def first_connect_mqtt():
+            connected = connect_mqtt()
+            if self.mqtt is None and connected:
+                self.mqtt = clock.now
+            return connected
+
+        def first_send_data():
+            if self.first_reading is None:
+                self.first_reading = clock.now
+            return send_data()
+
+        def sync_clock():
+            synced = sync()
+            if self.clock_set is None and firmware.clock_set():
+                self.clock_set = clock.now
+            return synced
+
+        firmware.sample = first_sample
+        firmware.safety_check = first_safety
+        firmware.do_connect = do_connect
+        firmware.sync_clock = sync_clock
+        firmware.connect_mqtt = first_connect_mqtt
+        firmware.send_data = first_send_data
+        broker.listen(firmware.data_topic().decode(), self.on_data)
+
+    def on_data(self, topic, msg):
+        if self.publish is not None:
+            return
+        self.publish = self.clock.now
+        # the oldest record published is the first reading, wherever it was spooled
+        t = telemetry.decode_batch(msg)[0]['time'] - telemetry.EPOCH_OFFSET
+        self.stamp_error = t - (self.rtc.epoch + self.first_reading / 1000)
+
+
+def boot(name, profiles, fast, rtc_kept, ntp_failures, flash, cpu_scale):
+    probes = []
+
+    def prepare(firmware, clock, broker):
+        wlan = firmware.link.wlan
+        wlan.associate_time = ASSOCIATE
+        wlan.search_time = SEARCH
+        wlan.scan_time = SCAN
+        ntptime = sim.ntptime
+        ntptime.rtc = ntptime.RTC(clock, kept=rtc_kept)
+        ntptime.fail = ntp_failures
+        firmware.time = ntptime.rtc.time
+        firmware.sleep = lambda s: clock.advance(s * 1000)
+        waveforms(firmware)
+        probes.append(Probe(firmware, clock, broker))
+        # what run() does before main()
+        if not firmware.CONFIG['FAST_BOOT']:
+            firmware.blink_debug_led(3)
+
+    config = {'WIFI_CREDENTIALS': profiles, 'FAST_BOOT': fast, 'PAYLOAD_FORMAT': 'binary', 'LOG_INTERVAL': 10000}
+    run = run_firmware(DURATION, config, cpu_scale=cpu_scale, latency=LATENCY, prepare=prepare, flash=flash, boot=True)
+    return probes[0], run
+
+
+def ms(t):
+    return '{:>7.0f}'.format(t) if t is not None else '      -'
+
+
+def main():
+    cpu_scale = float(sys.argv[1]) if len(sys.argv) > 1 else CPU_SCALE
+    print('{:<26} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7}'.format(
+        'boot (virtual ms)', 'TTFM', 'safety', 'WiFi', 'MQTT', 'clock', 'TTFP', 'stamp s', 'scans'))
+    flash = None
+    try:
+        for name, profiles, fast, rtc_kept, ntp_failures, new_flash in SCENARIOS:
+            if new_flash:
+                if flash is not None:
+                    shutil.rmtree(flash, ignore_errors=True)
+                flash = tempfile.mkdtemp(prefix='hppc-flash-')
+            probe, run = boot(name, profiles, fast, rtc_kept, ntp_failures, flash, cpu_scale)
+            error = '{:>7.1f}'.format(probe.stamp_error) if probe.stamp_error is not None else '      -'
+            print('{:<26} {} {} {} {} {} {} {} {:>7}'.format(
+                name, ms(probe.first_sample), ms(probe.first_safety), ms(probe.wifi), ms(probe.mqtt), ms(probe.clock_set),
+                ms(probe.publish), error, run.firmware.link.wlan.scans))
+    finally:
+        if flash is not None:
+            shutil.rmtree(flash, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+'''
+Batch calibration (tools/calibrate.py) of a simulated production run.
+Every board's six channels deviate from the nominal conversions in the firmware (the sim stand-ins of
+libs/power_monitoring.py) by a gain and offset error and an ADC bow, and are recorded at SAMPLES codes
+against a reference meter with a little noise. The dataset goes through the tool as a CSV file.
+Reports the fit time of the batched solve against fitting one series at a time, then builds the
+firmware's conversion tables (libs/lut.py) from the fitted profiles for some boards and compares their
+readings with the truth over the operating range, against the nominal conversion. Finally loads the
+firmware with a fitted profile in its config file and checks that its tables and protection thresholds
+follow it, and that malformed profiles are refused. Exits with status 1 when a check fails.
+Run from the repository root:  python -m sim.bench_calibration [boards]
+'''
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import sim
+from libs.acquisition import Channel
+from libs.calibration import calibrated
+from libs.lut import ConversionTable, CODES
+from sim.machine import ADC, Pin
+from tools.calibrate import Dataset, fit, model
+
+BOARDS = 1000
+SAMPLES = 40        # codes recorded per board and reading
+CHECKED = 50        # boards whose tables are built and compared with the truth
+MODELS = ('poly1', 'poly2', 'poly3', 'pwl9')
+CHARGER = 'gamistar'
+
+# reading: (table scale, operating range) as fetch_data() converts it
+READINGS = {
+    'scc_load_voltage': (100, (18.0, 30.0)),
+    'scc_load_current': (1000, (0.0, 5.0)),
+    'battery_voltage': (100, (18.0, 30.0)),
+    'battery_current': (1000, (-5.0, 5.0)),
+    'solar_voltage': (100, (0.0, 15.0)),
+    'solar_current': (1000, (0.0, 5.0)),
+    }
+
+
+def nominal_conversions(firmware):
+    '''reading -> the firmware's nominal conversion of every code, and its table'''
+    f = firmware
+    sources = {
+        'scc_load_voltage': (f.load_voltage_ch, f.load_voltage.get_voltage, f.load_voltage_table),
+        'scc_load_current': (f.load_current_ch, f.load_current.get_current, f.load_current_table),
+        'battery_voltage': (f.battery_voltage_ch, f.battery_voltage.get_voltage, f.battery_voltage_table),
+        'battery_current': (f.battery_current_ch, f.battery_current.get_current, f.battery_current_table),
+        'solar_voltage': (f.panel_voltage_ch, lambda: f.get_panel_rise(f.panel_voltage), f.panel_rise_table),
+        'solar_current': (f.panel_current_ch, f.panel_current.get_current, f.panel_current_table),
+        }
+    out = {}
+    for name, (channel, convert, table) in sources.items():
+        saved = channel.value
+        values = []
+        for code in range(CODES):
+            channel.value = code
+            values.append(convert())
+        channel.value = saved
+        out[name] = (np.array(values), table)
+    return out
+
+
+def production_run(nominal, boards, rng):
+    '''(truth[reading] as (boards, CODES), operating codes[reading], dataset columns)'''
+    truth = {}
+    operating = {}
+    columns = {'board': [], 'reading': [], 'code': [], 'reference': []}
+    x = np.arange(CODES) / (CODES - 1)
+    for name in READINGS:
+        values = nominal[name][0]
+        low, high = READINGS[name][1]
+        codes = np.flatnonzero((values >= low) & (values <= high))
+        operating[name] = codes
+        span = high - low
+        gain = rng.normal(0, 0.015, (boards, 1))
+        offset = rng.normal(0, 0.01 * span, (boards, 1))
+        bow = rng.normal(0, 0.005 * span, (boards, 1))
+        truth[name] = values * (1 + gain) + offset + bow * 4 * x * (1 - x)
+        recorded = rng.integers(codes.min(), codes.max() + 1, (boards, SAMPLES))
+        reference = np.take_along_axis(truth[name], recorded, 1) + rng.normal(0, 0.0005 * span, recorded.shape)
+        columns['board'].append(np.repeat(np.arange(boards), SAMPLES))
+        columns['reading'] += [name] * (boards * SAMPLES)
+        columns['code'].append(recorded.ravel())
+        columns['reference'].append(reference.ravel())
+    return truth, operating, columns
+
+
+def write_csv(path, columns):
+    board = np.concatenate(columns['board'])
+    code = np.concatenate(columns['code'])
+    reference = np.concatenate(columns['reference'])
+    with open(path, 'w') as f:
+        f.write('board,reading,code,reference\n')
+        for i in range(len(board)):
+            f.write('HPPC-{:05d},{},{},{:.5f}\n'.format(board[i], columns['reading'][i], code[i], reference[i]))
+
+
+def fit_one_at_a_time(dataset, name):
+    '''The same fits with a NumPy call per series, as a script would loop over boards'''
+    group, n = dataset.groups()
+    order = np.argsort(group, kind='stable')
+    bounds = np.searchsorted(group[order], np.arange(n + 1))
+    fitted = model(name)
+    for g in range(n):
+        rows = order[bounds[g]:bounds[g + 1]]
+        code = dataset.code[rows]
+        reference = dataset.reference[rows]
+        if name.startswith('poly'):
+            np.polyfit(code / (CODES - 1), reference, fitted.degree)
+        else:
+            knots = np.linspace(code.min(), code.max(), fitted.points)
+            t = np.clip((code - knots[0]) / (knots[1] - knots[0]), 0, fitted.points - 1 - 1e-9)
+            i = t.astype(int)
+            basis = np.zeros((len(code), fitted.points))
+            basis[np.arange(len(code)), i] = 1 - (t - i)
+            basis[np.arange(len(code)), i + 1] = t - i
+            np.linalg.lstsq(basis, reference, rcond=None)
+
+
+def table_errors(channel, nominal, truth, operating, profiles, boards):
+    '''reading -> (nominal errors, calibrated errors) of the firmware tables over the operating codes'''
+    errors = {}
+    for name, (scale, limits) in READINGS.items():
+        codes = operating[name]
+        table = nominal[name][1]
+        before = []
+        after = []
+        for b in range(boards):
+            board = 'HPPC-{:05d}'.format(b)
+            exact = truth[name][b, codes]
+            before.append(np.array([table.convert(int(c)) for c in codes]) - exact)
+            spec = profiles.get(board, {}).get(name)
+            if spec is None:
+                after.append(before[-1])
+                continue
+            calibrated_table = ConversionTable.build(channel, calibrated(channel, name, spec), step=table.step, scale=scale)
+            after.append(np.array([calibrated_table.convert(int(c)) for c in codes]) - exact)
+        errors[name] = (np.concatenate(before), np.concatenate(after))
+    return errors
+
+
+def check_firmware(profile):
+    '''The firmware builds its tables and thresholds from the profile in its config file'''
+    ok = True
+    plain = sim.load_firmware()
+    plain.setup()
+    firmware = sim.load_firmware({'CALIBRATION': {CHARGER: profile}})
+    firmware.setup()
+    channel = firmware.battery_voltage_ch
+    expected = ConversionTable.build(channel, calibrated(channel, 'battery_voltage', profile['battery_voltage']), step=firmware.READING_LUT_STEP, scale=100)
+    if list(firmware.battery_voltage_table.table) != list(expected.table):
+        print('firmware battery voltage table does not follow the profile')
+        ok = False
+    thresholds = (firmware.protection.load_v_max, firmware.protection.batt_v_max)
+    print('firmware: load over voltage trips at code {} (nominal {}), battery over voltage at {} (nominal {})'.format(
+        thresholds[0], plain.protection.load_v_max, thresholds[1], plain.protection.batt_v_max))
+    if thresholds == (plain.protection.load_v_max, plain.protection.batt_v_max):
+        print('firmware protection thresholds ignore the profile')
+        ok = False
+    # a broken entry is refused by the update command and ignored at boot
+    reply = firmware.update_calibration({CHARGER: {'battery_voltage': {'poly': [30, -0.01]}}})
+    print('firmware: falling battery voltage calibration -> {!r}'.format(reply))
+    if 'not updated' not in reply:
+        ok = False
+    broken = sim.load_firmware({'CALIBRATION': {CHARGER: {'battery_voltage': {'points': [[100, 1.0]]}}}})
+    broken.setup()
+    if list(broken.battery_voltage_table.table) != list(plain.battery_voltage_table.table):
+        print('firmware did not fall back to the nominal conversion')
+        ok = False
+    return ok
+
+
+def main():
+    boards = int(sys.argv[1]) if len(sys.argv) > 1 else BOARDS
+    rng = np.random.default_rng(1)
+    firmware = sim.load_firmware()
+    firmware.setup()
+    nominal = nominal_conversions(firmware)
+    truth, operating, columns = production_run(nominal, boards, rng)
+    path = os.path.join(tempfile.mkdtemp(prefix='hppc-calibration-'), 'dataset.csv')
+    write_csv(path, columns)
+    start = time.perf_counter()
+    dataset = Dataset.load(path)
+    parse = time.perf_counter() - start
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+    print('{} boards x {} readings x {} samples, CSV parsed in {:.0f} ms'.format(
+        boards, len(READINGS), SAMPLES, parse * 1000))
+    channel = Channel(ADC(Pin(7)))
+    checked = min(CHECKED, boards)
+    print('{:<7} {:>10} {:>14} {:>8} {:>9} {:>7} | error over the operating range, {} boards: rms (max)'.format(
+        'model', 'batched ms', 'one by one ms', 'speedup', 'checked ms', 'usable', checked))
+    ok = True
+    results = {}
+    group, n = dataset.groups()
+    for name in MODELS:
+        # the solve alone, as the loop below only solves
+        start = time.perf_counter()
+        model(name).fit(group, n, dataset.code, dataset.reference)
+        batched = time.perf_counter() - start
+        # and with the residuals and monotonic checks of every series
+        start = time.perf_counter()
+        result = fit(dataset, name)
+        checked_fit = time.perf_counter() - start
+        start = time.perf_counter()
+        fit_one_at_a_time(dataset, name)
+        looped = time.perf_counter() - start
+        profiles = result.profiles()
+        errors = table_errors(channel, nominal, truth, operating, profiles, checked)
+        results[name] = (errors, profiles)
+        usable = int(result.usable().sum())
+        print('{:<7} {:>10.1f} {:>14.1f} {:>7.0f}x {:>9.1f} {:>7} | {}'.format(
+            name, batched * 1000, looped * 1000, looped / batched, checked_fit * 1000, usable,
+            '  '.join('{} {:.3f} ({:.3f})'.format(n.split('_')[-2][0] + n.split('_')[-1][0], np.sqrt(np.mean(a ** 2)), np.abs(a).max())
+                      for n, (b, a) in errors.items())))
+        # a series is only left out when its fit turns back outside the recorded codes
+        if usable < 0.99 * boards * len(READINGS) or any(np.abs(a).max() > np.abs(b).max() for b, a in errors.values()):
+            ok = False
+    errors = results[MODELS[0]][0]
+    print('{:<7} {:>10} {:>14} {:>8} {:>9} {:>7} | {}'.format(
+        'nominal', '', '', '', '', '',
+        '  '.join('{} {:.3f} ({:.3f})'.format(n.split('_')[-2][0] + n.split('_')[-1][0], np.sqrt(np.mean(b ** 2)), np.abs(b).max())
+                  for n, (b, a) in errors.items())))
+    print('(lv load voltage, lc load current, bv battery voltage, bc battery current, sv solar rise, sc solar current; V and A)')
+    profile = results['poly2'][1]['HPPC-00000']
+    print('profile of HPPC-00000: {}'.format(json.dumps({'battery_voltage': profile['battery_voltage']})))
+    ok = check_firmware(profile) and ok
+    if not ok:
+        print('CHECK FAILED')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
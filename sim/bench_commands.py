@@ -0,0 +1,113 @@
+'''
+Sends pipelined control messages (with repeats) to the firmware and reports how long each
+MQTT poll and command run took, per-command latency and whether every reply was correlated.
+Then checks that a dashboard without REQUEST_IDs gets an answer every time it repeats a command, and
+that a handler that raises is answered with HANDLER_FAILED without stopping the commands after it.
+Run from the repository root:  python -m sim.bench_commands
+'''
+import json
+import sys
+import time
+
+import sim
+
+REQUESTS = 40
+REPEATS = 10  # of those, re-sent with the same REQUEST_ID
+WINDOW = 4    # requests the dashboard keeps outstanding
+COMMANDS = ({'COMMAND': 'SHOW_WIFI_CREDENTIALS'}, {'COMMAND': 'SHOW_CONFIG_FILE'},
+            {'SITE_ID': ['SITE-BENCH']}, {'COMMAND': 'NOT_A_COMMAND'})
+
+
+def main():
+    firmware = sim.load_firmware()
+    broker = sim.mqtt.Broker()
+    sim.mqtt.MQTTClient.broker = broker
+    firmware.DATA['connected_to_wifi'] = True
+    firmware.mqtt_setup(firmware.CONFIG['ID'], '127.0.0.1', None, None, 60000)
+    firmware.subscribe_to_control(firmware.client)
+    topic = firmware.CONFIG['MQTT_REQUEST_TOPIC']
+    replies = {}
+    sent = []
+
+    def send(i):
+        message = dict(COMMANDS[i % len(COMMANDS)], ID=firmware.CONFIG['ID'], REQUEST_ID='req-{}'.format(i))
+        sent.append(i)
+        broker.inject(topic, json.dumps(message))
+        if i < REPEATS:
+            # e.g. a dashboard retry that crossed the reply
+            broker.inject(topic, json.dumps(message))
+
+    def on_reply(topic, msg):
+        reply = json.loads(msg)
+        if 'REQUEST_ID' in reply:
+            replies.setdefault(reply['REQUEST_ID'], []).append(reply)
+            if len(sent) < REQUESTS:
+                send(len(sent))
+    broker.listen(firmware.CONFIG['MQTT_REPLY_TOPIC'], on_reply)
+
+    # the dashboard keeps WINDOW requests outstanding
+    for i in range(WINDOW):
+        send(i)
+
+    worst_poll = worst_run = 0
+    start = time.perf_counter()
+    while True:
+        t = time.perf_counter()
+        firmware.poll_control()
+        worst_poll = max(worst_poll, time.perf_counter() - t)
+        t = time.perf_counter()
+        ran = firmware.commands.process()
+        worst_run = max(worst_run, time.perf_counter() - t)
+        if not ran and not firmware.commands.pending() and firmware.publisher.pending() == 0:
+            break
+    elapsed = time.perf_counter() - start
+
+    dispatcher = firmware.commands
+    print('{} requests + {} repeats handled in {:.1f} ms; worst poll {:.0f} us, worst command run {:.0f} us'.format(
+        REQUESTS, REPEATS, elapsed * 1000, worst_poll * 1e6, worst_run * 1e6))
+    print('queue full: {}, unknown: {}, failed: {}'.format(dispatcher.rejected, dispatcher.unknown, dispatcher.failed))
+    for name in sorted(dispatcher.stats):
+        print('    {!r}'.format(dispatcher.stats[name]))
+    answered = [rid for rid in replies if len(replies[rid]) == 1]
+    busy = [rid for rid in replies if replies[rid][0].get('ERROR') == 'BUSY']
+    print('replies: {} correlated, {} busy, {} requests without a reply, {} replies refused by the publisher'.format(
+        len(answered) - len(busy), len(busy), REQUESTS - len(replies), firmware.publisher.refused))
+
+    # a legacy dashboard repeats a command within the dedup window, both are answered
+    legacy = []
+    broker.listen(firmware.CONFIG['MQTT_REPLY_TOPIC'], lambda topic, msg: legacy.append(json.loads(msg)))
+    for i in range(2):
+        broker.inject(topic, json.dumps({'COMMAND': 'SHOW_CONFIG_FILE', 'ID': firmware.CONFIG['ID']}))
+        firmware.poll_control()
+        firmware.commands.process()
+    while firmware.publisher.pending():
+        firmware.poll_control()
+    answered = len([r for r in legacy if 'SHOW_CONFIG_FILE' in r])
+    print('repeated command without REQUEST_ID: {} of 2 answered'.format(answered))
+    failed = []
+    if answered != 2:
+        failed.append('{} of 2 repeated commands without REQUEST_ID answered'.format(answered))
+
+    # a handler that raises is answered, the next message still runs
+    def broken():
+        raise OSError(5)
+    dispatcher.command('BROKEN', broken, 'BROKEN')
+    del legacy[:]
+    broker.inject(topic, json.dumps({'COMMAND': 'BROKEN', 'ID': firmware.CONFIG['ID'], 'REQUEST_ID': 'broken'}))
+    broker.inject(topic, json.dumps({'COMMAND': 'SHOW_CONFIG_FILE', 'ID': firmware.CONFIG['ID'], 'REQUEST_ID': 'after'}))
+    firmware.poll_control()
+    while firmware.commands.process() or firmware.publisher.pending():
+        firmware.poll_control()
+    print('raising handler: {}, failed: {}'.format(legacy, dispatcher.failed))
+    if legacy[:1] != [{'ERROR': 'HANDLER_FAILED', 'COMMAND': 'BROKEN', 'REQUEST_ID': 'broken'}] or \
+            [r.get('REQUEST_ID') for r in legacy[1:]] != ['after'] or dispatcher.failed != 1:
+        failed.append('raising handler replies {!r}, {} failed'.format(legacy, dispatcher.failed))
+
+    for failure in failed:
+        print('CHECK FAILED: {}'.format(failure))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
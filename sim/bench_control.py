@@ -0,0 +1,210 @@
+'''
+Fan-out throughput of the fleet control plane (tools/control.py) against a simulated fleet.
+The tool connects over a loopback TCP bridge to the in-process broker (sim/mqtt.py). The fleet is the
+firmware itself plus N emulated devices, each with the firmware's dispatcher (libs/commands.py) and
+signature check (libs/auth.py) answering after up to one COMMAND_PERIOD. Some devices are offline,
+some lose the first request and some lose their first reply, so timeouts, retries and the reply cache
+are all exercised. Every request is signed.
+Reports replies/s and reply latency per in-flight window, checks that no command ran twice and that
+the firmware refuses forged and expired requests, signed ones without an EXPIRES or valid for longer than
+CONTROL_MAX_TTL, and, before its clock is set, replays older than a request it already accepted.
+Exits with status 1 when a check fails.
+Run from the repository root:  python -m sim.bench_control [devices] [window,window,...]
+'''
+import asyncio
+import json
+import random
+import sys
+import time
+
+import sim
+from libs.auth import device_key, sign, verify
+from sim.mqtt import Broker, TCPBridge
+from tools.control import ControlPlane, summary
+from tools.mqtt import Connection
+
+DEVICES = 2000
+WINDOWS = (32, 256, 1024)
+FLEET_KEY = 'bench-fleet-key'
+COMMAND_PERIOD = 0.1    # s, a device handles its queue every COMMAND_PERIOD
+OFFLINE = 0.01          # fraction of devices that never answer
+LOST_REQUEST = 0.03     # fraction that miss the first request
+LOST_REPLY = 0.03       # fraction whose first reply is lost
+TIMEOUT = 1.0
+RETRIES = 2
+
+
+class Device:
+    '''A device's control path: request topic, ID and signature check, dispatcher, reply topic'''
+    def __init__(self, firmware, device_id, broker, rng):
+        self.id = device_id
+        self.broker = broker
+        self.key = device_key(FLEET_KEY, device_id)
+        self.reply_topic = 'hppc/control/{}/reply'.format(device_id)
+        self.site = None
+        self.runs = 0
+        self.roll = rng.random()
+        self.offline = self.roll < OFFLINE
+        self.arm()
+        self.delay = rng.random() * COMMAND_PERIOD
+        self.commands = firmware.Dispatcher(self.publish, queue=8, dedup=16, dedup_window=30000)
+        self.commands.update('SITE_ID', self.update_site_id, 'SITE_ID_UPDATE')
+        broker.listen('hppc/control/{}/request'.format(device_id), self.on_request)
+
+    def arm(self):
+        '''Sets up this round's lost request or reply'''
+        self.runs = 0
+        self.lose_request = OFFLINE <= self.roll < OFFLINE + LOST_REQUEST
+        self.lose_reply = OFFLINE + LOST_REQUEST <= self.roll < OFFLINE + LOST_REQUEST + LOST_REPLY
+
+    def update_site_id(self, value):
+        self.runs += 1
+        self.site = value
+        return 'SITE_ID updated'
+
+    def publish(self, reply):
+        if self.lose_reply:
+            self.lose_reply = False
+            return
+        self.broker.publish(self.id, self.reply_topic, json.dumps(reply))
+
+    def on_request(self, topic, msg):
+        if self.offline:
+            return
+        if self.lose_request:
+            self.lose_request = False
+            return
+        message = json.loads(msg)
+        if message.get('ID') != self.id or not verify(msg, self.key):
+            return
+        if self.commands.submit(message):
+            asyncio.get_running_loop().call_later(self.delay, self.commands.process)
+
+
+def firmware_device(broker):
+    '''The firmware, connected to the broker, its control path polled every COMMAND_PERIOD'''
+    firmware = sim.load_firmware({'ID': 'HPPC-SIM-0000', 'CONTROL_KEY': device_key(FLEET_KEY, 'HPPC-SIM-0000')})
+    sim.mqtt.MQTTClient.broker = broker
+    firmware.DATA['connected_to_wifi'] = True
+    firmware.mqtt_setup(firmware.CONFIG['ID'], '127.0.0.1', None, None, 60000)
+    firmware.subscribe_to_control(firmware.client)
+
+    async def poll():
+        while True:
+            firmware.poll_control()
+            firmware.process_commands()
+            await asyncio.sleep(COMMAND_PERIOD / 10)
+    return firmware, asyncio.ensure_future(poll())
+
+
+def refusals(firmware):
+    '''Replies of the firmware's signature and EXPIRES check to signed requests, called directly'''
+    key = firmware.CONFIG['CONTROL_KEY']
+    replies = []
+    publish, clock = firmware.publish_control, firmware.time
+
+    def check(request_id, expires=None):
+        message = {'ID': firmware.CONFIG['ID'], 'REQUEST_ID': request_id, 'COMMAND': 'SHOW_CONFIG_FILE'}
+        if expires is not None:
+            message['EXPIRES'] = expires
+        message['SIG'] = ''
+        msg = sign(json.dumps(message).encode(), key)
+        if firmware.authenticate_control_config(firmware.CONFIG, json.loads(msg), msg):
+            replies.append((request_id, None))
+    firmware.publish_control = lambda reply: replies.append((reply.get('REQUEST_ID'), reply['ERROR']))
+    try:
+        check('no-expires')
+        # the firmware's clock is the host's: set
+        check('float-expires', time.time() + 30)
+        # before NTP the clock counts from 2000, seconds since boot
+        booted = 100 - firmware.telemetry.EPOCH_OFFSET
+        firmware.time = lambda: booted
+        firmware.control_floor = None
+        now = int(time.time())
+        check('first', now + 30)
+        check('older', now - 3600)
+        check('within-ttl', now + 35 - firmware.CONTROL_MAX_TTL)
+        check('newer', now + 60)
+    finally:
+        firmware.publish_control, firmware.time = publish, clock
+        firmware.control_floor = None
+    return replies
+
+
+async def bench(count, windows):
+    broker = Broker()
+    firmware, poller = firmware_device(broker)
+    rng = random.Random(1)
+    devices = [Device(firmware, 'HPPC-{:05d}'.format(i), broker, rng) for i in range(1, count + 1)]
+    ids = [firmware.CONFIG['ID']] + [d.id for d in devices]
+    bridge = TCPBridge(broker)
+    await bridge.start()
+    connection = await Connection.open('127.0.0.1', bridge.port, 'hppc-control-bench')
+    plane = None
+
+    async def on_message(topic, payload):
+        await plane.on_message(topic, payload)
+    connection.subscribe(['hppc/control/+/reply'])
+    receiver = asyncio.ensure_future(connection.run(on_message))
+    ok = True
+    for window in windows:
+        replayed = sum(d.commands.replayed for d in devices)
+        for device in devices:
+            device.arm()
+        plane = ControlPlane(connection, fleet_key=FLEET_KEY, window=window, timeout=TIMEOUT, retries=RETRIES)
+        await asyncio.sleep(0.05)
+        start = time.perf_counter()
+        results = await plane.fan_out(ids, {'SITE_ID': ['SITE-{}'.format(window)]})
+        elapsed = time.perf_counter() - start
+        print('window {}'.format(window))
+        for line in summary(results, elapsed):
+            print('    ' + line)
+        twice = sum(1 for d in devices if d.runs > 1)
+        answered = sum(1 for d in devices if not d.offline)
+        ok_count = sum(1 for r in results if r.status == 'ok')
+        print('    {} requests sent, {} late replies, {} commands ran twice, {} replies from the reply cache'.format(
+            plane.sent, plane.late, twice, sum(d.commands.replayed for d in devices) - replayed))
+        if twice or ok_count != answered + 1:
+            ok = False
+        # the next round's requests must not be taken for retries
+        await asyncio.sleep(0.2)
+
+    # the firmware refuses requests that are forged or too old
+    plane = ControlPlane(connection, fleet_key='not-the-fleet-key', timeout=TIMEOUT, retries=0)
+    forged = (await plane.fan_out([firmware.CONFIG['ID']], {'COMMAND': 'SHOW_CONFIG_FILE'}))[0]
+    plane = ControlPlane(connection, fleet_key=FLEET_KEY, timeout=TIMEOUT, retries=0, ttl=-60)
+    expired = (await plane.fan_out([firmware.CONFIG['ID']], {'COMMAND': 'SHOW_CONFIG_FILE'}))[0]
+    plane = ControlPlane(connection, fleet_key=FLEET_KEY, timeout=TIMEOUT, retries=0, ttl=firmware.CONTROL_MAX_TTL + 60)
+    too_long = (await plane.fan_out([firmware.CONFIG['ID']], {'COMMAND': 'SHOW_CONFIG_FILE'}))[0]
+    print('firmware: forged request -> {}, expired request -> {}, request valid for too long -> {}'.format(
+        forged.reply and forged.reply.get('ERROR'), expired.reply and expired.reply.get('ERROR'),
+        too_long.reply and too_long.reply.get('ERROR')))
+    if forged.reply != {'ERROR': 'UNAUTHORIZED', 'REQUEST_ID': forged.request_id} or \
+            expired.reply != {'ERROR': 'EXPIRED', 'REQUEST_ID': expired.request_id} or \
+            too_long.reply != {'ERROR': 'EXPIRED', 'REQUEST_ID': too_long.request_id}:
+        ok = False
+    replies = refusals(firmware)
+    print('firmware: {}'.format(', '.join('{} -> {}'.format(*r) for r in replies)))
+    if replies != [('no-expires', 'UNAUTHORIZED'), ('float-expires', 'UNAUTHORIZED'), ('first', None),
+                   ('older', 'EXPIRED'), ('within-ttl', None), ('newer', None)]:
+        ok = False
+
+    receiver.cancel()
+    poller.cancel()
+    connection.close()
+    await bridge.close()
+    return ok
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEVICES
+    windows = tuple(int(w) for w in sys.argv[2].split(',')) if len(sys.argv) > 2 else WINDOWS
+    print('{} emulated devices + the firmware, {:.0%} offline, {:.0%} lose a request, {:.0%} lose a reply'.format(
+        count, OFFLINE, LOST_REQUEST, LOST_REPLY))
+    if not asyncio.run(bench(count, windows)):
+        print('CHECK FAILED')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
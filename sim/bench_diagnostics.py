@@ -0,0 +1,173 @@
+'''
+Cost and output of the firmware diagnostics (DIAGNOSTICS in main.py, libs/diagnostics.py).
+The cost is measured end to end, on pairs of runs without and with them, the order alternated, and is
+the median over the pairs of the change within the pair: a pair runs close together, while the host's
+speed drifts by a third over a minute here. The host CPU of the firmware (process time from main() on)
+is compared on PAIRS short runs at cpu_scale 0, whose work doesn't depend on the host's speed, and may
+grow by OVERHEAD_LIMIT at most. The runs of a pair differ by a few % either way and by up to a third
+now and then, more the longer they are: over PAIRS pairs of PAIR_DURATION (one report each) the median
+stayed within +-1% in repeated measurements here, a fifth of the limit. The quartiles of the pairs are
+printed with it. With cpu_scale a slower run is later and skips periods, so the mean run
+time of each task and the total task load are compared on REPEATS pairs of runs at cpu_scale.
+The task run times are virtual us (cpu_scale times the host's), and the sim's ticks_us() charges the
+host CPU used so far to the clock and fires the machine.Timer callbacks that fall due (the ADC
+acquisition), so the two extra reads of timed() put a share of the timer work in the task they time:
+the per task changes are an upper bound of what the device would see, the host CPU is not affected.
+Then a run with tracemalloc, on which sim.gc models the heap (model_heap) and collects at the firmware's threshold,
+checks that the reports arrive on the diagnostics topic every INTERVAL, that a STATS command is answered,
+that the histograms saw every run of their callback and that the heap and collection figures move.
+It runs with cpu_scale 0: tracemalloc slows the host more than the 1 ms acquisition timer allows.
+Run from the repository root:  python -m sim.bench_diagnostics [seconds] [cpu_scale]
+'''
+import json
+import sys
+import time
+import tracemalloc
+from collections import deque
+from statistics import median, quantiles
+
+from sim.bench_firmware import waveforms
+from sim.runtime import run_firmware
+
+DURATION = 120          # virtual s of the runs at cpu_scale and of the run with tracemalloc
+CPU_SCALE = 20          # as sim.bench_firmware
+REPEATS = 5             # pairs of runs at cpu_scale
+PAIRS = 100             # pairs of runs at cpu_scale 0
+PAIR_DURATION = 11      # virtual s of those
+INTERVAL = 10000        # ms between diagnostics reports
+STATS_AT = 30000        # virtual ms the dashboard sends STATS
+OVERHEAD_LIMIT = 0.05   # of the firmware's host CPU time
+TASKS = ('sample', 'safety', 'watchdog', 'publish', 'mqtt_inbound', 'commands')
+
+
+def run(duration, cpu_scale, enabled, traced=False):
+    received = {'reports': [], 'replies': []}
+    started = {}
+
+    # decoded after the run, the decoded reports would grow the traced heap by a few KB each
+    def prepare(firmware, clock, broker):
+        waveforms(firmware)
+        broker.listen(firmware.CONFIG['MQTT_DIAGNOSTICS_TOPIC'], lambda topic, msg: received['reports'].append(msg))
+        broker.listen(firmware.CONFIG['MQTT_REPLY_TOPIC'], lambda topic, msg: received['replies'].append(msg))
+        if traced:
+            # and the broker keeps every message, neither is the firmware's heap
+            broker.messages = deque(maxlen=0)
+            sys.modules['gc'].model_heap = True
+            tracemalloc.start()
+        started['cpu'] = time.process_time()
+
+    def stats(firmware):
+        message = {'COMMAND': 'STATS', 'ID': firmware.CONFIG['ID'], 'REQUEST_ID': 'bench-stats'}
+        firmware.client.broker.inject(firmware.CONFIG['MQTT_REQUEST_TOPIC'], json.dumps(message))
+
+    config = {'LOG_INTERVAL': 5000, 'DIAGNOSTICS': enabled, 'DIAGNOSTICS_INTERVAL': INTERVAL}
+    try:
+        result = run_firmware(duration * 1000, config, cpu_scale=cpu_scale, latency=20,
+                              prepare=prepare, events=((STATS_AT, stats),))
+    finally:
+        if traced:
+            tracemalloc.stop()
+            sys.modules['gc'].model_heap = False
+    result.cpu = time.process_time() - started['cpu']
+    for name in received:
+        received[name] = [json.loads(msg) for msg in received[name]]
+    # libs.tasks is imported again by the next run
+    return result, dict(result.task_stats()), received
+
+
+def figures(result, tasks):
+    '''Host s, the share of the run spent in the tasks and the mean run time (us) of each of TASKS'''
+    out = {'host s': result.cpu, 'task load': sum(s.total_run for s in tasks.values()) / (result.duration * 1000)}
+    for name in TASKS:
+        out[name] = tasks[name].total_run / tasks[name].runs
+    return out
+
+
+def pairs(count, duration, cpu_scale):
+    '''count runs without and count with diagnostics, alternately, without first every other pair'''
+    runs = {False: [], True: []}
+    for i in range(count):
+        for enabled in ((False, True) if i % 2 == 0 else (True, False)):
+            runs[enabled].append(run(duration, cpu_scale, enabled))
+    return runs[False], runs[True]
+
+
+def compare(plain, timed, names, relative=False):
+    '''name -> (median without, median with, median, first and third quartile of the change within the pairs)'''
+    plain = [figures(*r[:2]) for r in plain]
+    timed = [figures(*r[:2]) for r in timed]
+    out = {}
+    for name in names:
+        changes = [b[name] / a[name] - 1 if relative else b[name] - a[name] for a, b in zip(plain, timed)]
+        first, second, third = quantiles(changes, n=4)
+        out[name] = (median(a[name] for a in plain), median(b[name] for b in timed), median(changes), first, third)
+    return out
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else DURATION
+    cpu_scale = float(sys.argv[2]) if len(sys.argv) > 2 else CPU_SCALE
+    failed = []
+
+    plain, timed = pairs(PAIRS, PAIR_DURATION, 0)
+    measured = compare(plain, timed, ('host s',), relative=True)
+    measured.update(compare(*pairs(REPEATS, duration, cpu_scale), ('task load',) + TASKS))
+    print('host CPU over {} pairs of {:.0f} s runs at cpu_scale 0, tasks over {} pairs of {:.0f} s at cpu_scale {} (virtual us)'.format(
+        PAIRS, PAIR_DURATION, REPEATS, duration, cpu_scale))
+    print('{:<16} {:>10} {:>10} {:>10}'.format('', 'without', 'with', 'change'))
+    print('{:<16} {:>10.3f} {:>10.3f} {:>+10.1%}   pairs {:+.1%} to {:+.1%} (quartiles)'.format('host s', *measured['host s']))
+    print('{:<16} {:>10.2%} {:>10.2%} {:>+10.2%}'.format('task load', *measured['task load']))
+    for name in TASKS:
+        print('{:<16} {:>10.0f} {:>10.0f} {:>+10.0f}'.format(name + ' us', *measured[name]))
+    cost = measured['host s'][2]
+    if cost > OVERHEAD_LIMIT:
+        failed.append('diagnostics cost {:.1%} of host CPU, limit {:.0%}'.format(cost, OVERHEAD_LIMIT))
+    plain, plain_tasks, plain_received = plain[0]
+    if plain_received['reports'] or plain.firmware.diagnostics.histograms:
+        failed.append('diagnostics ran while disabled')
+
+    gc = sys.modules['gc']
+    collections = gc.collections
+    timed, tasks, received = run(duration, 0, True, traced=True)
+    firmware = timed.firmware
+    histograms = firmware.diagnostics.histograms
+    print('\nhistograms of the run with tracemalloc (virtual us, cpu_scale 0):')
+    for name in sorted(histograms):
+        print('    {!r}'.format(histograms[name]))
+
+    # every run of the timed callbacks is in its histogram
+    for histogram, task in (('fetch_data', 'sample'), ('safety_check', 'safety'), ('send_data', 'publish')):
+        if histograms[histogram].count != tasks[task].runs:
+            failed.append('{} recorded {} runs, the {} task ran {}'.format(histogram, histograms[histogram].count, task, tasks[task].runs))
+    if not histograms['connect_mqtt'].count or not histograms['control_callback'].count:
+        failed.append('no MQTT connect or control callback recorded')
+
+    # periodic reports: the first one INTERVAL after the start, none at the very end of the run
+    reports = received['reports']
+    expected = int(-(-duration * 1000 // INTERVAL)) - 1
+    sizes = [len(json.dumps(r)) for r in reports]
+    print('{} reports on {} ({} expected), {} to {} bytes'.format(
+        len(reports), firmware.CONFIG['MQTT_DIAGNOSTICS_TOPIC'], expected, min(sizes or [0]), max(sizes or [0])))
+    if [r['uptime'] for r in reports] != [INTERVAL * (i + 1) for i in range(expected)]:
+        failed.append('diagnostics reports at {}, {} expected every {} ms'.format([r['uptime'] for r in reports], expected, INTERVAL))
+    if reports:
+        last = reports[-1]
+        print('last report: heap {}, wdt {}, publish {}'.format(last['heap'], last['wdt'], last['publish']))
+        print('{} collections by the sim heap, threshold {} B'.format(gc.collections - collections, gc.threshold()))
+        free, min_free, allocated, seen = last['heap']
+        if not (allocated > 0 and min_free <= free and min_free < gc.HEAP and 0 < seen <= gc.collections - collections):
+            failed.append('heap figures {} with {} collections'.format(last['heap'], gc.collections - collections))
+        if last['wdt'][1] is None or last['wdt'][1] <= 0:
+            failed.append('watchdog margin {}'.format(last['wdt']))
+    stats = [r for r in received['replies'] if r.get('REQUEST_ID') == 'bench-stats']
+    if len(stats) != 1 or sorted(stats[0]['STATS']) != sorted(reports[-1] if reports else ()):
+        failed.append('STATS reply {!r}'.format(stats))
+
+    for failure in failed:
+        print('CHECK FAILED: {}'.format(failure))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+'''
+Accuracy of the energy counters and state of charge (libs/energy.py) on a synthetic day.
+Solar is a half sine from 06:00 to 18:00, the load switches between two levels, and the battery
+takes the difference through an internal resistance with a biased current sensor.
+Compares the integrated counters with the exact integrals and with the old approach of multiplying
+the reading taken at each LOG_INTERVAL publish by the interval, and the integer path the firmware uses
+(update_record() on a libs/record.py Record) with the float one.
+Run from the repository root:  python -m sim.bench_energy
+'''
+import math
+import os
+import random
+import sys
+import tempfile
+
+from libs.energy import EnergyMeter, StateOfCharge, Checkpoint, energy_changed
+from libs.record import Record
+from libs.telemetry import _scaled
+from sim.clock import Clock
+
+DAY = 24 * 3600 * 1000
+SAMPLE_PERIOD = 100   # ms, with jitter
+LOG_INTERVAL = 5000
+SOLAR_PEAK = 5.0      # A
+CAPACITY = 100.0      # Ah
+R_INTERNAL = 0.05     # ohm
+SENSOR_BIAS = 0.05    # A added to the measured battery current
+START_SOC = 55.0      # true SoC at midnight, the estimate starts from the voltage
+RECORD_TOLERANCE = 0.001   # relative Ah difference allowed between the integer and the float path
+SMALL_INT = 1 << 30        # MicroPython's small integers on 32 bit ports, larger ones are heap objects
+OCV = [[22.6, 0], [23.0, 10], [23.3, 20], [23.6, 30], [23.9, 40], [24.2, 50],
+       [24.5, 60], [24.7, 70], [25.0, 80], [25.2, 90], [25.5, 100]]
+
+
+def solar_current(t):
+    hour = t / 3600000
+    if 6 <= hour < 18:
+        return SOLAR_PEAK * math.sin(math.pi * (hour - 6) / 12)
+    return 0.0
+
+
+def load_current(t):
+    # the load is off 01:00 - 03:00, which gives the estimator a rest period before sunrise
+    hour = t / 3600000
+    if 1 <= hour < 3:
+        return 0.0
+    # 7.3 s duty cycle, out of step with the publish interval
+    return 2.0 if t % 7300 < 2000 else 0.5
+
+
+def solar_ah(t):
+    '''Exact solar charge (Ah) from midnight to t'''
+    hour = t / 3600000
+    if hour < 6:
+        return 0.0
+    if hour < 18:
+        return SOLAR_PEAK * 12 / math.pi * (1 - math.cos(math.pi * (hour - 6) / 12))
+    return SOLAR_PEAK * 24 / math.pi
+
+
+def _pulses(t):
+    n, r = divmod(t, 7300)
+    return n * (2.0 * 2000 + 0.5 * 5300) + 2.0 * min(r, 2000) + 0.5 * max(0, r - 2000)
+
+
+def load_ah(t):
+    '''Exact load charge (Ah) from midnight to t'''
+    off = _pulses(min(max(t, 3600000), 3 * 3600000)) - _pulses(3600000)
+    return (_pulses(t) - off) / 3600000
+
+
+def voltage_at(soc):
+    for i in range(1, len(OCV)):
+        if soc <= OCV[i][1]:
+            v0, s0 = OCV[i - 1]
+            v1, s1 = OCV[i]
+            return v0 + (v1 - v0) * (soc - s0) / (s1 - s0)
+    return OCV[-1][0]
+
+
+def run(rest_time, record=None):
+    '''The float path, or update_record() on `record` (a Record) when given'''
+    random.seed(1)
+    clock = Clock()
+    soc = StateOfCharge(CAPACITY, OCV, rest_current=0.5, rest_time=rest_time)
+    meter = EnergyMeter(soc, clock=clock)
+    store = Checkpoint(os.path.join(tempfile.mkdtemp(), 'energy'), interval=600000, changed=energy_changed, clock=clock)
+    legacy = {'solar': 0.0, 'load': 0.0}
+    # worst error (Ah) of a single hour, for both methods
+    hourly = {'solar': [0.0, 0.0], 'load': [0.0, 0.0]}
+    hour_start = {}
+    next_hour = 0
+    worst_soc_error = 0.0
+    largest = 0                 # integer sum or power of the record path
+    next_log = LOG_INTERVAL
+    next_checkpoint = 60000
+    data = {}
+    t = 0
+    while t < DAY:
+        clock.now = t
+        true_soc = START_SOC + (solar_ah(t) - load_ah(t)) * 100 / CAPACITY
+        i_solar = solar_current(t)
+        i_load = load_current(t)
+        i_batt = i_solar - i_load
+        v_batt = voltage_at(true_soc) + i_batt * R_INTERNAL
+        data['solar_current'] = i_solar
+        data['solar_voltage'] = v_batt + 1.0
+        data['scc_load_current'] = i_load
+        data['scc_load_voltage'] = v_batt
+        data['battery_current'] = i_batt + SENSOR_BIAS
+        data['battery_voltage'] = v_batt
+        if record is None:
+            meter.update(data)
+        else:
+            for i in range(len(record.fields)):
+                name, scale = record.fields[i]
+                if name in data:
+                    record.values[i] = _scaled(data[name], scale)
+            meter.update_record(record.values)
+            for counter in meter.counters.values():
+                largest = max(largest, counter.q_in, counter.q_out, counter.e_in, counter.e_out, abs(counter.last_power))
+        if soc.soc is not None:
+            worst_soc_error = max(worst_soc_error, abs(soc.soc - true_soc))
+        if t >= next_hour:
+            meter.fold()
+            exact_now = {'solar': solar_ah(t), 'load': load_ah(t)}
+            for name in hourly:
+                now = (meter.counters[name].ah_in, legacy[name], exact_now[name])
+                if name in hour_start:
+                    then = hour_start[name]
+                    for k in (0, 1):
+                        err = abs((now[k] - then[k]) - (now[2] - then[2]))
+                        hourly[name][k] = max(hourly[name][k], err)
+                hour_start[name] = now
+            next_hour += 3600000
+        if t >= next_log:
+            legacy['solar'] += i_solar * LOG_INTERVAL / 3600000
+            legacy['load'] += i_load * LOG_INTERVAL / 3600000
+            next_log += LOG_INTERVAL
+        if t >= next_checkpoint:
+            store.save(meter.state())
+            next_checkpoint += 60000
+        t += SAMPLE_PERIOD + random.randint(-10, 10)
+    # the counters stop at the last sample
+    meter.fold()
+    exact = {'solar': solar_ah(meter.counters['solar'].last), 'load': load_ah(meter.counters['load'].last)}
+    return meter, soc, store, exact, legacy, hourly, true_soc, worst_soc_error, largest
+
+
+def main():
+    meter, soc, store, exact, legacy, hourly, true_soc, worst, largest = run(1800000)
+    for name in ('solar', 'load'):
+        counted = meter.counters[name].ah_in
+        print('{:>5}: exact {:8.3f} Ah  integrated {:8.3f} Ah ({:+.3f}%)  LOG_INTERVAL samples {:8.3f} Ah ({:+.3f}%)'.format(
+            name, exact[name], counted, 100 * (counted - exact[name]) / exact[name],
+            legacy[name], 100 * (legacy[name] - exact[name]) / exact[name]))
+        print('       worst hour: integrated {:.4f} Ah, LOG_INTERVAL samples {:.4f} Ah'.format(*hourly[name]))
+    print('SoC with re-anchoring:    final {:.1f}% (true {:.1f}%), worst error {:.1f}%, {} anchors'.format(
+        soc.soc, true_soc, worst, soc.anchors))
+    meter, soc, store_off, exact, legacy, hourly, true_soc, worst, largest = run(10 * DAY)
+    print('SoC without re-anchoring: final {:.1f}% (true {:.1f}%), worst error {:.1f}%'.format(soc.soc, true_soc, worst))
+    print('checkpoints written in 24 h: {} (at most one per {} min)'.format(store.writes, store.interval // 60000))
+
+    failed = []
+    floats = run(1800000)
+    integers = run(1800000, Record())
+    for name in ('solar', 'load', 'battery'):
+        for direction in ('ah_in', 'ah_out', 'wh_in', 'wh_out'):
+            a = getattr(floats[0].counters[name], direction)
+            b = getattr(integers[0].counters[name], direction)
+            if abs(b - a) > RECORD_TOLERANCE * max(abs(a), 1):
+                failed.append('{} {}: {:.4f} from the record, {:.4f} from floats'.format(name, direction, b, a))
+    print('record path: solar {:.3f} Ah, load {:.3f} Ah, SoC {:.1f}% (floats {:.3f} Ah, {:.3f} Ah, {:.1f}%), worst SoC error {:.1f}%, {} anchors'.format(
+        integers[0].counters['solar'].ah_in, integers[0].counters['load'].ah_in, integers[1].soc,
+        floats[0].counters['solar'].ah_in, floats[0].counters['load'].ah_in, floats[1].soc, integers[7], integers[1].anchors))
+    print('largest integer of the record path: {} ({:.1%} of the small integer range)'.format(integers[8], integers[8] / SMALL_INT))
+    if integers[8] >= SMALL_INT:
+        failed.append('the record path reached {}, a heap integer on the device'.format(integers[8]))
+    if abs(integers[1].soc - floats[1].soc) > 1 or integers[1].anchors != floats[1].anchors:
+        failed.append('SoC {:.1f}% with {} anchors from the record, {:.1f}% with {} from floats'.format(
+            integers[1].soc, integers[1].anchors, floats[1].soc, floats[1].anchors))
+    for failure in failed:
+        print('CHECK FAILED: {}'.format(failure))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Benchmark suite: runs the unmodified firmware on the virtual clock (sim/runtime.py) through a few
+scenarios and reports loop iterations/s, per-task timing, watchdog margin and MQTT traffic.
+cpu_scale charges host CPU time to the virtual clock times that factor (0 = computation is free).
+Run from the repository root:  python -m sim.bench_firmware [seconds] [cpu_scale]
+'''
+import sys
+
+from sim.runtime import run_firmware
+from sim.waveforms import codes, constant, current_code, pulses, sine, steps, voltage_code
+
+DURATION = 120  # virtual s per scenario
+CPU_SCALE = 20  # rough ESP32-S3 MicroPython slowdown against a desktop CPython
+
+
+def waveforms(firmware, load_voltage=None):
+    '''Plausible readings: a 25 V battery bank, a cycling load and a slowly varying panel'''
+    firmware.battery_voltage_pin.set_source(codes(sine(25.4, 0.2, 60000), voltage_code(88700, 1000000, 0.001)), 2)
+    firmware.load_voltage_pin.set_source(codes(load_voltage or constant(25.0), voltage_code(88700, 1000000, 0, 0.1)), 2)
+    firmware.load_current_pin.set_source(codes(pulses(0.4, 1.5, 7300, 2000), current_code(1.688, -0.008)), 2)
+    firmware.battery_current_pin.set_source(codes(sine(1.0, 2.0, 45000), current_code(1.660, -0.001)), 2)
+    firmware.panel_current_pin.set_source(codes(sine(3.0, 1.0, 90000), current_code(1.671, -0.007)), 2)
+
+
+def wifi_outage(start, end):
+    def drop(firmware):
+        firmware.link.wlan.link_up = False
+
+    def restore(firmware):
+        firmware.link.wlan.link_up = True
+    return ((start, drop), (end, restore))
+
+
+SCENARIOS = (
+    # name, broker latency ms, prepare, events
+    ('nominal', 20, lambda fw, clock, broker: waveforms(fw), ()),
+    ('slow broker', 800, lambda fw, clock, broker: waveforms(fw), ()),
+    ('wifi outage', 20, lambda fw, clock, broker: waveforms(fw), wifi_outage(30000, 75000)),
+    ('over voltage', 20, lambda fw, clock, broker: waveforms(fw, steps([(0, 25.0), (40000, 31.5), (60000, 25.0)])), ()),
+    )
+
+
+def report(name, run):
+    firmware = run.firmware
+    seconds = run.duration / 1000
+    stats = run.task_stats()
+    wdt = firmware.wdt
+    print('== {} ({:.0f} virtual s in {:.2f} host s)'.format(name, seconds, run.cpu))
+    print('   loop iterations/s {:.0f}, conversions/s {:.1f}, timer callbacks {}'.format(
+        run.loop.iterations / seconds, stats['sample'].runs / seconds, run.clock.fired))
+    print('   watchdog: margin {:.0f} ms of {} ms, {} near misses, {} expired'.format(
+        wdt.margin(), wdt.timeout, wdt.near_misses, wdt.expired))
+    print('   mqtt: {} messages, {} payload bytes, {} wire bytes, {} acked, worst ack {} ms'.format(
+        len(run.broker.messages), run.broker.bytes_in, run.broker.bytes_wire,
+        firmware.publisher.acked, firmware.publisher.worst_latency))
+    print('   spool: {} pending, {} dropped; protection tripped: {}'.format(
+        firmware.spool.pending(), firmware.spool.dropped, bool(firmware.protection.tripped)))
+    print('   {:<18} {:>6} {:>10} {:>10} {:>12} {:>12}'.format('task', 'runs', 'last late', 'worst late', 'mean run', 'worst run'))
+    for task in sorted(stats):
+        s = stats[task]
+        print('   {:<18} {:>6} {:>8}ms {:>8}ms {:>10}us {:>10}us'.format(
+            task, s.runs, s.last_late, s.worst_late, s.total_run // s.runs if s.runs else 0, s.worst_run))
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else DURATION
+    cpu_scale = float(sys.argv[2]) if len(sys.argv) > 2 else CPU_SCALE
+    for name, latency, prepare, events in SCENARIOS:
+        run = run_firmware(duration * 1000, {'LOG_INTERVAL': 5000}, cpu_scale=cpu_scale, latency=latency,
+                           prepare=prepare, events=events)
+        report(name, run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+'''
+Uplink cost of a fleet with and without site gateways (tools/gateway.py).
+S sites of N emulated controllers each talk MQTT over loopback TCP, either straight to the cloud broker
+(the in-process broker of sim/mqtt.py behind a TCP bridge) or to their site's gateway, which keeps one
+session to the cloud. Like the firmware every device publishes a reading per LOG_INTERVAL at QoS 1
+(a quarter JSON DATA, the others binary records on their own sub topic), subscribes to its request topic
+and the shared control topic, and answers control requests on its reply topic. Device time runs SPEEDUP
+times faster than real time, readings are spread over the interval and the gateway's linger is scaled
+to match. Halfway through, every gateway loses its uplink and has to reconnect and send again.
+Reports the broker's connections, packets, bytes and messages from the devices' side of the cloud, checks
+that the ingestion service (tools/ingest.py) stored every reading, then times a control fan out to the
+whole fleet (tools/control.py) through the same path. Exits with status 1 when a reading is missing or a
+device doesn't answer.
+Run from the repository root:  python -m sim.bench_gateway [sites] [devices per site] [rounds]
+'''
+import asyncio
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from libs import telemetry
+from sim.bench_ingest import START, get_time
+from sim.mqtt import Broker, TCPBridge
+from tools.control import ControlPlane, summary
+from tools.gateway import Gateway
+from tools.ingest import Ingester
+from tools.mqtt import Connection
+from tools.store import ColumnStore
+
+SITES = 20
+DEVICES = 10        # per site
+ROUNDS = 20         # LOG_INTERVALs of device time
+INTERVAL = 10       # device LOG_INTERVAL, s
+SPEEDUP = 20        # device s per real s
+LINGERS = (1, 5, 10)    # gateway linger in device s
+TOPIC = 'hppc/data'
+CONTROL_TOPIC = 'hppc/control'
+PACKET_OVERHEAD = 69    # bytes of TCP/IPv4 headers and TLS record framing around every uplink packet
+
+
+class Device:
+    def __init__(self, site, i, rng):
+        self.id = 'hppc-{:02d}-{:03d}'.format(site, i)
+        self.site = 'site-{:02d}'.format(site)
+        self.binary = i % 4 != 0
+        self.topic = '{}/{}'.format(TOPIC, self.id) if self.binary else TOPIC
+        self.offset = rng.random()      # where in the interval it publishes
+        self.rows = 0
+        self.total = 0                  # sum of the battery_voltage codes sent
+        self.acks = []
+
+    async def connect(self, port):
+        self.connection = await Connection.open('127.0.0.1', port, self.id)
+        self.connection.subscribe(['{}/{}/request'.format(CONTROL_TOPIC, self.id), CONTROL_TOPIC])
+        self.receiver = asyncio.ensure_future(self.connection.run(self.on_message))
+        self.acks.append(self.connection.publish(self.reply_topic(), b'{"HPPC": "DEVICE RUNNING"}', qos=1))
+
+    def reply_topic(self):
+        return '{}/{}/reply'.format(CONTROL_TOPIC, self.id)
+
+    async def on_message(self, topic, payload):
+        try:
+            request = json.loads(payload)
+        except ValueError:
+            return
+        if request.get('ID') != self.id:
+            return
+        reply = {'HPPC': 'CONFIG FILE', 'REQUEST_ID': request.get('REQUEST_ID')}
+        self.acks.append(self.connection.publish(self.reply_topic(), json.dumps(reply).encode(), qos=1))
+
+    def publish(self, t, values):
+        self.rows += 1
+        self.total += int(values[2])
+        if self.binary:
+            payload = bytes(telemetry.encode_values(values.tolist(), 7, 0, t))
+        else:
+            data = {'id': self.id, 'site_id': self.site}
+            for i in range(len(telemetry.FIELDS)):
+                name, scale = telemetry.FIELDS[i]
+                data[name] = int(values[i]) / scale
+            data['connected_to_wifi'] = data['battery_connected'] = data['panel_connected'] = True
+            data['time'] = get_time(t)
+            payload = json.dumps(data).encode()
+        self.acks.append(self.connection.publish(self.topic, payload, qos=1))
+
+    def close(self):
+        self.receiver.cancel()
+        self.connection.close()
+
+
+class Counters:
+    '''Broker counters over a stretch of the run'''
+    def __init__(self, broker):
+        self.broker = broker
+        self.start = self.read()
+
+    def read(self):
+        b = self.broker
+        return {'connections': b.connections, 'packets': b.packets_in, 'bytes up': b.bytes_wire,
+                'bytes down': b.bytes_out, 'messages': len(b.messages)}
+
+    def delta(self):
+        now = self.read()
+        delta = {k: now[k] - self.start[k] for k in now}
+        delta['payload'] = sum(len(m[2]) for m in self.broker.messages[self.start['messages']:])
+        return delta
+
+
+def live_sessions(broker):
+    return sum(1 for s in broker.sessions.values() if s.socket is not None and not s.socket.closed)
+
+
+async def run(mode, linger, sites, per_site, rounds, root):
+    broker = Broker()
+    bridge = TCPBridge(broker)
+    await bridge.start()
+    store = ColumnStore(root)
+    ingester = Ingester(store)
+    worker = asyncio.ensure_future(ingester.run())
+    broker.listen(TOPIC + '/#', ingester.submit)
+    rng = random.Random(1)
+    devices = [Device(s, i, rng) for s in range(sites) for i in range(per_site)]
+    gateways = {}
+    if mode == 'gateway':
+        for s in range(sites):
+            site = 'site-{:02d}'.format(s)
+            gateways[site] = Gateway(site, '127.0.0.1', bridge.port, data_topic=TOPIC, linger=linger / SPEEDUP)
+            await gateways[site].start('127.0.0.1', 0, ntp_port=None)
+        while any(g.upstream is None for g in gateways.values()):
+            await asyncio.sleep(0.001)
+
+    counters = Counters(broker)
+    for device in devices:
+        await device.connect(gateways[device.site].listen_port if gateways else bridge.port)
+
+    # readings spread over every interval
+    period = INTERVAL / SPEEDUP
+    values = np.array([2500, 800, 2600, 1200, 3600, 2000, 2500], np.int16)
+    noise = np.random.default_rng(1)
+    schedule = sorted((n + d.offset, n, d) for n in range(rounds) for d in devices)
+    start = time.perf_counter()
+    sessions = 0
+    outage = None
+    for at, n, device in schedule:
+        delay = start + at * period - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if n == rounds // 2 and outage is None:
+            sessions = live_sessions(broker)
+            outage = 0
+            for gateway in gateways.values():
+                if gateway.upstream is not None:
+                    gateway.upstream.writer.close()
+                    outage += 1
+        device.publish(START + n * INTERVAL + int(device.offset * INTERVAL), values + noise.integers(-20, 21, len(values), dtype=np.int16))
+    for device in devices:
+        await asyncio.gather(*device.acks, return_exceptions=True)
+    for gateway in gateways.values():
+        await gateway.drain()
+    while ingester.queue.qsize():
+        await asyncio.sleep(0.001)
+    await ingester.drain()
+    traffic = counters.delta()
+    if not sessions:
+        sessions = live_sessions(broker)
+
+    # control fan out to the fleet, through the gateways when there are
+    connection = await Connection.open('127.0.0.1', bridge.port, 'hppc-control-bench')
+    plane = ControlPlane(connection, timeout=2.0, retries=2)
+    connection.subscribe([plane.reply_filter()])
+    receiver = asyncio.ensure_future(connection.run(plane.on_message))
+    await asyncio.sleep(0.05)
+    fan_start = time.perf_counter()
+    results = await plane.fan_out([d.id for d in devices], {'COMMAND': 'SHOW_CONFIG_FILE'})
+    fan_out = summary(results, time.perf_counter() - fan_start)
+    receiver.cancel()
+    connection.close()
+
+    for device in devices:
+        device.close()
+    for gateway in gateways.values():
+        await gateway.close()
+    worker.cancel()
+    await bridge.close()
+    store.close()
+
+    # every reading arrived, an at least once delivery may have duplicated some
+    store = ColumnStore(root, writable=False)
+    missing = extra = 0
+    for device in devices:
+        rows = store.range(device.id, START, START + (rounds + 1) * INTERVAL, ('battery_voltage',), raw=True)
+        if len(rows['time']) < device.rows:
+            missing += 1
+        extra += max(0, len(rows['time']) - device.rows)
+    store.close()
+    answered = sum(1 for r in results if r.status == 'ok')
+    return {'sessions': sessions, 'traffic': traffic, 'records': ingester.records, 'rejected': sum(ingester.rejected.values()),
+            'missing': missing, 'extra': extra, 'fan_out': fan_out, 'answered': answered, 'outage': outage,
+            'held': sum(g.held for g in gateways.values()), 'reconnects': sum(g.reconnects for g in gateways.values())}
+
+
+def main():
+    sites = int(sys.argv[1]) if len(sys.argv) > 1 else SITES
+    per_site = int(sys.argv[2]) if len(sys.argv) > 2 else DEVICES
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else ROUNDS
+    count = sites * per_site
+    print('{} sites x {} devices, {} readings each ({} s LOG_INTERVAL, {}x real time)'.format(
+        sites, per_site, rounds, INTERVAL, SPEEDUP))
+    modes = [('direct', None)] + [('gateway', linger) for linger in LINGERS]
+    ok = True
+    print('uplink bytes: payload, overhead (MQTT framing, topics and {} B of TCP/TLS per packet), all of it per record'.format(
+        PACKET_OVERHEAD))
+    print('{:<20} {:>8} {:>8} {:>8} {:>8} {:>9} {:>9} {:>9} {:>10} {:>8}'.format(
+        'cloud side', 'sessions', 'CONNECTs', 'messages', 'packets', 'payload', 'overhead', 'B/record', 'bytes down', 'missing'))
+    fan_outs = []
+    for mode, linger in modes:
+        root = tempfile.mkdtemp(prefix='hppc-store-')
+        try:
+            r = asyncio.run(run(mode, linger, sites, per_site, rounds, root))
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        name = mode if linger is None else '{} linger {} s'.format(mode, linger)
+        t = r['traffic']
+        wire = t['bytes up'] + t['packets'] * PACKET_OVERHEAD
+        print('{:<20} {:>8} {:>8} {:>8} {:>8} {:>9} {:>9} {:>9.1f} {:>10} {:>8}'.format(
+            name, r['sessions'], t['connections'], t['messages'], t['packets'], t['payload'], wire - t['payload'],
+            wire / max(1, r['records']), t['bytes down'], r['missing']))
+        if r['outage']:
+            print('{:<20} {} uplinks dropped and reconnected ({} reconnects), {} duplicated records, devices held back {} times'.format(
+                '', r['outage'], r['reconnects'], r['extra'], r['held']))
+        fan_outs.append((name, r['fan_out']))
+        if r['missing'] or r['rejected'] or r['answered'] != count:
+            ok = False
+    for name, lines in fan_outs:
+        print('control fan out, {}'.format(name))
+        for line in lines:
+            print('    ' + line)
+    if not ok:
+        print('CHECK FAILED')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+'''
+Load generator for the ingestion service (tools/ingest.py) and its columnar store (tools/store.py).
+N emulated devices connect to the in-process broker (sim/mqtt.py) and publish one reading per
+LOG_INTERVAL of device time at QoS 1, as fast as the service keeps up. A quarter of them publish JSON
+DATA, the others binary records on their own sub topic. Every device drops offline once and replays
+what it spooled as one batch when it is back, and a malformed message is mixed in now and then.
+The service either listens on the broker directly (local) or subscribes with its MQTT client over a
+loopback TCP bridge to the broker (tcp).
+Reports the sustained messages/s end to end, checks that every valid record is in the store, then
+times range and downsampling queries from a separate read-only view of the store.
+Run from the repository root:  python -m sim.bench_ingest [devices] [seconds] [local|tcp]
+'''
+import asyncio
+import calendar
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from libs import telemetry
+from sim.mqtt import Broker, MQTTClient, TCPBridge
+from tools.ingest import Ingester, raise_file_limit, subscribe
+from tools.store import ColumnStore
+
+DEVICES = 1000
+SECONDS = 20
+TOPIC = 'hppc/data'
+INTERVAL = 5                                         # device LOG_INTERVAL, s
+START = calendar.timegm((2023, 6, 1, 23, 50, 0))     # runs over midnight, into a second partition
+MALFORMED = 997                                      # one truncated payload every MALFORMED messages
+QUERIES = 200
+
+
+def get_time(t):
+    '''main.getTime() of unix time t'''
+    return '{}_{:02d}_{:02d}_{:02d}_{:02d}_{:02d}'.format(*time.gmtime(t)[:6])
+
+
+class Device:
+    def __init__(self, i, broker, rng):
+        self.id = 'hppc-{:05d}'.format(i)
+        self.binary = i % 4 != 0
+        self.topic = '{}/{}'.format(TOPIC, self.id) if self.binary else TOPIC
+        self.client = MQTTClient(self.id, 'localhost')
+        self.client.broker = broker
+        self.client.connect()
+        # offline for up to 5 minutes somewhere in the first half hour
+        self.offline_from = rng.randrange(360)
+        self.offline_to = self.offline_from + rng.randrange(1, 60)
+        self.spool = []
+        self.rows = 0
+        self.total = 0          # sum of the battery_voltage codes sent
+
+    def record(self, t, values):
+        self.rows += 1
+        self.total += int(values[2])
+        if self.binary:
+            return bytes(telemetry.encode_values(values.tolist(), 7, 0, t))
+        data = {'id': self.id, 'site_id': 'bench'}
+        for i in range(len(telemetry.FIELDS)):
+            name, scale = telemetry.FIELDS[i]
+            data[name] = int(values[i]) / scale
+        data['connected_to_wifi'] = data['battery_connected'] = data['panel_connected'] = True
+        data['time'] = get_time(t)
+        return data
+
+    def payload(self, records):
+        '''One record, or a list of spooled ones'''
+        if not self.binary:
+            return json.dumps(records).encode()
+        return b''.join(records) if isinstance(records, list) else records
+
+    def tick(self, n, t, values):
+        '''One LOG_INTERVAL: returns the number of messages published'''
+        record = self.record(t, values)
+        if self.offline_from <= n < self.offline_to:
+            self.spool.append(record)
+            return 0
+        self.client.publish(self.topic, self.payload(record), qos=1)
+        if not self.spool:
+            return 1
+        # live reading first, then the spooled ones, as drain_spool() does
+        self.client.publish(self.topic, self.payload(self.spool), qos=1)
+        self.spool = []
+        return 2
+
+
+async def generate(devices, ingester, seconds, pending):
+    '''Publishes rounds of readings for `seconds`, returns (messages, malformed messages, rounds)'''
+    rng = np.random.default_rng(1)
+    base = np.array([2500, 800, 2600, 1200, 3600, 2000, 2500], np.int16)
+    noise = np.array([20, 200, 30, 800, 300, 1500, 100], np.int16)
+    messages = malformed = n = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        values = base + rng.integers(-noise, noise + 1, (len(devices), len(base)), dtype=np.int16)
+        for i in range(len(devices)):
+            device = devices[i]
+            sent = device.tick(n, START + n * INTERVAL + i % INTERVAL, values[i])
+            messages += sent
+            if sent and messages // MALFORMED != (messages - sent) // MALFORMED and device.binary:
+                device.client.publish(device.topic, b'\x01\x02\x03', qos=1)
+                messages += 1
+                malformed += 1
+        n += 1
+        # hold back while the service catches up, it is the service being measured
+        while pending() > 2 * len(devices):
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0)
+    # whatever is still spooled comes in on the next round
+    for device in devices:
+        if device.spool:
+            device.client.publish(device.topic, device.payload(device.spool), qos=1)
+            device.spool = []
+            messages += 1
+    return messages, malformed, n
+
+
+def percentiles(samples):
+    ms = np.array(samples) * 1000
+    return np.mean(ms), np.percentile(ms, 50), np.percentile(ms, 99)
+
+
+def queries(root, devices, rounds):
+    store = ColumnStore(root, writable=False)
+    end = START + rounds * INTERVAL + INTERVAL
+    rng = random.Random(2)
+    timings = {'range 1 h': [], 'range all': [], 'downsample 60 s': []}
+    for i in range(QUERIES):
+        device = rng.choice(devices).id
+        start = rng.randrange(START, max(START + 1, end - 3600))
+        t = time.perf_counter()
+        store.range(device, start, start + 3600)
+        timings['range 1 h'].append(time.perf_counter() - t)
+        t = time.perf_counter()
+        store.range(device, START, end)
+        timings['range all'].append(time.perf_counter() - t)
+        t = time.perf_counter()
+        store.downsample(device, START, end, 60)
+        timings['downsample 60 s'].append(time.perf_counter() - t)
+    # every valid record arrived, once
+    missing = 0
+    for device in devices:
+        rows = store.range(device.id, START, end, ('battery_voltage',), raw=True)
+        if len(rows['time']) != device.rows or int(rows['battery_voltage'].astype(np.int64).sum()) != device.total:
+            missing += 1
+    partitions = sum(len(store.days(device.id)) for device in devices)
+    store.close()
+    return timings, missing, partitions
+
+
+def disk_usage(root):
+    used = 0
+    for path, dirs, files in os.walk(root):
+        for name in files:
+            used += os.stat(os.path.join(path, name)).st_blocks * 512
+    return used
+
+
+async def bench(count, seconds, transport, root):
+    broker = Broker()
+    store = ColumnStore(root)
+    ingester = Ingester(store)
+    worker = asyncio.ensure_future(ingester.run())
+    bridge = None
+    if transport == 'tcp':
+        bridge = TCPBridge(broker)
+        await bridge.start()
+        subscriber = asyncio.ensure_future(
+            subscribe('127.0.0.1', bridge.port, (TOPIC, TOPIC + '/#'), ingester.put))
+        while not broker.subscribers:
+            await asyncio.sleep(0.001)
+        pending = lambda: ingester.queue.qsize() + bridge.buffered() // 30
+    else:
+        broker.listen(TOPIC + '/#', ingester.submit)
+        pending = ingester.queue.qsize
+    devices = [Device(i, broker, random.Random(i)) for i in range(count)]
+
+    start = time.perf_counter()
+    messages, malformed, rounds = await generate(devices, ingester, seconds, pending)
+    while ingester.messages + ingester.dropped < messages:
+        await asyncio.sleep(0.001)
+    await ingester.drain()
+    elapsed = time.perf_counter() - start
+    worker.cancel()
+    if bridge is not None:
+        subscriber.cancel()
+        await bridge.close()
+    store.close()
+    return devices, messages, malformed, rounds, elapsed, ingester
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEVICES
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else SECONDS
+    transport = sys.argv[3] if len(sys.argv) > 3 else 'local'
+    raise_file_limit()
+    root = tempfile.mkdtemp(prefix='hppc-store-')
+    try:
+        devices, messages, malformed, rounds, elapsed, ingester = asyncio.run(bench(count, seconds, transport, root))
+        print('{} devices over {}, {} rounds ({:.1f} h of device time) in {:.1f} s'.format(
+            count, transport, rounds, rounds * INTERVAL / 3600, elapsed))
+        print('messages  published {}  ingested {}  dropped {}  in {} batches'.format(
+            messages, ingester.messages, ingester.dropped, ingester.batches))
+        print('records   stored {}  rejected {} (sent {} malformed)'.format(
+            ingester.records, dict(ingester.rejected), malformed))
+        print('sustained {:.0f} messages/s, {:.0f} records/s with the emulated fleet on the same CPU'.format(
+            messages / elapsed, ingester.records / elapsed))
+        print('service   {:.1f} CPU s parsing and writing, capacity {:.0f} messages/s, {:.0f} records/s'.format(
+            ingester.busy, ingester.messages / ingester.busy, ingester.records / ingester.busy))
+        timings, missing, partitions = queries(root, devices, rounds)
+        print('store     {} partitions, {:.1f} MB on disk, {:.1f} B/record'.format(
+            partitions, disk_usage(root) / 1e6, disk_usage(root) / max(1, ingester.records)))
+        print('{:<18} {:>10} {:>10} {:>10}'.format('query', 'mean ms', 'p50 ms', 'p99 ms'))
+        for name, samples in timings.items():
+            print('{:<18} {:>10.3f} {:>10.3f} {:>10.3f}'.format(name, *percentiles(samples)))
+        print('devices with missing or extra records: {}'.format(missing))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    if missing or ingester.dropped:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''
+State logging over a simulated day: the old full rewrite of log.txt on every publish against the
+journal (libs/journal.py) that only appends a slot when the state moved.
+Reports writes and bytes written per day, host write latency and the flash blocks an append-only
+writer would program, then checks the boot-time recovery after a torn write and times it.
+Run from the repository root:  python -m sim.bench_journal [hours]
+'''
+import os
+import sys
+import time
+from json import dumps
+
+import sim
+from sim.clock import Clock
+from sim.waveforms import pulses, sine
+
+HOURS = 24
+BLOCK = 4096  # flash erase block
+
+
+def rewrite_log(firmware):
+    '''log_state() as it was: DATA, CONFIG and hppc_config rewritten on every publish'''
+    with open('log.txt', 'w') as f:
+        f.write(dumps(firmware.DATA))
+        f.write('\n')
+        f.write(dumps(firmware.CONFIG))
+        f.write('\n')
+        f.write(dumps(firmware.hppc_config))
+        f.write('\n')
+        f.write(str(firmware.test_count))
+    return os.stat('log.txt')[6]
+
+
+def day(t):
+    '''Readings at t ms: a daily solar curve with cloud, a cycling load and a battery following both'''
+    hour = t / 3600000 % 24
+    sun = max(0.0, sine(0, 1, 24 * 3600000, -6 * 3600000)(t))
+    cloud = 0.7 + 0.3 * sine(0, 1, 1300000)(t)
+    return {
+        'solar_current': 8 * sun * cloud,
+        'solar_voltage': 36 if sun > 0 else 0,
+        'scc_load_current': pulses(0.8, 2.5, 900000, 120000)(t),
+        'scc_load_voltage': 25.0,
+        'battery_voltage': 24.2 + 1.4 * sun + 0.05 * sine(0, 1, 60000)(t),
+        'battery_current': 8 * sun * cloud - 1.2,
+        'temperature': 18 + 12 * sun + (2 if 12 <= hour < 15 else 0),
+        }
+
+
+def simulate(firmware, clock, hours):
+    values = firmware.readings.values
+    interval = firmware.CONFIG['LOG_INTERVAL']
+    old = {'writes': 0, 'bytes': 0, 'blocks': 0, 'latency': 0, 'worst': 0}
+    new = {'latency': 0, 'worst': 0}
+    for i in range(int(hours * 3600000 / interval)):
+        clock.advance(interval)
+        for name, value in day(clock.now).items():
+            scale = dict(firmware.telemetry.FIELDS)[name]
+            values[firmware.readings.index[name]] = int(round(value * scale))
+        firmware.update_data()
+        firmware.DATA['time'] = firmware.getTime()
+
+        start = time.perf_counter()
+        size = rewrite_log(firmware)
+        elapsed = time.perf_counter() - start
+        old['writes'] += 1
+        old['bytes'] += size
+        # a rewritten file goes to freshly erased blocks
+        old['blocks'] += (size + BLOCK - 1) // BLOCK
+        old['latency'] += elapsed
+        old['worst'] = max(old['worst'], elapsed)
+
+        start = time.perf_counter()
+        firmware.log_state()
+        elapsed = time.perf_counter() - start
+        new['latency'] += elapsed
+        new['worst'] = max(new['worst'], elapsed)
+    return i + 1, old, new
+
+
+def main():
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else HOURS
+    clock = Clock()
+    firmware = sim.load_firmware({'LOG_INTERVAL': 5000}, clock=clock)
+    firmware.setup()
+    # readings are scripted directly, no need for the acquisition timer
+    firmware.acquisition.stop()
+    journal = firmware.journal
+    ticks, old, new = simulate(firmware, clock, hours)
+
+    per_day = 24 / hours
+    print('{} publishes over {:g} h'.format(ticks, hours))
+    print('{:<16} {:>10} {:>14} {:>16} {:>14} {:>14}'.format(
+        'per day', 'writes', 'bytes', 'blocks (est.)', 'mean us', 'worst us'))
+    print('{:<16} {:>10.0f} {:>14.0f} {:>16.0f} {:>14.1f} {:>14.1f}'.format(
+        'log.txt rewrite', old['writes'] * per_day, old['bytes'] * per_day, old['blocks'] * per_day,
+        old['latency'] / ticks * 1e6, old['worst'] * 1e6))
+    print('{:<16} {:>10.0f} {:>14.0f} {:>16.1f} {:>14.1f} {:>14.1f}'.format(
+        'journal', journal.writes * per_day, journal.bytes_written * per_day,
+        journal.bytes_written * per_day / BLOCK, new['latency'] / ticks * 1e6, new['worst'] * 1e6))
+    capacity = (journal.files - 1) * journal.slots
+    print('journal keeps at least {} records, {:.1f} days at this rate'.format(
+        capacity, capacity / (journal.writes * per_day) if journal.writes else float('inf')))
+
+    # a reset in the middle of a write leaves half a slot behind
+    newest = journal.seq
+    with open(journal._file_path(journal.file), 'ab') as f:
+        f.write(b'\x53\x4a' + bytes(journal.slot_size // 2))
+    start = time.perf_counter()
+    recovered = firmware.Journal(journal.path, journal.slot_size, journal.slots, journal.files)
+    last = recovered.recover()
+    elapsed = time.perf_counter() - start
+    print('recovery after a torn write: record {} of {} in {:.0f} us, {} records readable'.format(
+        last[0], newest, elapsed * 1e6, len(recovered.records())))
+    seq = recovered.append(bytes(firmware.journal_buf))
+    print('next record {} went to file {} slot {}'.format(seq, recovered.file, recovered.used - 1))
+    decoded = firmware.telemetry.decode(recovered.recover()[1])
+    print('newest record decodes to battery_voltage {}'.format(decoded['battery_voltage']))
+
+
+if __name__ == '__main__':
+    main()
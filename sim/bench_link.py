@@ -0,0 +1,68 @@
+'''
+Compares the legacy per-iteration ping_google() probe with LinkMonitor over a simulated hour.
+Run from the repository root:  python -m sim.bench_link
+'''
+from libs.link_monitor import LinkMonitor
+from sim.clock import Clock
+from sim.network import WLAN, STA_IF
+from sim.uping import Ping
+
+DURATION = 3600 * 1000
+LOOP_WORK = 50  # ms of sampling work per loop iteration
+# (start, end, wifi_up) outages in ms: AP lost, then AP up but no internet behind it
+OUTAGES = ((20 * 60000, 30 * 60000, False), (40 * 60000, 45 * 60000, True))
+
+
+def apply_outages(clock, wlan, ping):
+    wlan.link_up = True
+    ping.reachable = True
+    for start, end, wifi_up in OUTAGES:
+        if start <= clock.now < end:
+            wlan.link_up = wifi_up
+            ping.reachable = False
+
+
+def legacy_probe(ping):
+    return ping('google.com', count=4, timeout=5000, interval=10, quiet=True, size=64) == (4, 4)
+
+
+def run(use_monitor):
+    clock = Clock()
+    wlan = WLAN(STA_IF)
+    wlan.active(True)
+    wlan.connect('site')
+    ping = Ping(clock)
+    monitor = LinkMonitor(wlan, ping, clock=clock)
+    iterations = 0
+    worst = 0
+    detected = {}
+    while clock.now < DURATION:
+        apply_outages(clock, wlan, ping)
+        start = clock.now
+        clock.advance(LOOP_WORK)
+        if use_monitor:
+            connected = monitor.poll()
+        else:
+            connected = legacy_probe(ping)
+        for outage in OUTAGES:
+            if not connected and outage[0] <= start < outage[1] and outage not in detected:
+                detected[outage] = clock.now - outage[0]
+        worst = max(worst, clock.now - start)
+        iterations += 1
+    return {
+        'iterations': iterations,
+        'worst loop ms': worst,
+        'blocked ms': ping.blocked,
+        'icmp echoes': ping.echoes,
+        'detect ms': [detected.get(o) for o in OUTAGES],
+    }
+
+
+def main():
+    for name, use_monitor in (('ping_google', False), ('LinkMonitor', True)):
+        result = run(use_monitor)
+        print('{:<12} '.format(name) + '  '.join('{}={}'.format(k, v) for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''
+Accuracy and speed of the temperature lookup table (libs/lut.py) against the analytic conversion,
+over every 13 bit ADC code.
+Run from the repository root:  python -m sim.bench_lut
+'''
+import time
+
+import sim
+from libs.acquisition import Channel
+from libs.lut import ConversionTable, CODES
+from sim.machine import ADC, Pin
+
+STEPS = (1, 4, 16, 64, 256)
+# the range the board is expected to see, errors are only measured inside it
+OPERATING = (-40, 125)
+
+
+def main():
+    firmware = sim.load_firmware()
+    channel = Channel(ADC(Pin(7)))
+    thermistor = sim.temperature.NTC_Temperature(channel, **firmware.NTC_PARAMETERS)
+
+    exact = []
+    for code in range(CODES):
+        channel.value = code
+        exact.append(thermistor.get_temperature())
+
+    start = time.perf_counter()
+    for code in range(CODES):
+        channel.value = code
+        thermistor.get_temperature()
+    analytic = (time.perf_counter() - start) / CODES
+    print('analytic: {:.2f} us/conversion'.format(analytic * 1e6))
+    print('{:>5} {:>8} {:>8} {:>12} {:>12} {:>12} {:>10}'.format(
+        'step', 'entries', 'bytes', 'build ms', 'max err C', 'rms err C', 'us/conv'))
+    for step in STEPS:
+        start = time.perf_counter()
+        table = ConversionTable.build(channel, thermistor.get_temperature, step=step, scale=100)
+        build = time.perf_counter() - start
+        worst = 0
+        total = 0
+        n = 0
+        for code in range(CODES):
+            if not OPERATING[0] <= exact[code] <= OPERATING[1]:
+                continue
+            err = abs(table.convert(code) - exact[code])
+            worst = max(worst, err)
+            total += err * err
+            n += 1
+        start = time.perf_counter()
+        for code in range(CODES):
+            table.convert(code)
+        lookup = (time.perf_counter() - start) / CODES
+        print('{:>5} {:>8} {:>8} {:>12.1f} {:>12.4f} {:>12.4f} {:>10.2f}'.format(
+            step, len(table.table), len(table.table) * 2, build * 1000, worst, (total / n) ** 0.5, lookup * 1e6))
+    print('errors over {} of {} codes where {} <= T <= {} C'.format(n, CODES, *OPERATING))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+'''
+Injects fault waveforms into the fast protection path and reports detection time, measured
+from the start of the waveform. Every acquisition round is one ACQUISITION_PERIOD of simulated time.
+Run from the repository root:  python -m sim.bench_protection
+'''
+import time
+
+from libs.acquisition import Acquisition
+from libs.protection import Protection, threshold_code
+from sim.config_proc import hppc_config
+from sim.machine import ADC, Pin, Timer
+from sim.power_monitoring import CurrentRead, VoltageRead
+
+ACQUISITION_PERIOD = 1  # ms
+ROUNDS = 2000
+ONSET = 500             # round at which the fault starts
+NOISE = 6               # ADC codes (1 sigma)
+NOMINAL = {'load_v': 24.0, 'load_i': 1.5, 'batt_v': 26.0}
+
+# name -> (signal, function of round giving the faulty value)
+SCENARIOS = (
+    ('over-current step', 'load_i', lambda n: 8.0),
+    ('over-voltage ramp', 'load_v', lambda n: 26.0 + 8.0 * min(n, 400) / 400),
+    ('under-voltage dip', 'load_v', lambda n: 15.0),
+    ('battery over-voltage', 'batt_v', lambda n: 31.0),
+    ('2 ms current spike', 'load_i', lambda n: 12.0 if n < 2 else NOMINAL['load_i']),
+    ('no fault', 'load_i', lambda n: NOMINAL['load_i']),
+    )
+
+
+def build():
+    adcs = {}
+    acq = Acquisition(Timer(0), period=ACQUISITION_PERIOD)
+    channels = {}
+    for name in ('load_i', 'load_v', 'batt_v'):
+        adcs[name] = ADC(Pin(0), noise=NOISE)
+        adcs[name].width(ADC.WIDTH_13BIT)
+        channels[name] = acq.add(adcs[name], oversample=16)
+    readers = {
+        'load_i': CurrentRead(channels['load_i'], 1.688, -0.008, 3.332, 'LOAD_CURRENT', 88700, 20000).get_current,
+        'load_v': VoltageRead(channels['load_v'], 0, 0.1, 'LOAD_VOLTAGE', 88700, 1000000).get_voltage,
+        'batt_v': VoltageRead(channels['batt_v'], 0.001, 0, 'BATTERY_VOLTAGE', 88700, 1000000).get_voltage,
+        }
+    return acq, adcs, channels, readers
+
+
+def run(scenario):
+    name, signal, fault = scenario
+    acq, adcs, channels, readers = build()
+    loads = [Pin(12, Pin.OUT, value=1), Pin(11, Pin.OUT, value=1)]
+    tripped_at = []
+
+    def trip_loads():
+        for pin in loads:
+            pin.value(0)
+
+    protection = Protection(channels['load_i'], channels['load_v'], channels['batt_v'], trip_loads)
+    protection.set_limits(threshold_code(channels['load_v'], readers['load_v'], hppc_config['SCC_MAX_VOLTAGE']),
+                          threshold_code(channels['load_v'], readers['load_v'], hppc_config['SCC_MIN_VOLTAGE']),
+                          threshold_code(channels['load_i'], readers['load_i'], hppc_config['SCC_MAX_CURRENT']),
+                          threshold_code(channels['batt_v'], readers['batt_v'], hppc_config['BATT_MAX_VOLTAGE']))
+    codes = {}
+
+    def code(key, value):
+        # cache the value -> code conversion, it is a binary search through the reader
+        if (key, value) not in codes:
+            codes[(key, value)] = threshold_code(channels[key], readers[key], value)
+        return codes[(key, value)]
+
+    for key, adc in adcs.items():
+        if key == signal:
+            adc.set_source(lambda n, key=key: code(key, fault(n - ONSET) if n >= ONSET else NOMINAL[key]))
+        else:
+            adc.set_source(lambda n, key=key: code(key, NOMINAL[key]))
+    worst_check = [0]
+
+    def timed_check():
+        start = time.perf_counter()
+        protection.check()
+        worst_check[0] = max(worst_check[0], time.perf_counter() - start)
+
+    acq.hook = timed_check
+    for n in range(ROUNDS):
+        acq.sample_all()
+        if not tripped_at and loads[0].value() == 0:
+            tripped_at.append(n)
+    detect = (tripped_at[0] - ONSET + 1) * ACQUISITION_PERIOD if tripped_at else None
+    return name, protection.tripped, detect, worst_check[0] * 1e6
+
+
+def main():
+    print('{:<22} {:>8} {:>12} {:>18}'.format('scenario', 'tripped', 'detect (ms)', 'host check (us)'))
+    for scenario in SCENARIOS:
+        name, tripped, detect, worst = run(scenario)
+        print('{:<22} {:>8} {:>12} {:>18.1f}'.format(name, bin(tripped), '-' if detect is None else detect, worst))
+    print('bound: trip_count x period = {} ms plus one check() call'.format(3 * ACQUISITION_PERIOD))
+
+
+if __name__ == '__main__':
+    main()
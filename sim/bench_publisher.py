@@ -0,0 +1,92 @@
+'''
+Compares blocking umqtt.simple QoS 1 publishing with the pipelined Publisher against the in-process broker.
+Runs on a virtual clock: the broker answers after its latency and the loop ticks once per ms, so
+throughput and latency are in simulated time and don't depend on the host.
+Run from the repository root:  python -m sim.bench_publisher
+'''
+import time
+
+from libs.publisher import Publisher
+from sim.clock import Clock
+from sim.mqtt import Broker, MQTTClient
+
+MESSAGES = 500
+PAYLOAD = b'x' * 120
+LATENCIES = (5, 50, 250)  # ms broker round trip
+WINDOWS = (1, 4, 8, 16)
+TOPIC = b'hppc/data'
+
+
+def connect(latency, clock):
+    broker = Broker(latency=latency, clock=clock)
+    client = MQTTClient('bench', '127.0.0.1', keepalive=60)
+    client.broker = broker
+    return broker, client
+
+
+def blocking(latency):
+    clock = Clock()
+    broker, client = connect(latency, clock)
+    client.connect()
+    start = clock.now
+    worst_stall = 0
+    cpu = time.perf_counter()
+    for i in range(MESSAGES):
+        before = clock.now
+        client.publish(TOPIC, PAYLOAD, qos=1)
+        worst_stall = max(worst_stall, clock.now - before)
+    cpu = time.perf_counter() - cpu
+    elapsed = clock.now - start
+    return elapsed, worst_stall, latency, cpu, len(broker.messages)
+
+
+def pipelined(latency, window, drop_acks=0, disconnect_at=None):
+    clock = Clock()
+    broker, client = connect(latency, clock)
+    broker.drop_acks = drop_acks
+    publisher = Publisher(client, window=window, queue=window, retry_timeout=4 * latency + 100, clock=clock)
+    publisher.connect()
+    start = clock.now
+    sent = 0
+    worst_stall = 0
+    cpu = time.perf_counter()
+    while sent < MESSAGES or publisher.pending():
+        before = clock.now
+        while sent < MESSAGES and publisher.available() > 0:
+            publisher.publish(TOPIC, PAYLOAD + str(sent).encode())
+            sent += 1
+        publisher.poll()
+        if disconnect_at is not None and sent >= disconnect_at:
+            publisher.drop()
+            disconnect_at = None
+            publisher.connect()
+        worst_stall = max(worst_stall, clock.now - before)
+        clock.advance(1)
+    cpu = time.perf_counter() - cpu
+    elapsed = clock.now - start
+    distinct = len(set(m[2] for m in broker.messages))
+    return elapsed, worst_stall, publisher, cpu, distinct
+
+
+def main():
+    print('{} QoS 1 messages of {} bytes'.format(MESSAGES, len(PAYLOAD)))
+    for latency in LATENCIES:
+        elapsed, stall, ack, cpu, received = blocking(latency)
+        print('latency {:>3} ms  blocking      {:>8.0f} msg/s  ack {:>6.1f} ms  worst stall {:>4} ms  {:>6.1f} us cpu/msg'.format(
+            latency, MESSAGES * 1000 / elapsed, ack, stall, cpu * 1e6 / MESSAGES))
+        for window in WINDOWS:
+            elapsed, stall, publisher, cpu, received = pipelined(latency, window)
+            print('latency {:>3} ms  window {:>2}     {:>8.0f} msg/s  ack {:>6.1f} ms  worst stall {:>4} ms  {:>6.1f} us cpu/msg'.format(
+                latency, window, MESSAGES * 1000 / elapsed, publisher.total_latency / publisher.acked,
+                stall, cpu * 1e6 / MESSAGES))
+
+    # lost acknowledgements and a dropped session must not lose messages
+    elapsed, stall, publisher, cpu, received = pipelined(50, 8, drop_acks=20)
+    print('20 lost PUBACKs:     {} distinct delivered, {} retransmits, worst ack {} ms'.format(
+        received, publisher.retransmits, publisher.worst_latency))
+    elapsed, stall, publisher, cpu, received = pipelined(50, 8, disconnect_at=MESSAGES // 2)
+    print('session drop:        {} distinct delivered, {} retransmits'.format(received, publisher.retransmits))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+'''
+Runs the main.py task runtime under CPython against the stand-ins and reports per-task start lateness.
+Run from the repository root:  python -m sim.bench_runtime [seconds]
+'''
+import sys
+
+import sim
+
+DURATION = 10  # s per scenario
+# broker round trip in ms
+LATENCIES = (0, 250, 1000)
+
+
+def run(latency, duration):
+    main = sim.load_firmware({'LOG_INTERVAL': 1000})
+    main.blink_debug_led = lambda times: None
+    sim.mqtt.MQTTClient.broker = sim.mqtt.Broker(latency=latency)
+    from libs.tasks import asyncio, TASK_STATS
+    TASK_STATS.clear()
+
+    async def bounded():
+        try:
+            await asyncio.wait_for(main.main(), duration)
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(bounded())
+    return main, dict(TASK_STATS)
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else DURATION
+    for latency in LATENCIES:
+        firmware, stats = run(latency, duration)
+        broker = sim.mqtt.MQTTClient.broker
+        print('broker latency {} ms: {} data messages, watchdog margin {:.0f} ms'.format(
+            latency, len(broker.topic_messages('hppc/data')), firmware.wdt.margin()))
+        for name in sorted(stats):
+            print('    {!r}'.format(stats[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+Benchmarks spool append and batched replay against the in-process broker, and checks that a batch
+still in flight when its segment is evicted commits none of the records that replaced it.
+Run from the repository root:  python -m sim.bench_spool
+'''
+import os
+import sys
+import tempfile
+import time
+
+import sim
+from libs.spool import Spool
+
+RECORDS = 2000
+BATCHES = (1, 10, 20, 50)
+
+
+def main():
+    firmware = sim.load_firmware()
+    broker = sim.mqtt.Broker()
+    sim.mqtt.MQTTClient.broker = broker
+    spool = firmware.spool
+    print('record size: {} bytes, capacity: {} records'.format(
+        spool.record_size, spool.segment_records * spool.max_segments))
+
+    start = time.perf_counter()
+    for i in range(RECORDS):
+        firmware.DATA['battery_voltage'] = 24 + i / RECORDS
+        spool.append(firmware.pack_record())
+    elapsed = time.perf_counter() - start
+    print('append: {:.0f} records/s ({} pending)'.format(RECORDS / elapsed, spool.pending()))
+
+    firmware.DATA['connected_to_wifi'] = True
+    firmware.mqtt_setup('bench', '127.0.0.1', None, None, 60000)
+    for batch in BATCHES:
+        firmware.SPOOL_BATCH = batch
+        published = len(broker.messages)
+        payload_bytes = broker.bytes_in
+        records = spool.pending()
+        start = time.perf_counter()
+        while spool.pending():
+            firmware.drain_spool()
+            firmware.publisher.poll()
+        elapsed = time.perf_counter() - start
+        print('drain batch {:>3}: {:>5} records {:>8.0f} records/s, {:>5} publishes, {:>8} bytes'.format(
+            batch, records, records / elapsed, len(broker.messages) - published, broker.bytes_in - payload_bytes))
+        for i in range(RECORDS):
+            spool.append(firmware.pack_record())
+
+    overflow = spool.segment_records * spool.max_segments + RECORDS
+    for i in range(overflow):
+        spool.append(firmware.pack_record())
+    print('after {} more appends: {} pending, {} evicted'.format(overflow, spool.pending(), spool.dropped))
+
+    if not evicted_in_flight():
+        print('CHECK FAILED')
+        sys.exit(1)
+
+
+def evicted_in_flight():
+    '''A batch is read, the outage goes on until its segment is evicted, then the broker acknowledges it'''
+    spool = Spool(os.path.join(tempfile.mkdtemp(prefix='hppc-spool-'), 'spool'), 4, segment_records=4, max_segments=3)
+    appended = 0
+    for i in range(10):
+        spool.append(appended.to_bytes(4, 'big'))
+        appended += 1
+    for batch in (3, 6):
+        head = spool.head()
+        sent = [int.from_bytes(r, 'big') for r in spool.read_batch(batch)]
+        # fills the newest segment and starts another, evicting the one the batch was read from
+        while spool.head() == head:
+            spool.append(appended.to_bytes(4, 'big'))
+            appended += 1
+        # every record after the batch that wasn't evicted must still be there
+        oldest = spool.head()[0] * 4
+        spool.commit(len(sent), head)
+        unsent = [int.from_bytes(r, 'big') for r in spool.read_batch(spool.pending())]
+        ok = unsent == list(range(max(sent[-1] + 1, oldest), appended))
+        print('batch of {} {} evicted in flight: {} left from record {}, {}'.format(
+            batch, sent, len(unsent), unsent[0], 'ok' if ok else 'WRONG RECORDS COMMITTED'))
+        if not ok:
+            return False
+    return True
+
+
+if __name__ == '__main__':
+    main()
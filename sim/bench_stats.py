@@ -0,0 +1,109 @@
+'''
+Checks libs/stats.py WindowStats against NumPy (float64) over long synthetic streams of readings in
+the record's integer scaling, and times add(). A naive single precision sum / sum of squares is run
+alongside to show what the compensated Welford update saves. Exits with status 1 when any window disagrees.
+Run from the repository root:  python -m sim.bench_stats [longest window]
+'''
+import random
+import sys
+import time
+from array import array
+
+import numpy as np
+
+from libs.stats import WindowStats
+from libs.telemetry import FIELDS
+
+WINDOWS = (50, 9000, 200000)  # one 5 s publish window, 15 min and about 5.5 h at 10 Hz
+# relative tolerance for the mean and RMS, a few single precision ulps whatever the window length
+TOLERANCE = 1e-6
+
+
+def stream(n, seed):
+    '''n samples of every telemetry field, roughly what the board reads, with load spikes'''
+    rng = random.Random(seed)
+    channels = []
+    for name, scale in FIELDS:
+        if name.endswith('voltage'):
+            base, noise = 25 * scale, 0.05 * scale
+        elif name == 'temperature':
+            base, noise = 30 * scale, 0.3 * scale
+        else:
+            base, noise = 2 * scale, 0.02 * scale
+        samples = [int(base + rng.gauss(0, noise)) for i in range(n)]
+        if name == 'scc_load_current':
+            for i in range(0, n, 97):
+                samples[i] = int(4.5 * scale)
+        channels.append(samples)
+    return channels
+
+
+class NaiveStats:
+    '''Running sum and sum of squares in single precision, for comparison'''
+    def __init__(self, channels):
+        self.count = 0
+        self.total = array('f', [0] * channels)
+        self.squares = array('f', [0] * channels)
+
+    def add(self, values):
+        self.count += 1
+        for i in range(len(self.total)):
+            x = values[i]
+            self.total[i] += x
+            self.squares[i] += x * x
+
+    def mean(self, i):
+        return self.total[i] / self.count
+
+    def rms(self, i):
+        return (self.squares[i] / self.count) ** 0.5
+
+
+def relative(a, b):
+    return abs(a - b) / abs(b) if b else abs(a)
+
+
+def check(n):
+    channels = stream(n, n)
+    stats = WindowStats(len(FIELDS))
+    naive = NaiveStats(len(FIELDS))
+    rows = list(zip(*channels))
+    start = time.perf_counter()
+    for row in rows:
+        stats.add(row)
+    elapsed = time.perf_counter() - start
+    for row in rows:
+        naive.add(row)
+    worst = worst_naive = 0
+    ok = True
+    for i in range(len(FIELDS)):
+        x = np.array(channels[i], dtype=np.float64)
+        mean = x.mean()
+        rms = np.sqrt(np.mean(x * x))
+        if stats.low[i] != x.min() or stats.high[i] != x.max() or stats.count[i] != n:
+            ok = False
+        error = max(relative(stats.mean(i), mean), relative(stats.rms(i), rms))
+        worst = max(worst, error)
+        worst_naive = max(worst_naive, relative(naive.mean(i), mean), relative(naive.rms(i), rms))
+        if error > TOLERANCE:
+            ok = False
+    return ok, worst, worst_naive, elapsed / n * 1e6
+
+
+def main():
+    windows = WINDOWS
+    if len(sys.argv) > 1:
+        windows = tuple(w for w in WINDOWS if w < int(sys.argv[1])) + (int(sys.argv[1]),)
+    print('{:>8} {:>8} {:>18} {:>18} {:>14}'.format('samples', 'agrees', 'welford rel err', 'naive rel err', 'add() us'))
+    failed = False
+    for n in windows:
+        ok, worst, worst_naive, us = check(n)
+        failed = failed or not ok
+        print('{:>8} {:>8} {:>18.2e} {:>18.2e} {:>14.2f}'.format(n, 'yes' if ok else 'NO', worst, worst_naive, us))
+    print('min, max and count must match exactly, mean and RMS within {:g} relative'.format(TOLERANCE))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+'''
+Compares the JSON dumps(DATA) payload with the binary telemetry record:
+bytes per message (topic + payload) and encode time.
+Run from the repository root:  python -m sim.bench_telemetry
+'''
+import random
+import time
+
+import sim
+from tools.decode_telemetry import decode_message
+
+MESSAGES = 20000
+
+
+def randomise(firmware):
+    values = firmware.readings.values
+    values[firmware.LOAD_V] = random.randint(2200, 2800)
+    values[firmware.LOAD_I] = random.randint(0, 4000)
+    values[firmware.BATTERY_V] = random.randint(2300, 2900)
+    values[firmware.BATTERY_I] = random.randint(-5000, 5000)
+    values[firmware.SOLAR_V] = random.randint(0, 4500)
+    values[firmware.SOLAR_I] = random.randint(0, 8000)
+    values[firmware.TEMPERATURE] = random.randint(1000, 5000)
+    # what send_data() publishes
+    firmware.readings.export(firmware.DATA)
+
+
+def bench(firmware, payload_format):
+    firmware.CONFIG['PAYLOAD_FORMAT'] = payload_format
+    sizes = 0
+    elapsed = 0
+    for i in range(MESSAGES):
+        randomise(firmware)
+        firmware.DATA['time'] = firmware.getTime()
+        start = time.perf_counter()
+        topic = firmware.data_topic()
+        payload = firmware.data_payload()
+        elapsed += time.perf_counter() - start
+        sizes += len(topic) + len(payload)
+    return sizes / MESSAGES, elapsed / MESSAGES * 1e6, topic, bytes(payload)
+
+
+def main():
+    firmware = sim.load_firmware()
+    firmware.DATA['connected_to_wifi'] = True
+    print('{:<8} {:>14} {:>16}'.format('format', 'bytes/message', 'encode (us)'))
+    results = {}
+    for payload_format in ('json', 'binary'):
+        size, encode_us, topic, payload = bench(firmware, payload_format)
+        results[payload_format] = size
+        print('{:<8} {:>14.1f} {:>16.2f}'.format(payload_format, size, encode_us))
+    print('binary is {:.1%} of the JSON size'.format(results['binary'] / results['json']))
+    # round trip of the last binary message
+    decoded = decode_message(topic, payload)[0]
+    print('decoded: battery_voltage {} (sent {:.4f})'.format(decoded['battery_voltage'], firmware.DATA['battery_voltage']))
+
+
+if __name__ == '__main__':
+    main()
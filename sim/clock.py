@@ -0,0 +1,76 @@
+from heapq import heappush, heappop
+from time import perf_counter
+
+
+class Clock:
+    '''
+    Virtual millisecond clock.
+    Fakes that would block on real hardware advance this clock instead of sleeping,
+    which makes stalls measurable and runs deterministic.
+    Callbacks scheduled with schedule() (e.g. by machine.Timer) fire at their due time while the
+    clock is advanced, the way a hardware timer interrupt would.
+    With `cpu_scale` set, sync() also moves the clock on by the host CPU time used since the last
+    sync times cpu_scale, so computation costs virtual time (roughly how much slower the device is).
+    '''
+    def __init__(self, start=0, cpu_scale=0):
+        self.now = start
+        self.cpu_scale = cpu_scale
+        self.timers = []    # heap of (due, sequence, handle)
+        self.sequence = 0
+        self.fired = 0
+        self._real = None
+        self._advancing = False
+
+    def ticks_ms(self):
+        return self.now
+
+    def schedule(self, delay, callback, period=0):
+        '''Calls callback() after `delay` ms, then every `period` ms if period is not 0. Returns a handle for cancel().'''
+        handle = [callback, period, True]
+        self.sequence += 1
+        heappush(self.timers, (self.now + delay, self.sequence, handle))
+        return handle
+
+    def cancel(self, handle):
+        handle[2] = False
+
+    def sync(self):
+        '''Charges the host CPU time since the last sync to the clock, when cpu_scale is set'''
+        if not self.cpu_scale or self._advancing:
+            return
+        real = perf_counter()
+        if self._real is not None:
+            self.advance((real - self._real) * 1000 * self.cpu_scale)
+        # time spent in timer callbacks is charged by the next sync
+        self._real = real
+
+    def advance(self, ms):
+        if self._advancing:
+            # a timer callback that blocks only moves time on, the outer advance fires the timers
+            self.now += ms
+            return self.now
+        self._advancing = True
+        try:
+            target = self.now + ms
+            while self.timers and self.timers[0][0] <= target:
+                due, sequence, handle = heappop(self.timers)
+                callback, period, active = handle
+                if not active:
+                    continue
+                if due > self.now:
+                    self.now = due
+                if period:
+                    self.sequence += 1
+                    heappush(self.timers, (due + period, self.sequence, handle))
+                else:
+                    handle[2] = False
+                self.fired += 1
+                callback()
+            if target > self.now:
+                self.now = target
+        finally:
+            self._advancing = False
+        return self.now
+
+    # allows a Clock instance to be passed wherever a ticks_ms function is expected
+    __call__ = ticks_ms
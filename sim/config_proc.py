@@ -0,0 +1,48 @@
+'''
+Stand-in for libs.config_proc with a fixed default configuration.
+update_config_file() only changes the in-memory copy.
+'''
+import json
+
+DEFAULT_CONFIG = {
+    'ID': 'HPPC-SIM-0001',
+    'SITE_ID': ['SITE-SIM'],
+    'WIFI_CREDENTIALS': {'SIM_SITE': ['sim-ssid', 'sim-password']},
+    'MQTT': {
+        'CREDENTIALS': ['sim-user', 'sim-password'],
+        'MQTT_SERVER': ['127.0.0.1'],
+        'MQTT_DATA_TOPIC': ['hppc/data'],
+        'MQTT_CONTROL_TOPIC': ['hppc/control'],
+        },
+    'CHARGER_PROFILE': 'gamistar',
+    'LOG_INTERVAL': 5000,
+    'LOAD_RESET_INTERVAL': 60000,
+    '12V_LOAD_ON': True,
+    'POE_LOAD_ON': True,
+    'TIMEZONE': 0,
+    'CONFIG_FILE': 'config.json',
+    'SCC_MAX_VOLTAGE': 30,
+    'SCC_MIN_VOLTAGE': 20,
+    'SCC_MAX_CURRENT': 5,
+    'BATT_MAX_VOLTAGE': 29.5,
+    }
+
+
+hppc_config = json.loads(json.dumps(DEFAULT_CONFIG))
+
+
+def reset(overrides=None):
+    '''Restores the default configuration in place, then applies `overrides`'''
+    hppc_config.clear()
+    hppc_config.update(json.loads(json.dumps(DEFAULT_CONFIG)))
+    if overrides:
+        hppc_config.update(overrides)
+
+
+def load_config():
+    return json.loads(json.dumps(hppc_config))
+
+
+def update_config_file(key, value):
+    hppc_config[key] = value
+    return '{} updated'.format(key)
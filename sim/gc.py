@@ -0,0 +1,61 @@
+'''
+Stand-in for the MicroPython gc module: the CPython gc functions plus mem_alloc(), mem_free() and
+threshold(). The heap is HEAP bytes, of which the memory traced by tracemalloc counts as allocated
+(nothing while tracemalloc is not running). Calls to collect() and the threshold are recorded.
+With model_heap set the heap is modelled on MicroPython's instead: what was allocated stays allocated,
+garbage included, until collect() drops it to the memory still traced, and collect() runs by itself
+once the threshold is passed. The model allocates and resets the peak of tracemalloc, so it is left
+off unless asked for, e.g. by sim.bench_diagnostics.
+'''
+import tracemalloc
+from gc import *
+from gc import collect as _collect
+
+HEAP = 200000  # roughly the MicroPython heap of an ESP32-S3 without PSRAM
+collections = 0
+allocation_threshold = -1
+model_heap = False
+allocated = 0  # bytes of the model heap in use, live or garbage
+traced = 0     # memory traced at the last update of `allocated`
+
+
+def collect(generation=2):
+    global collections, allocated, traced
+    collections += 1
+    result = _collect(generation)
+    if model_heap and tracemalloc.is_tracing():
+        traced = allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    return result
+
+
+def mem_alloc():
+    '''
+    In the model the allocations between two calls are only seen through their peak, so it is a lower
+    bound of what MicroPython would have allocated: the peak of the traced memory over what was traced
+    at the last call is added. Past the threshold the heap is collected here, not in the allocation.
+    '''
+    global allocated, traced
+    if not tracemalloc.is_tracing():
+        return 0
+    if not model_heap:
+        return tracemalloc.get_traced_memory()[0]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    allocated += max(peak - traced, 0)
+    traced = current
+    if 0 < allocation_threshold <= allocated:
+        collect()
+    return allocated
+
+
+def mem_free():
+    return max(HEAP - mem_alloc(), 0)
+
+
+def threshold(amount=None):
+    '''Returns the threshold without an argument, like MicroPython; -1 means none is set'''
+    global allocation_threshold
+    if amount is None:
+        return allocation_threshold
+    allocation_threshold = amount
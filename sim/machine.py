@@ -0,0 +1,161 @@
+'''
+Host-side stand-ins for the MicroPython `machine` module.
+Only the parts used by the firmware are implemented.
+'''
+import random
+import time
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+
+    def __init__(self, id, mode=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self._value = 0 if value is None else value
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+    def __repr__(self):
+        return 'Pin({})'.format(self.id)
+
+
+class ADC:
+    '''
+    Fake ADC which returns `source(n)` plus gaussian noise, where n is the read count, or the
+    virtual time in ms when a sim Clock is installed (ADC.clock, see sim/waveforms.py).
+    `source` defaults to a mid-scale constant.
+    '''
+    ATTN_0DB = 0
+    ATTN_2_5DB = 1
+    ATTN_6DB = 2
+    ATTN_11DB = 3
+    WIDTH_9BIT = 9
+    WIDTH_10BIT = 10
+    WIDTH_11BIT = 11
+    WIDTH_12BIT = 12
+    WIDTH_13BIT = 13
+    clock = None  # sim Clock
+
+    def __init__(self, pin, source=None, noise=0):
+        self.pin = pin
+        self.bits = 12
+        self.attenuation = ADC.ATTN_0DB
+        self.source = source
+        self.noise = noise
+        self.reads = 0
+
+    def atten(self, attenuation):
+        self.attenuation = attenuation
+
+    def width(self, bits):
+        self.bits = bits
+
+    def set_source(self, source, noise=None):
+        self.source = source
+        if noise is not None:
+            self.noise = noise
+
+    def read(self):
+        full_scale = (1 << self.bits) - 1
+        if self.source is None:
+            v = full_scale / 2
+        else:
+            v = self.source(self.reads if self.clock is None else self.clock.now)
+        if self.noise:
+            v += random.gauss(0, self.noise)
+        self.reads += 1
+        code = int(round(v))
+        if code < 0:
+            return 0
+        if code > full_scale:
+            return full_scale
+        return code
+
+
+class Timer:
+    '''
+    Hardware timer. With a sim Clock (Timer.clock) the callback fires as the clock advances,
+    otherwise only when fire() is called.
+    '''
+    ONE_SHOT = 0
+    PERIODIC = 1
+    clock = None  # sim Clock
+
+    def __init__(self, id):
+        self.id = id
+        self.period = None
+        self.mode = Timer.PERIODIC
+        self.callback = None
+        self._handle = None
+
+    def init(self, mode=PERIODIC, period=None, freq=None, callback=None):
+        self.deinit()
+        self.mode = mode
+        if freq is not None:
+            period = 1000 / freq
+        self.period = period
+        self.callback = callback
+        if self.clock is not None and callback is not None:
+            self._handle = self.clock.schedule(period, self.fire, period if mode == Timer.PERIODIC else 0)
+
+    def deinit(self):
+        if self._handle is not None:
+            self.clock.cancel(self._handle)
+            self._handle = None
+        self.callback = None
+
+    def fire(self):
+        '''Run the callback as the hardware would when the timer expires'''
+        if self.callback is not None:
+            self.callback(self)
+
+
+class WDT:
+    '''
+    Fake watchdog. Never resets the host; records feeds and the longest gap between them (ms).
+    Gaps longer than `near_miss` of the timeout are counted as near misses, gaps longer than the
+    timeout as resets the board would have done.
+    '''
+    clock = None  # sim Clock, real time is used when None
+    near_miss = 0.8
+
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self.feeds = 0
+        self.last_feed = self._now()
+        self.worst_gap = 0
+        self.near_misses = 0
+        self.expired = 0
+
+    def _now(self):
+        if self.clock is not None:
+            return self.clock.now
+        return time.monotonic() * 1000
+
+    def feed(self):
+        now = self._now()
+        gap = now - self.last_feed
+        if gap > self.timeout:
+            self.expired += 1
+        elif gap > self.timeout * self.near_miss:
+            self.near_misses += 1
+        self.worst_gap = max(self.worst_gap, gap)
+        self.last_feed = now
+        self.feeds += 1
+
+    def margin(self):
+        '''Smallest remaining time (ms) seen so far, including the current gap. Negative means the board would have reset'''
+        return self.timeout - max(self.worst_gap, self._now() - self.last_feed)
+
+
+class DeviceReset(Exception):
+    '''Raised by reset() so the simulation can observe a requested reboot'''
+
+
+def reset():
+    raise DeviceReset()
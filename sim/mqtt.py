@@ -0,0 +1,455 @@
+'''
+In-process MQTT broker and a client with the same interface and wire behaviour as
+libs.simple.MQTTClient (umqtt.simple).
+The client talks MQTT 3.1.1 packets to the broker through a fake socket, so code that writes to
+`client.sock` directly (see libs/publisher.py) can be exercised. The broker answers every packet after
+`latency` ms; reads on a blocking socket wait for that (really, or on a sim Clock when one is given).
+Only what the firmware uses is supported: CONNECT, PUBLISH (QoS 0/1), PUBACK, SUBSCRIBE, PINGREQ, DISCONNECT.
+Topic filters may use the + and # wildcards. TCPBridge serves a Broker on a loopback port for the
+asyncio host tools.
+'''
+import asyncio
+import struct
+import time
+
+
+def _bytes(value):
+    if isinstance(value, str):
+        return value.encode()
+    return bytes(value)
+
+
+def _encode_len(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def matches(topic_filter, topic):
+    '''True when topic (bytes) matches an MQTT topic filter (bytes), + and # included'''
+    if topic_filter == topic:
+        return True
+    levels = topic.split(b'/')
+    filters = topic_filter.split(b'/')
+    for i in range(len(filters)):
+        if filters[i] == b'#':
+            return True
+        if i >= len(levels) or (filters[i] != b'+' and filters[i] != levels[i]):
+            return False
+    return len(filters) == len(levels)
+
+
+class MQTTException(Exception):
+    pass
+
+
+class Socket:
+    '''One client connection to the Broker'''
+    def __init__(self, broker):
+        self.broker = broker
+        self.rx = bytearray()       # bytes ready for the client
+        self.due = []               # (due time, bytes) not yet delivered
+        self.inbuf = bytearray()    # bytes from the client not yet parsed
+        self.blocking = True
+        self.closed = False
+        self.session = None
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def settimeout(self, timeout):
+        self.blocking = timeout is None or timeout > 0
+
+    def write(self, buf, n=None):
+        if self.closed:
+            raise OSError(9)  # EBADF
+        data = bytes(buf[:n] if n is not None else buf)
+        self.broker.bytes_wire += len(data)
+        self.inbuf += data
+        self.broker.receive(self)
+        return len(data)
+
+    def _deliver(self):
+        now = self.broker.now()
+        while self.due and self.due[0][0] <= now:
+            self.rx += self.due.pop(0)[1]
+
+    def read(self, n):
+        self._deliver()
+        while len(self.rx) < n:
+            if not self.blocking and not self.rx:
+                return None
+            if self.closed or not self.due:
+                raise OSError(110)  # ETIMEDOUT, nothing will ever arrive
+            self.broker.wait(self.due[0][0] - self.broker.now())
+            self._deliver()
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def send_later(self, data, delay):
+        self.broker.bytes_out += len(data)
+        due = self.broker.now() + delay
+        # keep delivery in order even when the latency changes
+        if self.due and self.due[-1][0] > due:
+            due = self.due[-1][0]
+        self.due.append((due, data))
+
+    def close(self):
+        self.closed = True
+        self.broker.disconnect(self)
+
+
+class Session:
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.subscriptions = set()
+        self.socket = None
+
+
+class Broker:
+    def __init__(self, latency=0, clock=None):
+        self.latency = latency      # ms before the broker's answer to any packet arrives
+        self.clock = clock          # sim Clock, real time is used when None
+        self.sessions = {}          # client id -> Session
+        self.listeners = {}         # topic filter -> host side callbacks(topic, msg)
+        self.subscribers = {}       # topic filter -> ids of the clients subscribed to it
+        self.wildcards = set()      # filters of both with + or #, exact ones are looked up directly
+        self.messages = []          # (client_id, topic, msg, qos) in publish order
+        self.connections = 0
+        self.bytes_in = 0           # topic + payload bytes of every publish
+        self.bytes_wire = 0         # every byte written by clients, MQTT framing included
+        self.bytes_out = 0          # every byte sent to clients
+        self.packets_in = 0         # packets written by clients
+        self.drop_acks = 0          # number of upcoming PUBACKs to lose, to exercise retransmission
+
+    def now(self):
+        if self.clock is not None:
+            return self.clock.now
+        return time.monotonic() * 1000
+
+    def wait(self, ms):
+        if ms <= 0:
+            return
+        if self.clock is not None:
+            self.clock.advance(ms)
+        else:
+            time.sleep(ms / 1000)
+
+    def open(self):
+        return Socket(self)
+
+    def disconnect(self, sock):
+        if sock.session is not None and sock.session.socket is sock:
+            sock.session.socket = None
+
+    def receive(self, sock):
+        buf = sock.inbuf
+        while len(buf) >= 2:
+            # remaining length
+            n = 0
+            shift = 0
+            i = 1
+            while True:
+                if i >= len(buf):
+                    return
+                byte = buf[i]
+                n |= (byte & 0x7F) << shift
+                shift += 7
+                i += 1
+                if not byte & 0x80:
+                    break
+            if len(buf) < i + n:
+                return
+            header = buf[0]
+            body = bytes(buf[i:i + n])
+            del buf[:i + n]
+            self._handle(sock, header, body)
+
+    def _handle(self, sock, header, body):
+        self.packets_in += 1
+        op = header & 0xF0
+        if op == 0x10:      # CONNECT
+            proto_len = body[1]
+            flags = body[2 + proto_len + 1]
+            id_at = 2 + proto_len + 4
+            id_len = struct.unpack('!H', body[id_at:id_at + 2])[0]
+            client_id = body[id_at + 2:id_at + 2 + id_len].decode()
+            if flags & 0x02 or client_id not in self.sessions:
+                self.sessions[client_id] = Session(client_id)
+            present = 0 if flags & 0x02 else 1
+            session = self.sessions[client_id]
+            if session.socket is not None and session.socket is not sock:
+                session.socket.closed = True
+            session.socket = sock
+            sock.session = session
+            self.connections += 1
+            sock.send_later(bytes((0x20, 0x02, present, 0)), self.latency)
+        elif op == 0x30:    # PUBLISH
+            qos = (header >> 1) & 3
+            topic_len = struct.unpack('!H', body[:2])[0]
+            topic = body[2:2 + topic_len]
+            at = 2 + topic_len
+            if qos:
+                pid = body[at:at + 2]
+                at += 2
+            msg = body[at:]
+            self.publish(sock.session.client_id, topic, msg, qos, dup=bool(header & 0x08))
+            if qos:
+                if self.drop_acks:
+                    self.drop_acks -= 1
+                else:
+                    sock.send_later(b'\x40\x02' + pid, self.latency)
+        elif op == 0x40:    # PUBACK for a message delivered to the client
+            pass
+        elif op == 0x80:    # SUBSCRIBE
+            pid = body[:2]
+            granted = bytearray()
+            at = 2
+            while at < len(body):
+                topic_len = struct.unpack('!H', body[at:at + 2])[0]
+                topic = body[at + 2:at + 2 + topic_len]
+                granted.append(body[at + 2 + topic_len])
+                at += 3 + topic_len
+                sock.session.subscriptions.add(topic)
+                self.subscribers.setdefault(topic, set()).add(sock.session.client_id)
+                self._note_filter(topic)
+            sock.send_later(b'\x90' + _encode_len(2 + len(granted)) + pid + granted, self.latency)
+        elif op == 0xC0:    # PINGREQ
+            sock.send_later(b'\xd0\x00', self.latency)
+        elif op == 0xE0:    # DISCONNECT
+            sock.closed = True
+            self.disconnect(sock)
+
+    def publish(self, client_id, topic, msg, qos=0, dup=False):
+        topic = _bytes(topic)
+        msg = _bytes(msg)
+        self.messages.append((client_id, topic, msg, qos))
+        self.bytes_in += len(topic) + len(msg)
+        receivers = set(self.subscribers.get(topic, ()))
+        listeners = list(self.listeners.get(topic, ()))
+        for topic_filter in self.wildcards:
+            if matches(topic_filter, topic):
+                receivers.update(self.subscribers.get(topic_filter, ()))
+                listeners += self.listeners.get(topic_filter, ())
+        packet = None
+        for client_id in receivers:
+            session = self.sessions.get(client_id)
+            # a clean session started since may not have subscribed again
+            if session is None or not any(matches(f, topic) for f in session.subscriptions):
+                continue
+            if session.socket is not None and not session.socket.closed:
+                if packet is None:
+                    packet = b'\x30' + _encode_len(2 + len(topic) + len(msg)) + struct.pack('!H', len(topic)) + topic + msg
+                session.socket.send_later(packet, self.latency)
+        for listener in listeners:
+            listener(topic, msg)
+
+    def listen(self, topic, callback):
+        '''Host side subscription, callback(topic, msg) runs on every publish matching the topic filter'''
+        topic = _bytes(topic)
+        self.listeners.setdefault(topic, []).append(callback)
+        self._note_filter(topic)
+
+    def _note_filter(self, topic_filter):
+        if b'+' in topic_filter or b'#' in topic_filter:
+            self.wildcards.add(topic_filter)
+
+    def inject(self, topic, msg):
+        '''Publish from outside the fleet, e.g. the dashboard'''
+        self.publish(None, topic, msg)
+
+    def topic_messages(self, topic):
+        topic = _bytes(topic)
+        return [m[2] for m in self.messages if m[1] == topic]
+
+
+class TCPBridge:
+    '''Serves a Broker on a loopback TCP port to host-side asyncio clients (tools/mqtt.py)'''
+    def __init__(self, broker):
+        self.broker = broker
+        self.connections = []
+        self.handlers = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.pumping = asyncio.ensure_future(self.pump())
+
+    async def handle(self, reader, writer):
+        sock = self.broker.open()
+        self.connections.append((sock, writer))
+        self.handlers.append(asyncio.current_task())
+        while not sock.closed:
+            data = await reader.read(65536)
+            if not data:
+                break
+            sock.write(data)
+            self.flush(sock, writer)
+        sock.close()
+
+    def flush(self, sock, writer):
+        sock._deliver()
+        if sock.rx:
+            writer.write(bytes(sock.rx))
+            sock.rx.clear()
+
+    async def pump(self):
+        while True:
+            for sock, writer in self.connections:
+                self.flush(sock, writer)
+            await asyncio.sleep(0.001)
+
+    def buffered(self):
+        return sum(writer.transport.get_write_buffer_size() for sock, writer in self.connections)
+
+    async def close(self):
+        self.pumping.cancel()
+        self.server.close()
+        for sock, writer in self.connections:
+            writer.close()
+        # handlers end on the closed connections
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+
+BROKER = Broker()
+
+
+class MQTTClient:
+    '''Same interface and packet handling as umqtt.simple.MQTTClient, connected to MQTTClient.broker'''
+    broker = BROKER
+
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0, ssl=False, ssl_params={}):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.user = user
+        self.pswd = password
+        self.keepalive = keepalive
+        self.cb = None
+        self.sock = None
+        self.pid = 0
+        self.lw_topic = None
+
+    def _send_str(self, s):
+        s = _bytes(s)
+        self.sock.write(struct.pack('!H', len(s)))
+        self.sock.write(s)
+
+    def _recv_len(self):
+        n = 0
+        sh = 0
+        while 1:
+            b = self.sock.read(1)[0]
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                return n
+            sh += 7
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def connect(self, clean_session=True):
+        self.sock = self.broker.open()
+        client_id = _bytes(self.client_id)
+        body = bytearray(b'\x00\x04MQTT\x04')
+        body.append(clean_session << 1 | (0xC0 if self.user is not None else 0))
+        body += struct.pack('!H', self.keepalive)
+        body += struct.pack('!H', len(client_id)) + client_id
+        if self.user is not None:
+            for s in (self.user, self.pswd):
+                s = _bytes(s)
+                body += struct.pack('!H', len(s)) + s
+        self.sock.write(b'\x10' + _encode_len(len(body)) + body)
+        resp = self.sock.read(4)
+        assert resp[0] == 0x20 and resp[1] == 0x02
+        if resp[3] != 0:
+            raise MQTTException(resp[3])
+        return resp[2] & 1
+
+    def disconnect(self):
+        self.sock.write(b'\xe0\0')
+        self.sock.close()
+
+    def ping(self):
+        self.sock.write(b'\xc0\0')
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        topic = _bytes(topic)
+        msg = _bytes(msg)
+        sz = 2 + len(topic) + len(msg)
+        if qos > 0:
+            sz += 2
+        self.sock.write(bytes((0x30 | qos << 1 | retain,)) + _encode_len(sz))
+        self._send_str(topic)
+        if qos > 0:
+            self.pid += 1
+            pid = self.pid
+            self.sock.write(struct.pack('!H', pid))
+        self.sock.write(msg)
+        if qos == 1:
+            while 1:
+                op = self.wait_msg()
+                if op == 0x40:
+                    sz = self.sock.read(1)
+                    assert sz == b'\x02'
+                    rcv_pid = self.sock.read(2)
+                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
+                    if pid == rcv_pid:
+                        return
+
+    def subscribe(self, topic, qos=0):
+        assert self.cb is not None, 'Subscribe callback is not set'
+        self.pid += 1
+        topic = _bytes(topic)
+        pkt = bytearray(b'\x82') + _encode_len(2 + 2 + len(topic) + 1) + struct.pack('!H', self.pid)
+        self.sock.write(pkt)
+        self._send_str(topic)
+        self.sock.write(bytes((qos,)))
+        while 1:
+            op = self.wait_msg()
+            if op == 0x90:
+                resp = self.sock.read(4)
+                assert resp[2] == self.pid & 0xFF
+                if resp[3] == 0x80:
+                    raise MQTTException(resp[3])
+                return
+
+    def wait_msg(self):
+        res = self.sock.read(1)
+        self.sock.setblocking(True)
+        if res is None:
+            return None
+        if res == b'':
+            raise OSError(-1)
+        if res == b'\xd0':  # PINGRESP
+            sz = self.sock.read(1)[0]
+            assert sz == 0
+            return None
+        op = res[0]
+        if op & 0xF0 != 0x30:
+            return op
+        sz = self._recv_len()
+        topic_len = self.sock.read(2)
+        topic_len = (topic_len[0] << 8) | topic_len[1]
+        topic = self.sock.read(topic_len)
+        sz -= topic_len + 2
+        if op & 6:
+            pid = self.sock.read(2)
+            pid = pid[0] << 8 | pid[1]
+            sz -= 2
+        msg = self.sock.read(sz) if sz else b''
+        self.cb(topic, msg)
+        if op & 6 == 2:
+            self.sock.write(b'\x40\x02' + struct.pack('!H', pid))
+
+    def check_msg(self):
+        self.sock.setblocking(False)
+        return self.wait_msg()
@@ -0,0 +1,93 @@
+'''
+Host-side stand-in for the MicroPython `network` module.
+'''
+STA_IF = 0
+AP_IF = 1
+
+
+class WLAN:
+    '''
+    Fake station interface. The link state is driven by the test via `link_up`;
+    connect() succeeds only when `link_up` is True and the SSID is in `known_networks`
+    (or `known_networks` is None). Like the real driver there is one instance per interface.
+    With a sim Clock (set by sim.install) joining takes time: connect() returns at once and
+    isconnected() turns True `associate_time` ms later, plus `search_time` ms when the driver has to
+    search every channel for the access point (no BSSID given, or not on the channel set with
+    config(channel=...)). scan() blocks for `scan_time` ms and reports `networks`.
+    '''
+    _instances = {}
+    clock = None
+
+    def __new__(cls, interface=STA_IF):
+        if interface not in cls._instances:
+            instance = object.__new__(cls)
+            instance._init(interface)
+            cls._instances[interface] = instance
+        return cls._instances[interface]
+
+    @classmethod
+    def reset_all(cls):
+        cls._instances.clear()
+
+    def _init(self, interface):
+        self.interface = interface
+        self._active = False
+        self.link_up = True
+        self.known_networks = None
+        self.ssid = None
+        self.connects = 0
+        self.scans = 0
+        # access points in range, as scan() reports them: (ssid, bssid, channel, RSSI, security, hidden)
+        self.networks = [(b'sim-ssid', b'\x24\x0a\xc4\x10\x00\x01', 6, -58, 3, False)]
+        self.associate_time = 0     # ms
+        self.search_time = 0        # ms
+        self.scan_time = 0          # ms
+        self.channel = 0
+        self._joined_at = 0
+
+    def active(self, state=None):
+        if state is None:
+            return self._active
+        self._active = bool(state)
+
+    def _now(self):
+        return self.clock.now if self.clock is not None else 0
+
+    def connect(self, ssid, pwd=None, bssid=None):
+        self.connects += 1
+        self.ssid = None
+        if self.known_networks is not None and ssid not in self.known_networks:
+            return
+        name = ssid.encode() if isinstance(ssid, str) else ssid
+        delay = self.associate_time
+        for network in self.networks:
+            if network[0] == name and (bssid is None or network[1] == bssid):
+                if bssid is None or network[2] != self.channel:
+                    delay += self.search_time
+                self.ssid = ssid
+                self._joined_at = self._now() + delay
+                return
+
+    def disconnect(self):
+        self.ssid = None
+
+    def isconnected(self):
+        return self._active and self.link_up and self.ssid is not None and self._now() >= self._joined_at
+
+    def scan(self):
+        self.scans += 1
+        if self.clock is not None:
+            self.clock.advance(self.scan_time)
+        return list(self.networks) if self.link_up else []
+
+    def ifconfig(self):
+        return ('192.168.4.2', '255.255.255.0', '192.168.4.1', '8.8.8.8')
+
+    def config(self, *args, **kwargs):
+        if args == ('mac',):
+            return b'\x24\x0a\xc4\x00\x00\x01'
+        if args == ('channel',):
+            return self.channel
+        if 'channel' in kwargs:
+            self.channel = kwargs['channel']
+        return None
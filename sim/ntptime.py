@@ -0,0 +1,49 @@
+'''
+Host-side stand-in for the MicroPython `ntptime` module.
+Without a sim Clock the host clock is assumed to be correct. With one (set by sim.install) a request
+takes `rtt` ms of virtual time, or the full `timeout` when it fails, and `rtc` models the board's real
+time clock: it counts from 0 at power on, like an RTC that was never set, until settime() sets it.
+'''
+import time
+
+host = 'pool.ntp.org'
+timeout = 1     # s, as in the MicroPython module
+rtt = 40        # ms
+calls = 0
+fail = 0        # number of upcoming settime() calls that should time out
+clock = None
+
+
+class RTC:
+    '''
+    Wall clock of the board on the sim Clock. Pass rtc.time where the firmware reads time.time().
+    `epoch` is the true wall time at clock 0. An RTC that was `kept` through a reset starts out right,
+    otherwise it counts from 0 until settime() sets it, to the second like the real module.
+    '''
+    def __init__(self, clock, kept=False):
+        self.clock = clock
+        self.epoch = time.time() - clock.now / 1000
+        self.base = self.epoch if kept else 0   # the RTC's time at clock 0, s
+
+    def time(self):
+        return int(self.base + self.clock.now / 1000)
+
+    def set(self):
+        self.base = int(self.epoch + self.clock.now / 1000) - self.clock.now / 1000
+
+
+rtc = None
+
+
+def settime():
+    global calls, fail
+    calls += 1
+    if fail > 0:
+        fail -= 1
+        if clock is not None:
+            clock.advance(timeout * 1000)
+        raise OSError(110)  # ETIMEDOUT
+    if clock is not None:
+        clock.advance(rtt)
+    if rtc is not None:
+        rtc.set()
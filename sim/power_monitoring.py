@@ -0,0 +1,43 @@
+'''
+Stand-in for libs.power_monitoring with the same constructor signatures.
+The conversions are a plausible linear model of the board's dividers and hall-effect sensors,
+not a copy of the device calibration.
+'''
+ADC_VREF = 3.3
+ADC_MAX = 8191
+
+
+def adc_voltage(adc):
+    return adc.read() * ADC_VREF / ADC_MAX
+
+
+class VoltageRead:
+    def __init__(self, adc, gain_offset, offset, name, r1, r2):
+        self.adc = adc
+        self.gain_offset = gain_offset
+        self.offset = offset
+        self.name = name
+        self.ratio = (r1 + r2) / r1
+
+    def get_adc_voltage(self):
+        return adc_voltage(self.adc)
+
+    def get_voltage(self):
+        return self.get_adc_voltage() * self.ratio * (1 + self.gain_offset) + self.offset
+
+
+class CurrentRead:
+    SENSITIVITY = 0.066  # V/A at the ADC pin
+
+    def __init__(self, adc, zero, offset, vref, name, r1, r2):
+        self.adc = adc
+        self.zero = zero
+        self.offset = offset
+        self.vref = vref
+        self.name = name
+
+    def get_adc_voltage(self):
+        return adc_voltage(self.adc)
+
+    def get_current(self):
+        return (self.get_adc_voltage() - self.zero) / self.SENSITIVITY + self.offset
@@ -0,0 +1,106 @@
+'''
+Runs the unmodified firmware (main.main()) on a virtual clock.
+VirtualLoop is an asyncio event loop whose time is the sim Clock: instead of blocking in select() it
+advances the clock, which fires the machine.Timer callbacks (ADC acquisition and protection) on the way.
+With cpu_scale the host CPU time spent in the firmware is charged to the clock as well, so task
+lateness, run times and the watchdog margin reflect the cost of the code and not just the schedule.
+'''
+import asyncio
+import selectors
+import time
+
+import sim
+from sim.clock import Clock
+
+
+class VirtualSelector(selectors.SelectSelector):
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+        self.idle = 0       # virtual ms spent waiting
+
+    def select(self, timeout=None):
+        self.clock.sync()
+        # nothing scheduled at all, move on a little rather than wait forever
+        wait = 1 if timeout is None else timeout * 1000
+        if wait > 0:
+            self.clock.advance(wait)
+            self.idle += wait
+        return []
+
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        self.clock = clock
+        self.iterations = 0
+        super().__init__(VirtualSelector(clock))
+
+    def time(self):
+        return self.clock.now / 1000
+
+    def _run_once(self):
+        self.iterations += 1
+        super()._run_once()
+
+
+class Run:
+    '''Result of run_firmware()'''
+    def __init__(self, firmware, clock, loop, broker, duration, cpu):
+        self.firmware = firmware
+        self.clock = clock
+        self.loop = loop
+        self.broker = broker
+        self.duration = duration    # virtual ms
+        self.cpu = cpu              # host s
+
+    def task_stats(self):
+        from libs.tasks import TASK_STATS
+        return TASK_STATS
+
+
+def run_firmware(duration, config=None, cpu_scale=0, latency=0, prepare=None, events=(), flash=None, boot=False):
+    '''
+    Imports a fresh main.py against the stand-ins and runs main.main() for `duration` virtual ms.
+    prepare(firmware, clock, broker) runs before main(), e.g. to set ADC waveforms.
+    events are (time ms, function(firmware)) pairs called at that virtual time, e.g. to drop the WiFi.
+    flash is the directory standing in for the device filesystem, a new one by default.
+    With boot=True the CPU used to import main.py and its libs, and by prepare(), is charged to the clock as
+    well, so the clock starts at power on.
+    '''
+    clock = Clock()
+    if boot:
+        # the stand-ins are not firmware, they are imported before the clock starts
+        sim.install(config, clock)
+        clock.cpu_scale = cpu_scale
+        clock.sync()
+    firmware = sim.load_firmware(config, flash=flash, clock=clock)
+    broker = sim.mqtt.MQTTClient.broker
+    broker.latency = latency
+    from libs.tasks import TASK_STATS
+    TASK_STATS.clear()
+    if prepare is not None:
+        prepare(firmware, clock, broker)
+    for at, action in events:
+        clock.schedule(at, lambda action=action: action(firmware))
+
+    loop = VirtualLoop(clock)
+    asyncio.set_event_loop(loop)
+
+    async def bounded():
+        try:
+            await asyncio.wait_for(firmware.main(), duration / 1000)
+        except asyncio.TimeoutError:
+            pass
+
+    start = time.perf_counter()
+    # unless booting, the CPU used by imports and setup above is not charged
+    clock.cpu_scale = cpu_scale
+    try:
+        loop.run_until_complete(bounded())
+    finally:
+        clock.cpu_scale = 0
+        firmware.acquisition.stop()
+        asyncio.set_event_loop(None)
+        loop.close()
+    return Run(firmware, clock, loop, broker, duration, time.perf_counter() - start)
+
@@ -0,0 +1,35 @@
+'''
+Stand-in for libs.temperature with the same constructor signature.
+Uses the extended Steinhart-Hart form 1/T = A1 + B1 ln(R/R25) + C1 ln^2 + D1 ln^3 on a divider
+with the thermistor on the low side.
+'''
+from math import log
+
+ADC_VREF = 3.3
+ADC_MAX = 8191
+
+
+class NTC_Temperature:
+    def __init__(self, adc, set_point, Bval, A1, B1, C1, D1, temp_offset=0, r_ref=10000, r25=10000):
+        self.adc = adc
+        self.set_point = set_point
+        self.Bval = Bval
+        self.A1 = A1
+        self.B1 = B1
+        self.C1 = C1
+        self.D1 = D1
+        self.temp_offset = temp_offset
+        self.r_ref = r_ref
+        self.r25 = r25
+
+    def get_temperature(self):
+        code = self.adc.read()
+        if code <= 0:
+            code = 1
+        if code >= ADC_MAX:
+            code = ADC_MAX - 1
+        v = code * ADC_VREF / ADC_MAX
+        r = self.r_ref * v / (ADC_VREF - v)
+        x = log(r / self.r25)
+        inv_t = self.A1 + self.B1 * x + self.C1 * x * x + self.D1 * x * x * x
+        return 1 / inv_t - 273.15 + self.temp_offset
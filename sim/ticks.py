@@ -0,0 +1,29 @@
+'''
+Stand-in for libs.ticks which follows the simulation Clock while one is installed
+(see sim.install), and the host's monotonic clock otherwise.
+'''
+import time
+
+clock = None  # sim Clock, set by sim.install()
+
+
+def ticks_ms():
+    if clock is not None:
+        clock.sync()
+        return int(clock.now)
+    return int(time.monotonic() * 1000)
+
+
+def ticks_us():
+    if clock is not None:
+        clock.sync()
+        return int(clock.now * 1000)
+    return int(time.monotonic() * 1000000)
+
+
+def ticks_diff(new, old):
+    return new - old
+
+
+def ticks_add(ticks, delta):
+    return ticks + delta
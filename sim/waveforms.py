@@ -0,0 +1,65 @@
+'''
+Scripted ADC waveforms for the simulator.
+Each waveform is a function of the virtual time in ms, for ADC.set_source() while a sim Clock is
+installed. Waveforms describe physical values; codes() turns them into ADC codes with the inverse of
+the sim.power_monitoring conversions, e.g.
+    battery_voltage_pin.set_source(codes(sine(25, 0.5, 60000), voltage_code(88700, 1000000)))
+'''
+import math
+
+from sim.power_monitoring import ADC_MAX, ADC_VREF, CurrentRead
+
+
+def constant(value):
+    return lambda t: value
+
+
+def ramp(start, end, t0, t1):
+    '''start until t0, then linear to end at t1'''
+    def wave(t):
+        if t <= t0:
+            return start
+        if t >= t1:
+            return end
+        return start + (end - start) * (t - t0) / (t1 - t0)
+    return wave
+
+
+def sine(mean, amplitude, period, phase=0):
+    return lambda t: mean + amplitude * math.sin(2 * math.pi * (t + phase) / period)
+
+
+def pulses(low, high, period, width, start=0):
+    '''high for `width` ms out of every `period` ms'''
+    return lambda t: high if t >= start and (t - start) % period < width else low
+
+
+def steps(points):
+    '''[(t, value), ...] in increasing t, each value held until the next point'''
+    def wave(t):
+        value = points[0][1]
+        for at, v in points:
+            if t < at:
+                break
+            value = v
+        return value
+    return wave
+
+
+def add(*waves):
+    return lambda t: sum(wave(t) for wave in waves)
+
+
+def codes(wave, to_code):
+    return lambda t: to_code(wave(t))
+
+
+def voltage_code(r1, r2, gain_offset=0, offset=0):
+    '''Volts -> ADC code for a sim.power_monitoring.VoltageRead built with the same arguments'''
+    ratio = (r1 + r2) / r1
+    return lambda volts: (volts - offset) / (ratio * (1 + gain_offset)) * ADC_MAX / ADC_VREF
+
+
+def current_code(zero, offset=0):
+    '''Amps -> ADC code for a sim.power_monitoring.CurrentRead built with the same arguments'''
+    return lambda amps: ((amps - offset) * CurrentRead.SENSITIVITY + zero) * ADC_MAX / ADC_VREF
@@ -0,0 +1,3 @@
+'''
+Host-side tools for working with HomePoynt Power Controller telemetry and control messages.
+'''
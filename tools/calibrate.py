@@ -0,0 +1,242 @@
+'''
+Fits calibration profiles (libs/calibration.py) for many boards at once from recorded datasets: a
+channel's filtered ADC code (the firmware's channel.value, 13 bit) next to a reference meter's reading.
+Every (board, reading) series is fitted by least squares in one batched NumPy solve: the normal
+equations of all series are accumulated with bincount and solved together, so a fleet's worth of
+boards takes about as long as parsing the file.
+
+    python -m tools.calibrate <dataset.csv> <charger profile> [model] [output.json]
+
+The dataset has a header and one sample per line: board,reading,code,reference. Readings are named as
+in libs/telemetry.py FIELDS; for solar_voltage the reference is the panel's rise over the battery.
+model is polyN, a degree N polynomial in the code (default poly1, gain and offset), or pwlN,
+piecewise linear through N points spread over the codes recorded.
+Writes {board: {"CALIBRATION": {charger profile: profile}}}, to be merged into each board's config
+file or sent as a CALIBRATION update (tools/control.py). A series that is too short to fit, or whose
+fit turns back somewhere over the code range, is left out so the board keeps its nominal conversion for it.
+'''
+import csv
+import json
+import sys
+
+import numpy as np
+
+from libs.calibration import CODES, CHECK_STEP, FALLING, READINGS
+
+MODEL = 'poly1'
+
+
+class Dataset:
+    '''Samples as columns, boards and readings as indices into their names'''
+    def __init__(self, boards, readings, board, reading, code, reference):
+        self.boards = boards
+        self.readings = readings
+        self.board = board
+        self.reading = reading
+        self.code = code
+        self.reference = reference
+
+    @classmethod
+    def load(cls, path):
+        with open(path, newline='') as f:
+            rows = csv.reader(f)
+            header = [h.strip() for h in next(rows)]
+            columns = [header.index(name) for name in ('board', 'reading', 'code', 'reference')]
+            board, reading, code, reference = [], [], [], []
+            for row in rows:
+                if not row:
+                    continue
+                board.append(row[columns[0]].strip())
+                reading.append(row[columns[1]].strip())
+                code.append(row[columns[2]])
+                reference.append(row[columns[3]])
+        unknown = set(reading) - set(READINGS)
+        if unknown:
+            raise ValueError('Unknown readings {}'.format(sorted(unknown)))
+        boards, board = np.unique(np.array(board), return_inverse=True)
+        readings, reading = np.unique(np.array(reading), return_inverse=True)
+        return cls(list(boards), list(readings), board, reading, np.array(code, np.float64), np.array(reference, np.float64))
+
+    def groups(self):
+        '''(series index of every sample, number of series), a series is one board's reading'''
+        return self.board * len(self.readings) + self.reading, len(self.boards) * len(self.readings)
+
+
+def _normal_equations(group, n, size, basis, columns, reference):
+    '''
+    Batched normal equations of n series with `size` unknowns each. basis is (samples, k) of the
+    nonzero basis values of every sample and columns the unknowns they belong to.
+    '''
+    a = np.zeros(n * size * size)
+    b = np.zeros(n * size)
+    for j in range(basis.shape[1]):
+        b += np.bincount(group * size + columns[:, j], basis[:, j] * reference, n * size)
+        for k in range(basis.shape[1]):
+            a += np.bincount((group * size + columns[:, j]) * size + columns[:, k], basis[:, j] * basis[:, k], n * size * size)
+    return a.reshape(n, size, size), b.reshape(n, size)
+
+
+def _solve(a, b):
+    try:
+        return np.linalg.solve(a, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        # some series are singular, their fits are rejected by the sample count check
+        return np.einsum('gij,gj->gi', np.linalg.pinv(a), b)
+
+
+class PolyFit:
+    '''Degree `degree` polynomial per series, in a code scaled to 0..1 for conditioning'''
+    def __init__(self, degree):
+        self.degree = degree
+        self.unknowns = degree + 1
+
+    def fit(self, group, n, code, reference):
+        x = code / (CODES - 1)
+        basis = x[:, None] ** np.arange(self.unknowns)
+        columns = np.broadcast_to(np.arange(self.unknowns), basis.shape)
+        a, b = _normal_equations(group, n, self.unknowns, basis, columns, reference)
+        self.coefficients = _solve(a, b)
+
+    def __call__(self, group, code):
+        x = code / (CODES - 1)
+        c = self.coefficients[group]
+        v = c[:, -1].copy()
+        for i in range(self.degree - 1, -1, -1):
+            v = v * x + c[:, i]
+        return v
+
+    def spec(self, g):
+        scale = float(CODES - 1) ** np.arange(self.unknowns)
+        return {'poly': [float('{:.7g}'.format(c)) for c in self.coefficients[g] / scale]}
+
+
+class PiecewiseFit:
+    '''`points` values per series, evenly spaced over the codes it was recorded at'''
+    def __init__(self, points, smoothing=1e-6):
+        if points < 2:
+            raise ValueError('Piecewise fits need at least two points')
+        self.points = points
+        self.unknowns = points
+        self.smoothing = smoothing      # second difference penalty, carries points without samples along
+
+    def _position(self, group, code):
+        t = (code - self.low[group]) / self.span[group] * (self.points - 1)
+        i = np.clip(np.floor(t).astype(np.int64), 0, self.points - 2)
+        return i, t - i
+
+    def fit(self, group, n, code, reference):
+        self.low = np.full(n, np.inf)
+        high = np.full(n, -np.inf)
+        np.minimum.at(self.low, group, code)
+        np.maximum.at(high, group, code)
+        empty = ~np.isfinite(self.low)
+        self.low[empty] = 0
+        high[empty] = CODES - 1
+        self.span = np.maximum(high - self.low, 1.0)
+        i, w = self._position(group, code)
+        basis = np.stack((1 - w, w), axis=1)
+        columns = np.stack((i, i + 1), axis=1)
+        a, b = _normal_equations(group, n, self.unknowns, basis, columns, reference)
+        d = np.diff(np.eye(self.points), 2, axis=0)
+        weight = self.smoothing * np.maximum(a.trace(axis1=1, axis2=2), 1.0) / self.points
+        a += weight[:, None, None] * (d.T @ d)
+        self.values = _solve(a, b)
+
+    def __call__(self, group, code):
+        i, w = self._position(group, code)
+        low = self.values[group, i]
+        return low + (self.values[group, i + 1] - low) * w
+
+    def spec(self, g):
+        codes = self.low[g] + self.span[g] * np.arange(self.points) / (self.points - 1)
+        return {'points': [[round(float(c), 1), float('{:.7g}'.format(v))] for c, v in zip(codes, self.values[g])]}
+
+
+def model(name):
+    if name.startswith('poly'):
+        return PolyFit(int(name[4:]))
+    if name.startswith('pwl'):
+        return PiecewiseFit(int(name[3:]))
+    raise ValueError('Unknown model {}, use polyN or pwlN'.format(name))
+
+
+class Fit:
+    '''A model fitted to every series of a dataset, with the residuals and checks of each'''
+    def __init__(self, dataset, fitted, samples, rms, worst, monotonic):
+        self.dataset = dataset
+        self.model = fitted
+        self.samples = samples      # per series
+        self.rms = rms
+        self.worst = worst
+        self.monotonic = monotonic  # the fit keeps its direction over the codes, as the firmware requires
+
+    def usable(self):
+        return (self.samples >= self.model.unknowns) & self.monotonic & np.isfinite(self.rms)
+
+    def profiles(self):
+        '''{board: {reading: profile entry}} of the usable fits'''
+        readings = len(self.dataset.readings)
+        usable = self.usable()
+        out = {}
+        for g in np.flatnonzero(usable):
+            board = self.dataset.boards[g // readings]
+            out.setdefault(board, {})[self.dataset.readings[g % readings]] = self.model.spec(g)
+        return out
+
+
+def fit(dataset, name=MODEL):
+    '''Fits the model to every (board, reading) series of the dataset at once'''
+    group, n = dataset.groups()
+    fitted = model(name)
+    fitted.fit(group, n, dataset.code, dataset.reference)
+    error = fitted(group, dataset.code) - dataset.reference
+    samples = np.bincount(group, minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rms = np.sqrt(np.bincount(group, error * error, n) / samples)
+    worst = np.zeros(n)
+    np.maximum.at(worst, group, np.abs(error))
+    # every series over the whole code range, as the firmware checks it
+    grid = np.arange(0, CODES, CHECK_STEP, dtype=np.float64)
+    series = np.repeat(np.arange(n), len(grid))
+    values = fitted(series, np.tile(grid, n)).reshape(n, len(grid))
+    falling = np.array([name in FALLING for name in dataset.readings])[np.arange(n) % len(dataset.readings)]
+    steps = np.diff(values, axis=1)
+    monotonic = np.where(falling, np.all(steps <= 0, axis=1), np.all(steps >= 0, axis=1))
+    return Fit(dataset, fitted, samples, rms, worst, monotonic)
+
+
+def report(result):
+    '''Lines with the residuals of every reading across the boards'''
+    readings = len(result.dataset.readings)
+    lines = ['{:<18} {:>7} {:>7} {:>12} {:>12} {:>12}'.format('reading', 'boards', 'usable', 'median rms', 'worst rms', 'worst error')]
+    usable = result.usable()
+    for r in range(readings):
+        g = np.arange(r, len(result.samples), readings)
+        g = g[result.samples[g] > 0]
+        ok = g[usable[g]]
+        if not len(ok):
+            lines.append('{:<18} {:>7} {:>7}'.format(result.dataset.readings[r], len(g), 0))
+            continue
+        lines.append('{:<18} {:>7} {:>7} {:>12.4f} {:>12.4f} {:>12.4f}'.format(
+            result.dataset.readings[r], len(g), len(ok), np.median(result.rms[ok]), result.rms[ok].max(), result.worst[ok].max()))
+    return lines
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__)
+        return 1
+    name = sys.argv[3] if len(sys.argv) > 3 else MODEL
+    output = sys.argv[4] if len(sys.argv) > 4 else 'calibration.json'
+    result = fit(Dataset.load(sys.argv[1]), name)
+    for line in report(result):
+        print(line)
+    profiles = result.profiles()
+    with open(output, 'w') as f:
+        json.dump({board: {'CALIBRATION': {sys.argv[2]: profile}} for board, profile in profiles.items()}, f)
+    print('{} profiles written to {}'.format(len(profiles), output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
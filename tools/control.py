@@ -0,0 +1,199 @@
+'''
+Fleet control plane: sends a control command to many devices at once and tracks every reply.
+Each request goes to the device's request topic (<control topic>/<ID>/request) with a correlation id
+in REQUEST_ID, the reply comes back on <control topic>/<ID>/reply. At most `window` requests are
+outstanding. A request without a reply after `timeout` s is sent again with the same REQUEST_ID, up
+to `retries` times: a device that already ran it answers from its reply cache (libs/commands.py), so
+a lost reply never runs a command twice. BUSY replies are retried after a back-off.
+With a fleet key every request is signed with the device's key and expires after `ttl` s (libs/auth.py).
+
+    python -m tools.control <broker host> <port> <ids file or id,id,...> <command json> [fleet key]
+    python -m tools.control localhost 1883 ids.txt '{"COMMAND": "SHOW_CONFIG_FILE"}'
+'''
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+from libs.auth import PLACEHOLDER, device_key, sign
+from tools.mqtt import Connection
+
+CONTROL_TOPIC = 'hppc/control'
+WINDOW = 256        # requests outstanding at once
+TIMEOUT = 2.0       # s to wait for a reply before sending again
+RETRIES = 3
+BACKOFF = 0.5       # s before retrying after a BUSY reply, doubled every time
+TTL = 30            # s a signed request stays valid, the devices' dedup window
+
+
+class Result:
+    '''
+    Outcome of one device's request. status is 'ok', 'error' (the device refused it: unknown
+    command, wrong ID, bad signature, expired), 'busy' (its queue stayed full) or 'timeout'.
+    '''
+    def __init__(self, device, request_id):
+        self.device = device
+        self.request_id = request_id
+        self.status = 'timeout'
+        self.reply = None
+        self.attempts = 0
+        self.started = None     # perf_counter() of the first send
+        self.latency = None     # s from the first send to the reply
+
+    def __repr__(self):
+        latency = '{:.0f} ms'.format(self.latency * 1000) if self.latency is not None else '-'
+        return '{} {} attempts={} latency={} reply={}'.format(
+            self.device, self.status, self.attempts, latency, json.dumps(self.reply))
+
+
+class ControlPlane:
+    def __init__(self, connection, control_topic=CONTROL_TOPIC, fleet_key=None, window=WINDOW,
+                 timeout=TIMEOUT, retries=RETRIES, ttl=TTL):
+        self.connection = connection
+        self.control_topic = control_topic
+        self.fleet_key = fleet_key
+        self.keys = {}              # device -> its key, derived once
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.ttl = ttl
+        self.pending = {}           # REQUEST_ID -> future of its first reply
+        self.prefix = os.urandom(4).hex()
+        self.count = 0
+        self.late = 0               # replies after their request was settled, e.g. to a retry
+        self.sent = 0
+
+    def reply_filter(self):
+        return '{}/+/reply'.format(self.control_topic)
+
+    async def on_message(self, topic, payload):
+        try:
+            reply = json.loads(payload)
+            request_id = reply.get('REQUEST_ID')
+        except (ValueError, AttributeError):
+            return
+        future = self.pending.get(request_id)
+        if future is not None and not future.done():
+            future.set_result(reply)
+        elif request_id is not None:
+            self.late += 1
+
+    def _request(self, device, request_id, command):
+        message = {'ID': device, 'REQUEST_ID': request_id}
+        message.update(command)
+        if self.fleet_key is None:
+            return json.dumps(message).encode()
+        message['EXPIRES'] = int(time.time() + self.ttl)
+        message['SIG'] = ''
+        key = self.keys.get(device)
+        if key is None:
+            key = self.keys[device] = device_key(self.fleet_key, device)
+        payload = json.dumps(message).encode()
+        assert PLACEHOLDER in payload
+        return sign(payload, key)
+
+    async def send(self, device, command):
+        '''Sends one command to one device until it replies or the retries run out'''
+        self.count += 1
+        result = Result(device, '{}-{}'.format(self.prefix, self.count))
+        loop = asyncio.get_running_loop()
+        topic = '{}/{}/request'.format(self.control_topic, device)
+        backoff = BACKOFF
+        start = result.started = time.perf_counter()
+        try:
+            while result.attempts <= self.retries:
+                future = self.pending.get(result.request_id)
+                if future is None or future.done():
+                    future = self.pending[result.request_id] = loop.create_future()
+                self.connection.publish(topic, self._request(device, result.request_id, command))
+                self.sent += 1
+                await self.connection.drain()
+                result.attempts += 1
+                try:
+                    reply = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+                except asyncio.TimeoutError:
+                    continue
+                result.reply = reply
+                result.latency = time.perf_counter() - start
+                if reply.get('ERROR') == 'BUSY':
+                    result.status = 'busy'
+                    await asyncio.sleep(backoff)
+                    backoff *= 2
+                    continue
+                result.status = 'error' if 'ERROR' in reply or 'Invalid ID' in reply else 'ok'
+                break
+        finally:
+            self.pending.pop(result.request_id, None)
+        return result
+
+    async def fan_out(self, devices, command):
+        '''Sends command to every device, `window` at a time. Returns their Results in order.'''
+        window = asyncio.Semaphore(self.window)
+
+        async def one(device):
+            async with window:
+                return await self.send(device, command)
+        return await asyncio.gather(*(one(device) for device in devices))
+
+
+def summary(results, elapsed):
+    '''
+    Lines reporting status counts, attempts and reply latency of a fan out. The reply rate is taken
+    up to the last reply, devices that never answer would otherwise set it with their timeouts.
+    '''
+    statuses = Counter(r.status for r in results)
+    attempts = Counter(r.attempts for r in results)
+    replied = [r for r in results if r.latency is not None]
+    latencies = sorted(r.latency for r in replied)
+    span = 0
+    if replied:
+        span = max(r.started + r.latency for r in replied) - min(r.started for r in results)
+    lines = ['{} devices in {:.2f} s, {} replies in {:.2f} s, {:.0f} replies/s'.format(
+                 len(results), elapsed, len(replied), span, len(replied) / span if span else 0),
+             'status   ' + '  '.join('{} {}'.format(k, statuses[k]) for k in sorted(statuses)),
+             'attempts ' + '  '.join('{}: {}'.format(k, attempts[k]) for k in sorted(attempts))]
+    if latencies:
+        lines.append('latency  p50 {:.0f} ms  p99 {:.0f} ms  max {:.0f} ms'.format(
+            latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
+    return lines
+
+
+def read_devices(arg):
+    if os.path.exists(arg):
+        with open(arg) as f:
+            return [line.strip() for line in f if line.strip()]
+    return [d for d in arg.split(',') if d]
+
+
+async def run(host, port, devices, command, fleet_key):
+    connection = await Connection.open(host, port, 'hppc-control-{}'.format(os.urandom(3).hex()))
+    plane = ControlPlane(connection, fleet_key=fleet_key)
+    connection.subscribe([plane.reply_filter()])
+    receiver = asyncio.ensure_future(connection.run(plane.on_message))
+    start = time.perf_counter()
+    results = await plane.fan_out(devices, command)
+    elapsed = time.perf_counter() - start
+    receiver.cancel()
+    connection.close()
+    return results, elapsed
+
+
+def main():
+    if len(sys.argv) < 5:
+        print(__doc__)
+        return 1
+    devices = read_devices(sys.argv[3])
+    command = json.loads(sys.argv[4])
+    fleet_key = sys.argv[5] if len(sys.argv) > 5 else os.environ.get('HPPC_FLEET_KEY')
+    results, elapsed = asyncio.run(run(sys.argv[1], int(sys.argv[2]), devices, command, fleet_key))
+    for result in results:
+        print(result)
+    for line in summary(results, elapsed):
+        print(line)
+    return 0 if all(r.status == 'ok' for r in results) else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+'''
+Host-side decoder for the binary telemetry format (libs/telemetry.py).
+Turns binary records back into DATA style dictionaries. JSON payloads are passed through, so
+consumers can handle both formats with decode_message().
+
+    python -m tools.decode_telemetry <topic> <hex payload> [<hex payload> ...]
+'''
+import json
+import sys
+import time
+
+from libs import telemetry
+
+
+def format_time(unix_time):
+    '''Unix time in the getTime() format, YYYY_MM_DD_HH_MM_SS (UTC)'''
+    return '{}_{:02d}_{:02d}_{:02d}_{:02d}_{:02d}'.format(*time.gmtime(unix_time)[:6])
+
+
+def record_to_data(record, device_id):
+    '''Converts a decoded telemetry record into the DATA layout published by the JSON path'''
+    data = {'id': device_id}
+    for name, scale in telemetry.FIELDS:
+        data[name] = record[name]
+    for name in telemetry.FLAGS:
+        data[name] = record[name]
+    data['error_codes'] = telemetry.error_names(record['errors'])
+    data['time'] = format_time(record['time'])
+    return data
+
+
+def decode_message(topic, payload):
+    '''
+    Returns the list of DATA dictionaries carried by one message.
+    Binary payloads are published on <data topic>/<device id>, site batches from a gateway on
+    <data topic>/site/<site id>; JSON payloads hold a dictionary or, for replayed spools and
+    gateways, a list of dictionaries.
+    '''
+    if isinstance(topic, bytes):
+        topic = topic.decode()
+    if payload[:1] in (b'{', b'['):
+        decoded = json.loads(payload)
+        return decoded if isinstance(decoded, list) else [decoded]
+    parts = topic.rsplit('/', 2)
+    if len(parts) == 3 and parts[1] == 'site':
+        return [record_to_data(record, device_id) for device_id, records in telemetry.decode_site_batch(payload)
+                for record in telemetry.decode_batch(records)]
+    device_id = parts[-1]
+    return [record_to_data(record, device_id) for record in telemetry.decode_batch(payload)]
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__)
+        return 1
+    topic = sys.argv[1]
+    for payload in sys.argv[2:]:
+        for data in decode_message(topic, bytes.fromhex(payload)):
+            print(json.dumps(data))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,372 @@
+'''
+Site gateway: the controllers of one SITE_ID connect to it over the LAN (MQTT_GATEWAY in their config)
+instead of to the cloud broker, and it keeps the site's only session upstream.
+    devices -> cloud  Telemetry is merged into site level messages: JSON DATA into one list on the data
+                      topic, binary records (libs/telemetry.py) into one site batch on
+                      <data topic>/site/<site id>, sent every `linger` s or once `max_batch` bytes are
+                      waiting. Everything else (control replies, DEVICE RUNNING) is forwarded at once.
+                      Messages go upstream at QoS 1 and are sent again after a reconnect until acknowledged.
+    cloud -> devices  Every topic filter a device subscribes to is subscribed upstream once, and messages
+                      on it are passed down at QoS 0 to the devices whose filters match.
+A device's QoS 1 publish is acknowledged once the gateway holds it. When more than `buffer` bytes are
+waiting for the uplink the gateway stops reading from the devices, whose publish windows then fill up and
+their own spools take over. The gateway also answers NTP requests from the host clock, so the devices
+need nothing beyond the LAN.
+
+    python -m tools.gateway <site id> <cloud host> [port] [listen port] [user] [password]
+'''
+import asyncio
+import json
+import struct
+import sys
+import time
+from collections import deque
+
+from libs import telemetry
+from tools.mqtt import KEEPALIVE, Connection, encode_len, encode_string, matches, read_packet
+
+DATA_TOPIC = 'hppc/data'
+LINGER = 5.0                # s a data message may wait for others
+MAX_BATCH = 65536           # bytes of records that are sent without waiting for the linger
+BUFFER = 4 * 1024 * 1024    # bytes waiting for the uplink before the devices are held back
+WINDOW = 32                 # upstream messages unacknowledged at once
+NTP_PORT = 123
+NTP_DELTA = 2208988800      # s from 1900 (NTP) to 1970 (unix)
+
+
+class Session:
+    '''One device's connection to the gateway'''
+    def __init__(self, client_id, writer):
+        self.client_id = client_id
+        self.writer = writer
+        self.filters = set()
+        self.received = 0
+
+
+class SNTP(asyncio.DatagramProtocol):
+    '''Answers ntptime.settime() with the host's time'''
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 48:
+            return
+        now = time.time() + NTP_DELTA
+        seconds = int(now)
+        fraction = int((now - seconds) * 2 ** 32)
+        reply = bytearray(48)
+        reply[0] = 0x24     # no leap second warning, version 4, server
+        reply[1] = 2        # stratum, the host syncs from a public server
+        reply[24:32] = data[40:48]
+        struct.pack_into('!IIII', reply, 32, seconds, fraction, seconds, fraction)
+        self.transport.sendto(bytes(reply), addr)
+
+
+class Gateway:
+    def __init__(self, site_id, host, port=1883, data_topic=DATA_TOPIC, user=None, password=None,
+                 linger=LINGER, max_batch=MAX_BATCH, buffer=BUFFER, window=WINDOW, keepalive=KEEPALIVE):
+        self.site_id = site_id
+        self.host = host
+        self.port = port
+        self.data_topic = data_topic
+        self.site_topic = '{}/site/{}'.format(data_topic, site_id)
+        self.user = user
+        self.password = password
+        self.linger = linger
+        self.max_batch = max_batch
+        self.buffer = buffer
+        self.window = window
+        self.keepalive = keepalive
+        self.sessions = {}          # client id -> Session
+        self.exact = {}             # topic filter without wildcards -> sessions subscribed to it
+        self.wildcards = {}         # topic filter with + or # -> sessions subscribed to it
+        self.upstream = None        # Connection while the uplink is up
+        self.json = []              # DATA dictionaries waiting for the next batch
+        self.binary = {}            # device id -> bytearray of records waiting for the next batch
+        self.batched = 0            # bytes in json and binary
+        self.outbox = deque()       # (topic, payload) waiting for a window slot upstream
+        self.inflight = 0
+        self.buffered = 0           # bytes waiting for the uplink, batches included
+        self.room = asyncio.Event()
+        self.room.set()
+        self.wake = asyncio.Event()
+        self.flushed = asyncio.Event()
+        self.tasks = []
+        self.received = 0           # messages from the devices
+        self.records = 0
+        self.forwarded = 0          # messages sent upstream
+        self.delivered = 0          # messages passed down to the devices
+        self.reconnects = 0
+        self.held = 0               # times the devices were held back
+
+    async def start(self, listen_host='0.0.0.0', listen_port=1883, ntp_port=NTP_PORT):
+        '''Serves the devices and starts the uplink. ntp_port None serves no NTP.'''
+        self.server = await asyncio.start_server(self.serve, listen_host, listen_port)
+        self.listen_port = self.server.sockets[0].getsockname()[1]
+        self.ntp = None
+        if ntp_port is not None:
+            try:
+                self.ntp, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                    SNTP, local_addr=(listen_host, ntp_port))
+            except OSError as e:
+                print('NTP not served: {}'.format(e))
+        self.tasks = [asyncio.ensure_future(job()) for job in (self.uplink, self.send, self.batcher)]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.server.close()
+        for session in list(self.sessions.values()):
+            session.writer.close()
+        if self.ntp is not None:
+            self.ntp.close()
+        if self.upstream is not None:
+            self.upstream.close()
+        await self.server.wait_closed()
+
+    # devices
+
+    async def serve(self, reader, writer):
+        session = None
+        try:
+            header, body = await read_packet(reader)
+            if header != 0x10:
+                return
+            id_at = 2 + body[1] + 4
+            id_len = struct.unpack_from('!H', body, id_at)[0]
+            client_id = body[id_at + 2:id_at + 2 + id_len].decode()
+            old = self.sessions.get(client_id)
+            if old is not None:
+                self._drop(old)
+                old.writer.close()
+            session = self.sessions[client_id] = Session(client_id, writer)
+            # subscriptions are not kept, the firmware subscribes again on every connect
+            writer.write(b'\x20\x02\x00\x00')
+            while True:
+                if not self.room.is_set():
+                    await self.room.wait()
+                header, body = await read_packet(reader)
+                op = header & 0xF0
+                if op == 0x30:
+                    topic_len = struct.unpack_from('!H', body)[0]
+                    topic = body[2:2 + topic_len].decode()
+                    at = 2 + topic_len
+                    if header & 0x06:
+                        writer.write(b'\x40\x02' + body[at:at + 2])
+                        at += 2
+                    session.received += 1
+                    self.received += 1
+                    self.accept(topic, body[at:])
+                elif op == 0x80:
+                    self.subscribe(session, body)
+                elif op == 0xC0:
+                    writer.write(b'\xd0\x00')
+                elif op == 0xE0:
+                    return
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, UnicodeError):
+            pass
+        finally:
+            if session is not None and self.sessions.get(session.client_id) is session:
+                self._drop(session)
+                del self.sessions[session.client_id]
+            writer.close()
+
+    def subscribe(self, session, body):
+        pid = body[:2]
+        granted = bytearray()
+        new = []
+        at = 2
+        while at < len(body):
+            topic_len = struct.unpack_from('!H', body, at)[0]
+            topic_filter = body[at + 2:at + 2 + topic_len].decode()
+            at += 3 + topic_len
+            # passed down at QoS 0
+            granted.append(0)
+            session.filters.add(topic_filter)
+            table = self.wildcards if '+' in topic_filter or '#' in topic_filter else self.exact
+            if topic_filter not in table:
+                table[topic_filter] = set()
+                new.append(topic_filter)
+            table[topic_filter].add(session)
+        session.writer.write(b'\x90' + encode_len(2 + len(granted)) + pid + granted)
+        if new and self.upstream is not None:
+            self.upstream.subscribe(new)
+
+    def _drop(self, session):
+        # the filters stay subscribed upstream until the next reconnect
+        for topic_filter in session.filters:
+            for table in (self.exact, self.wildcards):
+                sessions = table.get(topic_filter)
+                if sessions is not None:
+                    sessions.discard(session)
+                    if not sessions:
+                        del table[topic_filter]
+
+    def accept(self, topic, payload):
+        '''Takes a device's message, batching telemetry and queueing everything else for the uplink'''
+        if topic == self.data_topic and payload[:1] in (b'{', b'['):
+            try:
+                data = json.loads(payload)
+            except ValueError:
+                data = None
+            if isinstance(data, (dict, list)):
+                records = data if isinstance(data, list) else [data]
+                self.json += records
+                self._batched(len(payload), len(records))
+                return
+        elif topic.startswith(self.data_topic + '/') and payload and not len(payload) % telemetry.SIZE:
+            device_id = topic[len(self.data_topic) + 1:]
+            if '/' not in device_id and len(device_id.encode()) < 256:
+                records = self.binary.get(device_id)
+                if records is None:
+                    records = self.binary[device_id] = bytearray()
+                records += payload
+                self._batched(len(payload), len(payload) // telemetry.SIZE)
+                return
+        self.queue(topic, payload)
+
+    def _batched(self, size, records):
+        self.records += records
+        self.batched += size
+        self._hold(size)
+        if self.batched >= self.max_batch:
+            self.flush()
+
+    def _hold(self, size):
+        self.buffered += size
+        if self.buffered > self.buffer and self.room.is_set():
+            self.room.clear()
+            self.held += 1
+
+    def _release(self, size):
+        self.buffered -= size
+        if self.buffered <= self.buffer:
+            self.room.set()
+
+    def flush(self):
+        '''Queues the waiting telemetry as site level messages'''
+        if self.json:
+            self.queue(self.data_topic, json.dumps(self.json, separators=(',', ':')).encode())
+            self.json = []
+        if self.binary:
+            self.queue(self.site_topic, telemetry.encode_site_batch(self.binary))
+            self.binary = {}
+        self._release(self.batched)
+        self.batched = 0
+
+    async def batcher(self):
+        while True:
+            await asyncio.sleep(self.linger)
+            self.flush()
+
+    def deliver(self, topic, payload):
+        '''Passes a message from the cloud down to the devices subscribed to it'''
+        sessions = set(self.exact.get(topic, ()))
+        for topic_filter, subscribed in self.wildcards.items():
+            if matches(topic_filter, topic):
+                sessions |= subscribed
+        if not sessions:
+            return
+        topic = encode_string(topic)
+        packet = b'\x30' + encode_len(len(topic) + len(payload)) + topic + payload
+        for session in sessions:
+            session.writer.write(packet)
+            self.delivered += 1
+
+    # uplink
+
+    def queue(self, topic, payload):
+        self._hold(len(payload))
+        self.outbox.append((topic, payload))
+        self.wake.set()
+
+    async def uplink(self):
+        '''Keeps the upstream session up, subscribing to every device filter again after a reconnect'''
+        delay = 1
+        client_id = 'hppc-gateway-{}'.format(self.site_id)
+        while True:
+            try:
+                connection = await Connection.open(self.host, self.port, client_id, self.keepalive, self.user, self.password)
+            except OSError as e:
+                print('cloud connection failed: {}'.format(e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+                continue
+            delay = 1
+            filters = list(self.exact) + list(self.wildcards)
+            if filters:
+                connection.subscribe(filters)
+            self.upstream = connection
+            self.wake.set()
+
+            async def on_message(topic, payload):
+                self.deliver(topic.decode(), payload)
+            await connection.run(on_message)
+            self.upstream = None
+            self.reconnects += 1
+
+    async def send(self):
+        '''Publishes the outbox upstream, at most `window` messages unacknowledged'''
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            while self.outbox and self.upstream is not None and self.inflight < self.window:
+                topic, payload = self.outbox.popleft()
+                future = self.upstream.publish(topic, payload, qos=1)
+                self.inflight += 1
+                future.add_done_callback(lambda f, message=(topic, payload): self._acked(f, message))
+            if self.upstream is not None:
+                try:
+                    await self.upstream.drain()
+                except ConnectionError:
+                    pass
+
+    def _acked(self, future, message):
+        self.inflight -= 1
+        if future.cancelled():
+            # the uplink dropped first, sent again after the reconnect
+            self.outbox.appendleft(message)
+        else:
+            self.forwarded += 1
+            self._release(len(message[1]))
+            if not self.outbox and not self.inflight and not self.batched:
+                self.flushed.set()
+        self.wake.set()
+
+    async def drain(self):
+        '''Flushes the waiting telemetry and waits until the cloud has acknowledged everything'''
+        self.flush()
+        while self.outbox or self.inflight or self.batched:
+            self.flushed.clear()
+            await self.flushed.wait()
+
+
+async def serve(gateway, listen_port):
+    await gateway.start(listen_port=listen_port)
+    print('site {}: devices on port {}, cloud at {}:{}'.format(gateway.site_id, gateway.listen_port, gateway.host, gateway.port))
+    while True:
+        await asyncio.sleep(60)
+        print('{} devices, {} messages in, {} records, {} forwarded, {} delivered, {} reconnects, {} bytes waiting'.format(
+            len(gateway.sessions), gateway.received, gateway.records, gateway.forwarded, gateway.delivered,
+            gateway.reconnects, gateway.buffered))
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__)
+        return 1
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 1883
+    listen_port = int(sys.argv[4]) if len(sys.argv) > 4 else 1883
+    user = sys.argv[5] if len(sys.argv) > 5 else None
+    password = sys.argv[6] if len(sys.argv) > 6 else None
+    try:
+        asyncio.run(serve(Gateway(sys.argv[1], sys.argv[2], port, user=user, password=password), listen_port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,301 @@
+'''
+Host-side ingestion service for fleet telemetry. Subscribes to the data topic, parses and validates
+messages in batches and writes them to the columnar store (tools/store.py).
+Binary payloads (libs/telemetry.py, on <data topic>/<device id>) of a whole batch are decoded in one
+NumPy call; JSON payloads (DATA dictionaries, or lists of them from spool replays) are converted to the
+same scaled integers. Site batches from a gateway (tools/gateway.py, on <data topic>/site/<site id>) are
+split into their devices' binary payloads. Records are rejected, and counted by reason, when the payload is malformed, the
+device id is not usable as a directory name or the time is implausible (a device without NTP reports 2000).
+
+    python -m tools.ingest <store directory> [broker host] [port] [data topic]
+'''
+import asyncio
+import calendar
+import json
+import re
+import struct
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from libs import telemetry
+from tools.mqtt import KEEPALIVE, Connection
+from tools.store import ColumnStore
+
+DATA_TOPIC = 'hppc/data'
+BATCH_SIZE = 2000           # messages parsed and written together
+FLUSH_INTERVAL = 5          # s between store flushes
+QUEUE_SIZE = 50000          # messages waiting to be parsed before the subscriber is held back
+
+# oldest and newest plausible record times, unix s
+MIN_TIME = calendar.timegm((2020, 1, 1, 0, 0, 0))
+MAX_SKEW = 86400
+
+# the binary record as a NumPy structure, same layout as telemetry.FORMAT
+RECORD = np.dtype([('version', 'u1'), ('time', '<u4'), ('values', '<i2', (len(telemetry.FIELDS),)),
+                   ('flags', 'u1'), ('errors', 'u1')])
+assert RECORD.itemsize == telemetry.SIZE
+
+DEVICE_ID = re.compile(r'^[A-Za-z0-9_\-][A-Za-z0-9_.\-]{0,63}$')
+# DATA keys of the error messages, as in main.py
+ERROR_KEYS = ('error_message_1', 'error_message_2', 'error_message_3', 'error_message_4')
+
+
+def parse_time(stamp):
+    '''getTime() string (YYYY_MM_DD_HH_MM_SS, UTC) to unix s'''
+    return calendar.timegm(tuple(int(p) for p in stamp.split('_')) + (0, 0, 0))
+
+
+class Batch:
+    '''Records parsed from a batch of messages, as columns, with the devices they came from'''
+    def __init__(self):
+        self.devices = []
+        self.index = {}             # device id -> position in devices
+        self.rejected = Counter()
+        self.binary = []            # (device position, payload)
+        self.rows = []              # JSON records: (device position, time, values, flags, errors)
+
+    def device(self, device_id):
+        if not isinstance(device_id, str) or not DEVICE_ID.match(device_id):
+            return None
+        i = self.index.get(device_id)
+        if i is None:
+            i = self.index[device_id] = len(self.devices)
+            self.devices.append(device_id)
+        return i
+
+    def add(self, topic, payload):
+        if isinstance(topic, bytes):
+            topic = topic.decode('utf-8', 'replace')
+        if payload[:1] in (b'{', b'['):
+            self._add_json(payload)
+            return
+        parts = topic.rsplit('/', 2)
+        if len(parts) == 3 and parts[1] == 'site':
+            self._add_site(payload)
+            return
+        self._add_binary(parts[-1], payload)
+
+    def _add_site(self, payload):
+        try:
+            devices = telemetry.decode_site_batch(payload)
+        except (IndexError, UnicodeError, ValueError, struct.error):
+            self.rejected['site'] += 1
+            return
+        for device_id, records in devices:
+            self._add_binary(device_id, records)
+
+    def _add_binary(self, device_id, payload):
+        device = self.device(device_id)
+        if device is None:
+            self.rejected['id'] += 1
+        elif not payload or len(payload) % telemetry.SIZE:
+            self.rejected['size'] += 1
+        else:
+            self.binary.append((device, payload))
+
+    def _add_json(self, payload):
+        try:
+            decoded = json.loads(payload)
+        except ValueError:
+            self.rejected['json'] += 1
+            return
+        for data in decoded if isinstance(decoded, list) else [decoded]:
+            try:
+                device = self.device(data.get('id'))
+                if device is None:
+                    self.rejected['id'] += 1
+                    continue
+                values = [telemetry._scaled(data.get(name), scale) for name, scale in telemetry.FIELDS]
+                flags = 0
+                for i in range(len(telemetry.FLAGS)):
+                    if data.get(telemetry.FLAGS[i]):
+                        flags |= 1 << i
+                errors = 0
+                for i in range(len(ERROR_KEYS)):
+                    if data.get(ERROR_KEYS[i]):
+                        errors |= 1 << i
+                self.rows.append((device, parse_time(data['time']), values, flags, errors))
+            except (AttributeError, KeyError, TypeError, ValueError):
+                self.rejected['json'] += 1
+
+    def columns(self, now=None):
+        '''(device index array, {column: array}) of the valid records, counting the others as rejected'''
+        if now is None:
+            now = time.time()
+        device_index = []
+        times = []
+        values = []
+        flags = []
+        errors = []
+        if self.binary:
+            payload = b''.join(p for d, p in self.binary)
+            records = np.frombuffer(payload, RECORD)
+            counts = [len(p) // telemetry.SIZE for d, p in self.binary]
+            device_index.append(np.repeat(np.array([d for d, p in self.binary], np.int32), counts))
+            version = records['version'] == telemetry.VERSION
+            bad = int(np.count_nonzero(~version))
+            if bad:
+                self.rejected['version'] += bad
+            times.append(np.where(version, records['time'], 0).astype(np.int64))
+            values.append(records['values'])
+            flags.append(records['flags'])
+            errors.append(records['errors'])
+        if self.rows:
+            device_index.append(np.array([r[0] for r in self.rows], np.int32))
+            times.append(np.array([r[1] for r in self.rows], np.int64))
+            values.append(np.array([r[2] for r in self.rows], np.int16).reshape(-1, len(telemetry.FIELDS)))
+            flags.append(np.array([r[3] for r in self.rows], np.uint8))
+            errors.append(np.array([r[4] for r in self.rows], np.uint8))
+        if not times:
+            return np.empty(0, np.int32), None
+        t = np.concatenate(times)
+        valid = (t >= MIN_TIME) & (t <= now + MAX_SKEW)
+        # records with a bad version were counted already and carry time 0
+        bad = int(np.count_nonzero(~valid & (t != 0)))
+        if bad:
+            self.rejected['time'] += bad
+        values = np.concatenate(values)[valid]
+        columns = {'time': t[valid], 'flags': np.concatenate(flags)[valid], 'errors': np.concatenate(errors)[valid]}
+        for i in range(len(telemetry.FIELDS)):
+            columns[telemetry.FIELDS[i][0]] = values[:, i]
+        return np.concatenate(device_index)[valid], columns
+
+
+class Ingester:
+    '''
+    Batches messages from submit() or put() and writes them to `store`. Parsing runs on the event loop,
+    store writes on one worker thread so the loop keeps reading from the broker meanwhile.
+    '''
+    def __init__(self, store, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(queue_size)
+        self.executor = ThreadPoolExecutor(1)
+        self.messages = 0
+        self.records = 0
+        self.batches = 0
+        self.dropped = 0
+        self.rejected = Counter()
+        self.busy = 0               # CPU s spent parsing and writing
+
+    def submit(self, topic, payload):
+        '''Queues a message from a callback, dropping it (and counting it) when the queue is full'''
+        try:
+            self.queue.put_nowait((topic, payload))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def put(self, topic, payload):
+        '''Queues a message, waiting for room'''
+        await self.queue.put((topic, payload))
+
+    def _write(self, devices, device_index, columns):
+        start = time.thread_time()
+        if columns is not None and len(device_index):
+            self.store.append(devices, device_index, columns)
+        self.busy += time.thread_time() - start
+
+    def _flush(self):
+        start = time.thread_time()
+        self.store.flush()
+        self.busy += time.thread_time() - start
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        flushed = time.monotonic()
+        while True:
+            batch = Batch()
+            taken = 0
+            try:
+                message = await asyncio.wait_for(self.queue.get(), self.flush_interval)
+                taken = 1
+            except asyncio.TimeoutError:
+                message = None
+            start = time.thread_time()
+            if message is not None:
+                batch.add(*message)
+            while taken and taken < self.batch_size and not self.queue.empty():
+                batch.add(*self.queue.get_nowait())
+                taken += 1
+            device_index, columns = batch.columns()
+            self.busy += time.thread_time() - start
+            await loop.run_in_executor(self.executor, self._write, batch.devices, device_index, columns)
+            self.messages += taken
+            self.records += len(device_index)
+            self.rejected.update(batch.rejected)
+            self.batches += taken > 0
+            for i in range(taken):
+                self.queue.task_done()
+            if time.monotonic() - flushed >= self.flush_interval:
+                await loop.run_in_executor(self.executor, self._flush)
+                flushed = time.monotonic()
+
+    async def drain(self):
+        '''Waits until every queued message is written, then flushes the store'''
+        await self.queue.join()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._flush)
+
+
+async def subscribe(host, port, topics, on_message, client_id='hppc-ingest', keepalive=KEEPALIVE):
+    '''
+    Subscribes to `topics` at QoS 1 and awaits on_message(topic, payload) for every message before
+    acknowledging it, so a full ingest queue holds the broker back. Returns when the connection drops.
+    '''
+    connection = await Connection.open(host, port, client_id, keepalive)
+    connection.subscribe(topics)
+    await connection.run(on_message)
+
+
+async def serve(store, host, port, topic):
+    ingester = Ingester(store)
+    worker = asyncio.ensure_future(ingester.run())
+    delay = 1
+    while True:
+        try:
+            await subscribe(host, port, (topic, topic + '/#'), ingester.put)
+            delay = 1
+        except OSError as e:
+            print('broker connection failed: {}'.format(e))
+        print('{} messages, {} records, rejected {}'.format(ingester.messages, ingester.records, dict(ingester.rejected)))
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+        if worker.done():
+            return worker.result()
+
+
+def raise_file_limit():
+    '''Lifts the soft open file limit to the hard one, every mapped partition holds a descriptor'''
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return 1
+    host = sys.argv[2] if len(sys.argv) > 2 else 'localhost'
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 1883
+    topic = sys.argv[4] if len(sys.argv) > 4 else DATA_TOPIC
+    raise_file_limit()
+    store = ColumnStore(sys.argv[1])
+    try:
+        asyncio.run(serve(store, host, port, topic))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+'''
+Minimal asyncio MQTT 3.1.1 client for the host-side tools, so they need nothing beyond the standard
+library and NumPy. Supports what the tools use: CONNECT (clean session), SUBSCRIBE, PUBLISH at QoS 0/1
+and receiving at QoS 0/1, PINGREQ. The packet helpers are shared with the site gateway (tools/gateway.py),
+which serves the other side of the protocol.
+'''
+import asyncio
+import struct
+
+KEEPALIVE = 60  # s
+
+
+def encode_len(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+def encode_string(s):
+    s = s.encode() if isinstance(s, str) else s
+    return struct.pack('!H', len(s)) + s
+
+
+async def read_packet(reader):
+    '''(first header byte, body) of the next packet'''
+    header = (await reader.readexactly(1))[0]
+    n = shift = 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        n |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    return header, await reader.readexactly(n)
+
+
+def matches(topic_filter, topic):
+    '''MQTT topic filter matching with + and # wildcards, on str or bytes'''
+    sep = b'/' if isinstance(topic, bytes) else '/'
+    f = topic_filter.split(sep)
+    t = topic.split(sep)
+    for i in range(len(f)):
+        if f[i] in ('#', b'#'):
+            return True
+        if i >= len(t) or f[i] not in ('+', b'+') and f[i] != t[i]:
+            return False
+    return len(f) == len(t)
+
+
+class Connection:
+    '''One connection to a broker, made with open()'''
+    def __init__(self, reader, writer, keepalive):
+        self.reader = reader
+        self.writer = writer
+        self.keepalive = keepalive
+        self.pid = 0
+        self.sent = 0
+        self.received = 0
+        self.unacked = {}       # pid -> future of a QoS 1 publish
+
+    @classmethod
+    async def open(cls, host, port, client_id, keepalive=KEEPALIVE, user=None, password=None):
+        reader, writer = await asyncio.open_connection(host, port)
+        flags = 0x02 | (0xC0 if user is not None else 0)
+        body = b'\x00\x04MQTT\x04' + bytes((flags,)) + struct.pack('!H', keepalive) + encode_string(client_id)
+        if user is not None:
+            body += encode_string(user) + encode_string(password)
+        writer.write(b'\x10' + encode_len(len(body)) + body)
+        header, body = await read_packet(reader)
+        if header != 0x20 or body[1] != 0:
+            writer.close()
+            raise ConnectionError('Broker refused the connection ({})'.format(body[1]))
+        return cls(reader, writer, keepalive)
+
+    def _next_pid(self):
+        self.pid = self.pid % 0xFFFF + 1
+        return self.pid
+
+    def subscribe(self, topics, qos=1):
+        '''Subscribes to topic filters without waiting for the SUBACK, which run() discards'''
+        body = struct.pack('!H', self._next_pid()) + b''.join(encode_string(topic) + bytes((qos,)) for topic in topics)
+        self.writer.write(b'\x82' + encode_len(len(body)) + body)
+
+    def publish(self, topic, payload, qos=0):
+        '''
+        QoS 0 by default, the control tool gets its acknowledgement from the reply. With qos=1 returns a
+        future that is done once the broker has acknowledged the message, and cancelled if the connection
+        drops first. Acknowledgements are only read while run() is running.
+        '''
+        topic = encode_string(topic)
+        if not qos:
+            self.writer.write(b'\x30' + encode_len(len(topic) + len(payload)) + topic + payload)
+            self.sent += 1
+            return None
+        pid = self._next_pid()
+        future = self.unacked[pid] = asyncio.get_running_loop().create_future()
+        self.writer.write(b'\x32' + encode_len(len(topic) + 2 + len(payload)) + topic + struct.pack('!H', pid) + payload)
+        self.sent += 1
+        return future
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def run(self, on_message):
+        '''
+        Awaits on_message(topic, payload) for every message received, acknowledging QoS 1 ones only
+        afterwards so a slow consumer holds the broker back instead of losing messages.
+        Returns when the connection drops. Cancelling it leaves the connection open.
+        '''
+        pinger = asyncio.ensure_future(self._ping())
+        try:
+            while True:
+                header, body = await read_packet(self.reader)
+                if header == 0x40:
+                    future = self.unacked.pop(struct.unpack('!H', body)[0], None)
+                    if future is not None and not future.done():
+                        future.set_result(True)
+                    continue
+                if header & 0xF0 != 0x30:
+                    continue        # SUBACK, PINGRESP
+                topic_len = struct.unpack_from('!H', body)[0]
+                at = 2 + topic_len
+                qos = (header >> 1) & 3
+                pid = body[at:at + 2]
+                if qos:
+                    at += 2
+                self.received += 1
+                await on_message(body[2:2 + topic_len], body[at:])
+                if qos == 1:
+                    self.writer.write(b'\x40\x02' + pid)
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.writer.close()
+            for future in self.unacked.values():
+                future.cancel()
+            self.unacked.clear()
+        finally:
+            pinger.cancel()
+
+    async def _ping(self):
+        while True:
+            await asyncio.sleep(self.keepalive / 2)
+            self.writer.write(b'\xc0\x00')
+
+    def close(self):
+        self.writer.write(b'\xe0\x00')
+        self.writer.close()
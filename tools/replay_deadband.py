@@ -0,0 +1,106 @@
+'''
+Replays a recorded DATA series through the report-by-exception filter (libs/deadband.py) and
+reports how many messages and bytes it saves compared to publishing every LOG_INTERVAL.
+
+    python -m tools.replay_deadband <recording.jsonl> [deadbands.json] [heartbeat ms]
+    python -m tools.replay_deadband --synthetic
+
+A recording holds one published DATA dictionary per line. Without a recording a synthetic day of
+10 s readings is used, with no solar current at night.
+'''
+import json
+import math
+import random
+import sys
+import time
+
+from libs.deadband import ReportByException
+
+TOPIC = 'hppc/data'
+DEFAULT_DEADBANDS = {
+    'scc_load_voltage': 0.1, 'scc_load_current': 0.05,
+    'battery_voltage': 0.1, 'battery_current': 0.05,
+    'solar_voltage': 0.5, 'solar_current': 0.05,
+    'temperature': 0.5,
+    }
+DEFAULT_HEARTBEAT = 900000
+
+
+def parse_time(stamp):
+    '''getTime() string (YYYY_MM_DD_HH_MM_SS) to ms'''
+    parts = [int(p) for p in stamp.split('_')]
+    return int(time.mktime(tuple(parts) + (0, 0, -1)) * 1000)
+
+
+def synthetic_day(interval=10):
+    '''A day of readings every `interval` s: a solar bell curve, a constant load and small noise'''
+    series = []
+    start = time.mktime((2023, 6, 1, 0, 0, 0, 0, 0, -1))
+    for i in range(int(86400 / interval)):
+        t = start + i * interval
+        hour = i * interval / 3600
+        sun = max(0.0, math.sin((hour - 6) / 12 * math.pi)) if 6 <= hour <= 18 else 0.0
+        solar_current = round(6 * sun + random.gauss(0, 0.01), 3) if sun else 0.0
+        load_current = 1.2 + random.gauss(0, 0.01)
+        series.append({
+            'id': 'HPPC-REPLAY', 'site_id': 'SITE',
+            'scc_load_voltage': round(24.0 + random.gauss(0, 0.02), 3),
+            'scc_load_current': round(load_current, 3),
+            'battery_voltage': round(25.0 + 2.5 * sun + random.gauss(0, 0.02), 3),
+            'battery_current': round(solar_current - load_current, 3),
+            'solar_voltage': round(38.0 * min(1.0, sun * 3), 2),
+            'solar_current': solar_current,
+            'temperature': round(22 + 10 * sun + random.gauss(0, 0.05), 2),
+            'connected_to_wifi': True, 'battery_connected': True, 'panel_connected': sun > 0.05,
+            'error_message_1': None, 'error_message_2': None, 'error_message_3': None, 'error_message_4': None,
+            'time': '{}_{:02d}_{:02d}_{:02d}_{:02d}_{:02d}'.format(*time.localtime(t)[:6]),
+            })
+    return series
+
+
+def replay(series, deadbands, heartbeat):
+    now = [0]
+    report = ReportByException(deadbands, heartbeat, clock=lambda: now[0])
+    full = {'messages': 0, 'bytes': 0}
+    rbe = {'messages': 0, 'bytes': 0}
+    for data in series:
+        now[0] = parse_time(data['time'])
+        payload = json.dumps(data)
+        full['messages'] += 1
+        full['bytes'] += len(TOPIC) + len(payload)
+        fields = report.changes(data)
+        if fields is None:
+            continue
+        if fields is not data:
+            fields = dict(fields, id=data['id'], time=data['time'])
+        rbe['messages'] += 1
+        rbe['bytes'] += len(TOPIC) + len(json.dumps(fields))
+    return full, rbe
+
+
+def main():
+    args = sys.argv[1:]
+    if not args:
+        print(__doc__)
+        return 1
+    if args[0] == '--synthetic':
+        series = synthetic_day()
+    else:
+        with open(args[0]) as f:
+            series = [json.loads(line) for line in f if line.strip()]
+    deadbands = DEFAULT_DEADBANDS
+    if len(args) > 1:
+        with open(args[1]) as f:
+            deadbands = json.load(f)
+    heartbeat = int(args[2]) if len(args) > 2 else DEFAULT_HEARTBEAT
+    full, rbe = replay(series, deadbands, heartbeat)
+    print('{:<22} {:>10} {:>12}'.format('', 'messages', 'bytes'))
+    print('{:<22} {:>10} {:>12}'.format('every LOG_INTERVAL', full['messages'], full['bytes']))
+    print('{:<22} {:>10} {:>12}'.format('report by exception', rbe['messages'], rbe['bytes']))
+    print('reduction: {:.1%} of messages, {:.1%} of bytes'.format(
+        1 - rbe['messages'] / full['messages'], 1 - rbe['bytes'] / full['bytes']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
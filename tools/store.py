@@ -0,0 +1,315 @@
+'''
+Columnar time-series store for fleet telemetry, one directory per device and one file per device per
+UTC day (partition). A partition file holds a header and then each column as one contiguous block:
+    time     int64, unix s
+    readings int16 each, scaled as in libs/telemetry.py FIELDS (MISSING when absent)
+    flags    uint8, libs/telemetry.py FLAGS bits
+    errors   uint8, libs/telemetry.py ERRORS bits
+Files are memory-mapped and the columns used as NumPy arrays, so range and downsampling queries read
+only the blocks they need and run vectorised. Rows are kept sorted by time with one row per second:
+late records (spool replays) are merged in and a repeated time keeps the last record received.
+Capacity doubles as a partition fills; the row count in the header is only updated by flush(), so a
+reader never sees half written rows.
+
+    python -m tools.store <store directory> [device] [hours] [bucket s]
+'''
+import calendar
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from libs import telemetry
+
+MAGIC = b'HPCS'
+VERSION = 1
+# magic, version, column count, capacity (rows), rows
+HEADER = '<4sHHII'
+DATA_OFFSET = 64
+INITIAL_ROWS = 4096
+MAX_OPEN = 4096     # partitions kept mapped, about one per device being written
+DAY = 86400
+
+COLUMNS = ((('time', np.dtype('<i8')),)
+           + tuple((name, np.dtype('<i2')) for name, scale in telemetry.FIELDS)
+           + (('flags', np.dtype('u1')), ('errors', np.dtype('u1'))))
+SCALES = dict(telemetry.FIELDS)
+
+
+def day_name(day):
+    '''Partition file name of a day number (unix time // DAY), in the getTime() date format'''
+    return '{}_{:02d}_{:02d}.col'.format(*time.gmtime(day * DAY)[:3])
+
+
+def name_day(name):
+    return calendar.timegm(tuple(int(p) for p in name[:-4].split('_')) + (0, 0, 0)) // DAY
+
+
+class Partition:
+    '''One device's rows of one day, in a memory-mapped file'''
+    def __init__(self, path, writable=True, capacity=None):
+        self.path = path
+        self.writable = writable
+        if capacity is not None:
+            self._create(path, capacity)
+        self._map()
+
+    @staticmethod
+    def _create(path, capacity):
+        size = DATA_OFFSET + capacity * sum(dtype.itemsize for name, dtype in COLUMNS)
+        with open(path, 'wb') as f:
+            f.write(struct.pack(HEADER, MAGIC, VERSION, len(COLUMNS), capacity, 0))
+            f.truncate(size)
+
+    def _map(self):
+        with open(self.path, 'r+b' if self.writable else 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ)
+        magic, version, columns, self.capacity, self.rows = struct.unpack_from(HEADER, self.mm)
+        if magic != MAGIC or version != VERSION or columns != len(COLUMNS):
+            self.mm.close()
+            raise ValueError('{} is not a version {} partition'.format(self.path, VERSION))
+        self.columns = {}
+        offset = DATA_OFFSET
+        for name, dtype in COLUMNS:
+            self.columns[name] = np.ndarray((self.capacity,), dtype, buffer=self.mm, offset=offset)
+            offset += self.capacity * dtype.itemsize
+
+    def time(self):
+        return self.columns['time'][:self.rows]
+
+    def _grow(self, rows):
+        capacity = self.capacity
+        while capacity < rows:
+            capacity *= 2
+        # copied to a new file and swapped in, a partition is never left half moved
+        tmp = self.path + '.tmp'
+        self._create(tmp, capacity)
+        grown = Partition(tmp)
+        for name, column in self.columns.items():
+            grown.columns[name][:self.rows] = column[:self.rows]
+        grown.rows = self.rows
+        grown.close()
+        self.close(flush=False)
+        os.replace(tmp, self.path)
+        self._map()
+
+    def append(self, columns):
+        '''Adds rows, `columns` holding an array for every column'''
+        t = columns['time']
+        n = len(t)
+        if self.rows + n > self.capacity:
+            self._grow(self.rows + n)
+        rows = self.rows
+        ordered = (rows == 0 or t[0] > self.columns['time'][rows - 1]) and bool(np.all(t[1:] > t[:-1]))
+        for name, column in self.columns.items():
+            column[rows:rows + n] = columns[name]
+        self.rows = rows + n
+        if not ordered:
+            self._sort()
+
+    def _sort(self):
+        '''Sorts the rows by time, keeping the last one received for a repeated time'''
+        order = np.argsort(self.time(), kind='stable')
+        t = self.time()[order]
+        keep = np.empty(len(t), bool)
+        keep[-1] = True
+        np.not_equal(t[1:], t[:-1], out=keep[:-1])
+        order = order[keep]
+        for column in self.columns.values():
+            column[:len(order)] = column[:self.rows][order]
+        self.rows = len(order)
+
+    def search(self, start, end):
+        '''Row slice of start <= time < end'''
+        t = self.time()
+        return slice(int(np.searchsorted(t, start, 'left')), int(np.searchsorted(t, end, 'left')))
+
+    def flush(self):
+        if self.writable:
+            struct.pack_into('<I', self.mm, 12, self.rows)
+            self.mm.flush()
+
+    def close(self, flush=True):
+        if flush:
+            self.flush()
+        # the column views have to go before the map can be closed
+        self.columns = {}
+        self.mm.close()
+
+
+class ColumnStore:
+    '''
+    Per-device, day partitioned store under `root`. Partitions are opened on demand and at most
+    `max_open` are kept mapped, least recently used first to go. Every map holds a file descriptor,
+    so a fleet wider than the open file limit keeps evicting (see tools/ingest.py raise_file_limit()).
+    '''
+    def __init__(self, root, writable=True, max_open=MAX_OPEN):
+        self.root = root
+        self.writable = writable
+        self.max_open = max_open
+        self.partitions = OrderedDict()     # (device, day) -> Partition
+        self.rows_written = 0
+        if writable:
+            os.makedirs(root, exist_ok=True)
+
+    def _path(self, device, day):
+        return os.path.join(self.root, device, day_name(day))
+
+    def partition(self, device, day, create=False):
+        '''The open Partition of device for a day number, None when there is none and create is False'''
+        key = (device, day)
+        partition = self.partitions.get(key)
+        if partition is not None:
+            self.partitions.move_to_end(key)
+            return partition
+        path = self._path(device, day)
+        if os.path.exists(path):
+            partition = Partition(path, self.writable)
+        elif create:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            partition = Partition(path, capacity=INITIAL_ROWS)
+        else:
+            return None
+        self.partitions[key] = partition
+        if len(self.partitions) > self.max_open:
+            self.partitions.popitem(last=False)[1].close()
+        return partition
+
+    def devices(self):
+        return sorted(d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d)))
+
+    def days(self, device):
+        try:
+            names = os.listdir(os.path.join(self.root, device))
+        except OSError:
+            return []
+        return sorted(name_day(name) for name in names if name.endswith('.col'))
+
+    def append(self, devices, device_index, columns):
+        '''
+        Writes a batch of rows from many devices: row i belongs to devices[device_index[i]].
+        Rows are grouped by device and day with one stable sort, arrival order is kept within a group.
+        '''
+        day = columns['time'] // DAY
+        order = np.lexsort((day, device_index))
+        key_device = device_index[order]
+        key_day = day[order]
+        bounds = np.flatnonzero((key_device[1:] != key_device[:-1]) | (key_day[1:] != key_day[:-1])) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(order)]))
+        sorted_columns = {name: columns[name][order] for name, dtype in COLUMNS}
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            partition = self.partition(devices[key_device[start]], int(key_day[start]), create=True)
+            partition.append({name: column[start:end] for name, column in sorted_columns.items()})
+        self.rows_written += len(order)
+
+    def flush(self):
+        for partition in self.partitions.values():
+            partition.flush()
+
+    def close(self):
+        while self.partitions:
+            self.partitions.popitem()[1].close()
+
+    def _slices(self, device, start, end):
+        for day in self.days(device):
+            if day * DAY + DAY <= start or day * DAY >= end:
+                continue
+            partition = self.partition(device, day)
+            rows = partition.search(start, end)
+            if rows.stop > rows.start:
+                yield partition, rows
+
+    def range(self, device, start, end, columns=None, raw=False):
+        '''
+        Rows of device with start <= time < end (unix s) as {column: array}. Readings are floats in
+        DATA's units with NaN for missing ones, or the stored integers when raw.
+        '''
+        names = ['time'] + list(columns if columns is not None else (name for name, dtype in COLUMNS[1:]))
+        parts = {name: [] for name in names}
+        for partition, rows in self._slices(device, start, end):
+            for name in names:
+                # copies, nothing returned keeps a partition's map alive
+                parts[name].append(np.array(partition.columns[name][rows]))
+        result = {}
+        for name in names:
+            dtype = dict(COLUMNS)[name]
+            values = np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype)
+            if name in SCALES and not raw:
+                values = scaled(values, SCALES[name])
+            result[name] = values
+        return result
+
+    def downsample(self, device, start, end, bucket, columns=None):
+        '''
+        Readings of device over start <= time < end in buckets of `bucket` s, aligned on start.
+        Returns {'time': bucket starts, 'count': rows per bucket, reading: {'min', 'max', 'mean'}}
+        for the buckets that hold rows; min, max and mean skip missing readings (NaN when all are).
+        '''
+        names = list(columns) if columns is not None else [name for name, scale in telemetry.FIELDS]
+        rows = self.range(device, start, end, names, raw=True)
+        t = rows['time']
+        index = (t - start) // bucket
+        starts = np.flatnonzero(np.diff(index, prepend=-1))
+        result = {'time': start + index[starts] * bucket, 'count': np.diff(np.append(starts, len(t)))}
+        for name in names:
+            values = rows[name]
+            scale = SCALES[name]
+            if not len(t):
+                result[name] = {'min': np.empty(0), 'max': np.empty(0), 'mean': np.empty(0)}
+                continue
+            valid = values != telemetry.MISSING
+            n = np.add.reduceat(valid.astype(np.intp), starts)
+            total = np.add.reduceat(np.where(valid, values, 0).astype(np.int64), starts)
+            low = np.minimum.reduceat(np.where(valid, values, 32767), starts)
+            # MISSING is the smallest int16, it never wins a max over a real reading
+            high = np.maximum.reduceat(values, starts)
+            empty = n == 0
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = total / n
+            result[name] = {
+                'min': np.where(empty, np.nan, low / scale),
+                'max': np.where(empty, np.nan, high / scale),
+                'mean': mean / scale,
+                }
+        return result
+
+
+def scaled(values, scale):
+    '''Stored integers to floats in DATA's units, NaN for MISSING'''
+    out = values / scale
+    out[values == telemetry.MISSING] = np.nan
+    return out
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return 1
+    store = ColumnStore(sys.argv[1], writable=False)
+    devices = store.devices() if len(sys.argv) < 3 else [sys.argv[2]]
+    hours = float(sys.argv[3]) if len(sys.argv) > 3 else 24
+    bucket = int(sys.argv[4]) if len(sys.argv) > 4 else 900
+    for device in devices:
+        days = store.days(device)
+        if not days:
+            continue
+        end = store.partition(device, days[-1]).time()[-1] + 1
+        start = int(end - hours * 3600)
+        summary = store.downsample(device, start, end, bucket, ('battery_voltage', 'solar_current', 'scc_load_current'))
+        print('{} ({} partitions)'.format(device, len(days)))
+        for i in range(len(summary['time'])):
+            print('  {} {:>5} rows  battery {:6.2f} V  solar {:6.3f} A  load {:6.3f} A'.format(
+                time.strftime('%Y_%m_%d_%H_%M_%S', time.gmtime(summary['time'][i])), summary['count'][i],
+                summary['battery_voltage']['mean'][i], summary['solar_current']['mean'][i],
+                summary['scc_load_current']['mean'][i]))
+    store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())